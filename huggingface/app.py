@@ -13,6 +13,7 @@ import gradio as gr
 import requests
 from typing import Dict, List
 import os
+import random
 
 # ==================== 配置 ====================
 
@@ -22,12 +23,20 @@ RAG_SERVER_URL = os.getenv("RAG_SERVER_URL", "http://10.164.243.10:8000")
 # 如果你的 GPU 服务器需要认证
 API_KEY = os.getenv("RAG_API_KEY", "")
 
+# 链路追踪采样率（0~1），采样的请求会在 RAG 服务器端导出 span
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+
+def new_traceparent() -> str:
+    """为每次调用生成新的 W3C traceparent"""
+    sampled = "01" if random.random() < TRACE_SAMPLE_RATE else "00"
+    return f"00-{os.urandom(16).hex()}-{os.urandom(8).hex()}-{sampled}"
+
 # ==================== API 调用函数 ====================
 
 def call_rag_server(endpoint: str, data: Dict) -> Dict:
     """调用远程 RAG 服务器"""
     try:
-        headers = {}
+        headers = {"traceparent": new_traceparent()}
         if API_KEY:
             headers["Authorization"] = f"Bearer {API_KEY}"
         
@@ -104,7 +113,8 @@ def rag_search_fn(query: str, top_k: int, retriever: str, reranker: str):
         "query": query,
         "top_k": top_k,
         "retriever": retriever,
-        "reranker": reranker
+        "reranker": reranker,
+        "fields": "ui"  # 只返回展示卡片用到的字段
     })
     
     return format_search_results(result)
@@ -7,10 +7,21 @@ MCP RAG Search Tool
 
 import requests
 import json
+import os
+import random
 from mcp.server.fastmcp import FastMCP
 
 mcp = FastMCP("LocalSearchRAG")
 
+# 链路追踪采样率（0~1）
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+
+
+def _new_traceparent() -> str:
+    """为每次工具调用生成新的 W3C traceparent"""
+    sampled = "01" if random.random() < TRACE_SAMPLE_RATE else "00"
+    return f"00-{os.urandom(16).hex()}-{os.urandom(8).hex()}-{sampled}"
+
 
 @mcp.tool()
 def query_rag(query: str, city: str = "上海", topk: int = 5, retrieval_k: int = 50):
@@ -40,7 +51,8 @@ def query_rag(query: str, city: str = "上海", topk: int = 5, retrieval_k: int
         
         # 设置请求头和代理
         headers = {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "traceparent": _new_traceparent()
         }
         
         # 使用本地连接，绕过代理
@@ -121,7 +133,7 @@ def web_search(query: str, search_type: str = "google", max_results: int = 5):
             "max_results": max_results
         }
         
-        headers = {"Content-Type": "application/json"}
+        headers = {"Content-Type": "application/json", "traceparent": _new_traceparent()}
         proxies = {"http": None, "https": None}
         
         response = requests.post(
@@ -1,101 +1,592 @@
 #!/usr/bin/env python3
 """
-CORS 代理服务器
+CORS 代理服务器（asyncio）
 用于转发前端请求到内网 RAG 服务器
+
+- 上游使用共享的 keep-alive 连接池（aiohttp.ClientSession）
+- 响应体分块透传，支持 SSE（text/event-stream）等流式响应
+- 按路由配置超时和并发上限，超出并发时返回 503 + Retry-After
+- 幂等的搜索请求按 (路径, 规范化 JSON 请求体) 缓存一段时间（TTL），
+  并发的相同请求合并为一次上游调用；/health 不缓存
+- 传播 W3C traceparent（没有时新建 trace），代理 span 由后台线程以 OTLP/JSON 写入 PROXY_TRACE_FILE
+- /geo/{name} 提供预处理的多级地图几何（server/build_map_geometry.py 生成），带 ETag 与长缓存头
 """
 
-from flask import Flask, request, Response, jsonify
-from flask_cors import CORS
-import requests
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import queue
+import random
 import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 
-app = Flask(__name__)
-CORS(app)  # 允许所有跨域请求
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
 
 # 内网 RAG 服务器地址
 # 修改这里为您的实际内网地址
 RAG_SERVER = "http://内网IP:8000"  # 例如: http://192.168.1.100:8000
 
-@app.route('/health', methods=['GET'])
-def health():
-    """健康检查"""
+PROXY_HOST = "0.0.0.0"
+PROXY_PORT = 8001
+
+# 逐跳头部，不向下游/上游转发
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length',
+}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': '*',
+}
+
+@dataclass
+class RouteLimit:
+    """单条路由的超时与并发配置"""
+    timeout: float          # 上游请求超时（秒）；流式响应时作为两次读之间的最大间隔
+    max_concurrency: int    # 同时转发的最大请求数
+    queue_timeout: float = 1.0  # 等待并发槽位的最长时间（秒）
+
+
+# 按路径前缀匹配（最长前缀优先）
+ROUTE_LIMITS: Dict[str, RouteLimit] = {
+    "/health": RouteLimit(timeout=5, max_concurrency=16),
+    "/api/rag/": RouteLimit(timeout=120, max_concurrency=32),
+    "/api/agentic/": RouteLimit(timeout=300, max_concurrency=8),
+    "/api/": RouteLimit(timeout=60, max_concurrency=64),
+}
+
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+# 可缓存的幂等搜索接口
+CACHEABLE_PATHS = ("/api/rag/search", "/api/web/search")
+CACHE_TTL = float(os.getenv("PROXY_CACHE_TTL", "60"))  # 秒，0 表示关闭缓存
+CACHE_MAX_ENTRIES = int(os.getenv("PROXY_CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_BODY_BYTES = 2 * 1024 * 1024
+
+
+@dataclass
+class CachedResponse:
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+    created_at: float
+    ttl: Optional[float] = None  # 比缓存默认 TTL 更短的有效期（响应中的游标会先于缓存过期）
+
+
+class ResponseCache:
+    """带 TTL 的 LRU 响应缓存"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.abandoned = 0  # 所有客户端都已断开而取消的上游请求
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        ttl = self.ttl if entry.ttl is None else entry.ttl
+        if time.time() - entry.created_at > ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+# 预处理的地图几何：static/geo/manifest.json + {name}.{level}.topo.json
+GEO_DIR = os.getenv("PROXY_GEO_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "geo"))
+GEO_MAX_AGE = 86400  # 未带版本参数（v=内容哈希）时的缓存秒数；带版本参数时为一年且 immutable
+
+
+@dataclass
+class GeoAsset:
+    body: bytes
+    gzip_body: bytes
+    etag: str
+    level: str
+
+
+class GeoAssets:
+    """按需读取并常驻内存的地图几何（原文 + 预压缩的 gzip）"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._manifest: Optional[Dict] = None
+        self._assets: Dict[str, GeoAsset] = {}
+
+    def manifest(self) -> Dict:
+        if self._manifest is None:
+            path = os.path.join(self.directory, "manifest.json")
+            if not os.path.exists(path):
+                return {"files": {}}
+            with open(path, "r", encoding="utf-8") as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    def choose_level(self, name: str, level: Optional[str], width: Optional[int]) -> Optional[str]:
+        """显式 level 优先；否则按渲染宽度（CSS 像素 × devicePixelRatio）取够用的最低级别"""
+        levels = self.manifest()["files"].get(name, {}).get("levels", {})
+        if level:
+            return level if level in levels else None
+        ordered = sorted(levels.items(), key=lambda item: item[1]["max_width_px"])
+        if not ordered:
+            return None
+        for level_name, info in ordered:
+            if width is None or width <= info["max_width_px"]:
+                return level_name
+        return ordered[-1][0]
+
+    def get(self, name: str, level: str) -> GeoAsset:
+        key = f"{name}.{level}"
+        asset = self._assets.get(key)
+        if asset is None:
+            info = self.manifest()["files"][name]["levels"][level]
+            with open(os.path.join(self.directory, info["file"]), "rb") as f:
+                body = f.read()
+            asset = GeoAsset(body, gzip.compress(body, compresslevel=9), f'"{info["sha256"]}"', level)
+            self._assets[key] = asset
+        return asset
+
+
+_geo_assets = GeoAssets(GEO_DIR)
+
+
+# 链路追踪
+TRACE_SAMPLE_RATE = float(os.getenv("PROXY_TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("PROXY_TRACE_FILE")
+
+
+def _start_span(request: web.Request) -> Dict:
+    """从 traceparent 继续 trace，或按采样率新建 trace"""
+    parts = request.headers.get('traceparent', '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        trace_id, parent_id = parts[1], parts[2]
+        sampled = parts[3] == '01' or random.random() < TRACE_SAMPLE_RATE
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+        sampled = random.random() < TRACE_SAMPLE_RATE
+    span = {
+        "traceId": trace_id,
+        "spanId": os.urandom(8).hex(),
+        "name": f"proxy {request.method} {request.path}",
+        "kind": 2,  # SPAN_KIND_SERVER
+        "startTimeUnixNano": str(time.time_ns()),
+        "sampled": sampled,
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    return span
+
+
+def _traceparent(span: Dict) -> str:
+    return f"00-{span['traceId']}-{span['spanId']}-{'01' if span['sampled'] else '00'}"
+
+
+class SpanWriter:
+    """后台线程把 span 按 OTLP/JSON（ExportTraceServiceRequest，每批一行）追加到文件，不在事件循环里写盘"""
+
+    def __init__(self, path: str, batch_size: int = 64, flush_interval: float = 2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=10000)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="proxy-span-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, span: Dict):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0):
+        """写完队列中剩余的 span 后退出"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            span = self._queue.get()
+            if span is None:
+                return
+            batch = [span]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size and time.time() < deadline:
+                try:
+                    span = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    self._write(batch)
+                    return
+                batch.append(span)
+            self._write(batch)
+
+    def _write(self, batch: List[Dict]):
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "cors-proxy"}}]},
+            "scopeSpans": [{"scope": {"name": "proxy_server"}, "spans": batch}],
+        }]}
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"⚠️ 写入 span 失败（{len(batch)} 条）: {e}")
+
+
+_span_writer: Optional[SpanWriter] = None
+
+
+def _end_span(span: Dict, response: web.StreamResponse):
+    if not (span['sampled'] and _span_writer is not None):
+        return
+    attributes = [{"key": "http.status_code", "value": {"intValue": str(response.status)}}]
+    cache_status = response.headers.get('X-Proxy-Cache')
+    if cache_status:
+        attributes.append({"key": "cache", "value": {"stringValue": cache_status}})
+    span = dict(span, endTimeUnixNano=str(time.time_ns()), attributes=attributes,
+                status={"code": 2 if response.status >= 500 else 1})  # STATUS_CODE_ERROR / OK
+    span.pop('sampled')
+    _span_writer.write(span)
+
+
+_cache = ResponseCache(CACHE_TTL, CACHE_MAX_ENTRIES)
+# 进行中的上游请求：相同 key 的并发请求共享同一个 Task
+_inflight: Dict[str, "asyncio.Task[CachedResponse]"] = {}
+# 每个上游 Task 还有多少客户端在等；全部断开后取消 Task，上游连接随之关闭，RAG 服务器停止计算
+_waiters: Dict["asyncio.Task[CachedResponse]", int] = {}
+
+
+def _route_for(path: str) -> str:
+    return max((prefix for prefix in ROUTE_LIMITS if path.startswith(prefix)), key=len, default="/api/")
+
+
+def _error(status: int, message: str, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    return web.json_response({"status": "error", "message": message}, status=status, headers=headers)
+
+
+@web.middleware
+async def cors_middleware(request: web.Request, handler):
+    """允许所有跨域请求（含预检）"""
+    if request.method == 'OPTIONS':
+        return web.Response(status=204, headers=CORS_HEADERS)
+    response = await handler(request)
+    if not response.prepared:
+        response.headers.update(CORS_HEADERS)
+    return response
+
+
+def _upstream_headers(request: web.Request) -> Dict[str, str]:
+    return {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+def _is_cacheable(request: web.Request) -> bool:
+    if CACHE_TTL <= 0 or request.method not in ('GET', 'POST') or request.path not in CACHEABLE_PATHS:
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
+
+
+def _cache_key(request: web.Request, body: bytes) -> str:
+    """路径 + 查询参数 + Accept-Encoding + 规范化 JSON 请求体（键排序、去空白）"""
     try:
-        response = requests.get(f"{RAG_SERVER}/health", timeout=5)
-        return Response(
-            response.content,
-            status=response.status_code,
-            headers=dict(response.headers)
-        )
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": f"无法连接到 RAG 服务器: {str(e)}"
-        }), 503
+        canonical_body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False, separators=(',', ':')) if body else ''
+    except ValueError:
+        canonical_body = body.decode('utf-8', errors='replace')
+    query = '&'.join(f"{k}={v}" for k, v in sorted(request.query.items()))
+    # 上游按 Accept-Encoding 压缩响应（Vary），压缩与未压缩的响应分开缓存
+    encoding = request.headers.get('Accept-Encoding', '').replace(' ', '')
+    raw = f"{request.method} {request.path}?{query}\n{encoding}\n{canonical_body}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+async def _forward(request: web.Request, upstream_path: str, unavailable_message: str,
+                   traceparent: Optional[str] = None) -> web.StreamResponse:
+    """转发请求到 RAG 服务器并分块透传响应"""
+    route = _route_for(request.path)
+    limit = ROUTE_LIMITS[route]
+    semaphore = _semaphores[route]
 
-@app.route('/api/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy(path):
-    """代理所有 API 请求"""
     try:
-        # 构建目标 URL
-        url = f"{RAG_SERVER}/api/{path}"
-        
-        # 转发请求
-        if request.method == 'GET':
-            response = requests.get(
-                url,
-                params=request.args,
-                headers={k: v for k, v in request.headers if k.lower() != 'host'},
-                timeout=120
-            )
-        elif request.method == 'POST':
-            response = requests.post(
-                url,
-                json=request.get_json(),
-                params=request.args,
-                headers={k: v for k, v in request.headers if k.lower() != 'host'},
-                timeout=120
-            )
+        await asyncio.wait_for(semaphore.acquire(), timeout=limit.queue_timeout)
+    except asyncio.TimeoutError:
+        return _error(503, "代理繁忙，请稍后重试", headers={"Retry-After": "1"})
+
+    response: Optional[web.StreamResponse] = None
+    try:
+        session: aiohttp.ClientSession = request.app["upstream"]
+        headers = _upstream_headers(request)
+        if traceparent:
+            headers['traceparent'] = traceparent
+        body = await request.read() if request.can_read_body else None
+
+        # SSE 客户端的长连接不设总超时，只限制两次读之间的间隔
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=limit.timeout)
         else:
-            return jsonify({"error": "Method not allowed"}), 405
-        
-        # 返回响应
-        excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
-        headers = [(name, value) for (name, value) in response.raw.headers.items()
-                   if name.lower() not in excluded_headers]
-        
-        return Response(
-            response.content,
-            status=response.status_code,
-            headers=headers
-        )
-        
-    except requests.exceptions.Timeout:
-        return jsonify({
-            "status": "error",
-            "message": "请求超时"
-        }), 504
-    except requests.exceptions.ConnectionError:
-        return jsonify({
-            "status": "error",
-            "message": f"无法连接到 RAG 服务器 {RAG_SERVER}"
-        }), 503
+            timeout = aiohttp.ClientTimeout(total=limit.timeout, sock_connect=5)
+
+        async with session.request(
+            request.method,
+            f"{RAG_SERVER}{upstream_path}",
+            params=request.query,
+            headers=headers,
+            data=body,
+            timeout=timeout,
+        ) as upstream:
+            response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+            for name, value in upstream.headers.items():
+                if name.lower() not in HOP_BY_HOP_HEADERS:
+                    response.headers.add(name, value)
+            response.headers.update(CORS_HEADERS)
+            await response.prepare(request)
+
+            # iter_any：有数据就立即下发，SSE 事件不会被攒批
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+    except ConnectionResetError:
+        # 下游客户端已断开
+        raise
     except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": str(e)
-        }), 500
+        if response is not None and response.prepared:
+            # 响应头已发出，只能截断流
+            print(f"⚠️ Upstream stream aborted for {request.path}: {e}")
+            return response
+        if isinstance(e, asyncio.TimeoutError):
+            return _error(504, "请求超时")
+        if isinstance(e, aiohttp.ClientConnectionError):
+            return _error(503, unavailable_message)
+        return _error(500, str(e))
+    finally:
+        semaphore.release()
+
+
+async def _fetch_buffered(app: web.Application, method: str, path: str, query, headers: Dict[str, str],
+                          body: bytes, upstream_path: str, unavailable_message: str) -> CachedResponse:
+    """完整读取上游响应（用于缓存和请求合并）；错误也以响应形式返回给所有等待者"""
+    route = _route_for(path)
+    limit = ROUTE_LIMITS[route]
+    semaphore = _semaphores[route]
+
+    def _error_entry(status: int, message: str, extra: Optional[List[Tuple[str, str]]] = None) -> CachedResponse:
+        payload = json.dumps({"status": "error", "message": message}, ensure_ascii=False).encode('utf-8')
+        return CachedResponse(status, [('Content-Type', 'application/json; charset=utf-8')] + (extra or []),
+                              payload, time.time())
+
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=limit.queue_timeout)
+    except asyncio.TimeoutError:
+        return _error_entry(503, "代理繁忙，请稍后重试", [('Retry-After', '1')])
+
+    try:
+        session: aiohttp.ClientSession = app["upstream"]
+        async with session.request(
+            method,
+            f"{RAG_SERVER}{upstream_path}",
+            params=query,
+            headers=headers,
+            data=body or None,
+            timeout=aiohttp.ClientTimeout(total=limit.timeout, sock_connect=5),
+        ) as upstream:
+            payload = await upstream.read()
+            resp_headers = [(name, value) for name, value in upstream.headers.items()
+                            if name.lower() not in HOP_BY_HOP_HEADERS]
+            return CachedResponse(upstream.status, resp_headers, payload, time.time())
+    except asyncio.TimeoutError:
+        return _error_entry(504, "请求超时")
+    except aiohttp.ClientConnectionError:
+        return _error_entry(503, unavailable_message)
+    except Exception as e:
+        return _error_entry(500, str(e))
+    finally:
+        semaphore.release()
+
+
+def _cached_response(entry: CachedResponse, cache_status: str) -> web.Response:
+    response = web.Response(status=entry.status, body=entry.body, headers=CIMultiDict(entry.headers))
+    response.headers['X-Proxy-Cache'] = cache_status
+    if cache_status == 'HIT':
+        response.headers['Age'] = str(int(time.time() - entry.created_at))
+    return response
+
+
+async def _cached_forward(request: web.Request, upstream_path: str, unavailable_message: str,
+                          traceparent: Optional[str] = None) -> web.StreamResponse:
+    """先查缓存，再合并进行中的相同请求，最后才转发到上游"""
+    body = await request.read() if request.can_read_body else b''
+    key = _cache_key(request, body)
+
+    entry = _cache.get(key)
+    if entry is not None:
+        _cache.hits += 1
+        return _cached_response(entry, 'HIT')
+
+    task = _inflight.get(key)
+    if task is not None:
+        _cache.coalesced += 1
+        cache_status = 'COALESCED'
+    else:
+        _cache.misses += 1
+        cache_status = 'MISS'
+        # 上游请求放在独立 Task 中，发起者断开连接不会影响其他等待者
+        headers = _upstream_headers(request)
+        if traceparent:
+            headers['traceparent'] = traceparent
+        task = asyncio.ensure_future(_fetch_buffered(
+            request.app, request.method, request.path, request.query.copy(),
+            headers, body, upstream_path, unavailable_message,
+        ))
+        _inflight[key] = task
+
+        def _done(t: "asyncio.Task[CachedResponse]"):
+            _inflight.pop(key, None)
+            if not t.cancelled() and t.exception() is None:
+                result = t.result()
+                # 过载降级（X-Degraded）的结果不缓存，负载恢复后应拿到完整结果
+                degraded = any(k.lower() == 'x-degraded' for k, _ in result.headers)
+                if result.status == 200 and not degraded and len(result.body) <= CACHE_MAX_BODY_BYTES:
+                    # 带分页游标的结果最多缓存到游标过期，之后再命中的客户端翻页只会拿到 410
+                    cursor_ttl = next((v for k, v in result.headers if k.lower() == 'x-cursor-ttl'), None)
+                    if cursor_ttl is not None:
+                        try:
+                            result.ttl = min(CACHE_TTL, float(cursor_ttl))
+                        except ValueError:
+                            result.ttl = 0.0
+                    _cache.put(key, result)
+
+        task.add_done_callback(_done)
+
+    _waiters[task] = _waiters.get(task, 0) + 1
+    try:
+        entry = await asyncio.shield(task)
+    finally:
+        _waiters[task] -= 1
+        if not _waiters[task]:
+            del _waiters[task]
+            if not task.done():
+                _cache.abandoned += 1
+                task.cancel()
+    return _cached_response(entry, cache_status)
+
+
+async def health(request: web.Request) -> web.StreamResponse:
+    """健康检查"""
+    span = _start_span(request)
+    response = await _forward(request, "/health", f"无法连接到 RAG 服务器: {RAG_SERVER}", _traceparent(span))
+    _end_span(span, response)
+    return response
+
+
+async def proxy(request: web.Request) -> web.StreamResponse:
+    """代理所有 API 请求"""
+    path = request.match_info["path"]
+    unavailable_message = f"无法连接到 RAG 服务器 {RAG_SERVER}"
+    span = _start_span(request)
+    if _is_cacheable(request):
+        response = await _cached_forward(request, f"/api/{path}", unavailable_message, _traceparent(span))
+    else:
+        response = await _forward(request, f"/api/{path}", unavailable_message, _traceparent(span))
+    _end_span(span, response)
+    return response
+
+
+async def geo(request: web.Request) -> web.Response:
+    """地图几何：/geo 返回 manifest；/geo/{name}?width=1500 或 ?level=low 返回对应级别的 TopoJSON"""
+    name = request.match_info.get("name")
+    if not name:
+        return web.json_response(_geo_assets.manifest(), headers={'Cache-Control': 'public, max-age=300'})
+    try:
+        width = int(request.query["width"]) if "width" in request.query else None
+    except ValueError:
+        return _error(400, "width must be an integer")
+    level = _geo_assets.choose_level(name, request.query.get("level"), width)
+    if level is None:
+        return _error(404, f"No geometry for '{name}' (level={request.query.get('level')})")
+    asset = _geo_assets.get(name, level)
+
+    # 带内容哈希作为版本参数的 URL 内容永不变化；否则短期缓存 + ETag 协商
+    versioned = request.query.get("v") == asset.etag.strip('"')
+    headers = {
+        'Cache-Control': 'public, max-age=31536000, immutable' if versioned
+                         else f'public, max-age={GEO_MAX_AGE}, stale-while-revalidate={GEO_MAX_AGE * 7}',
+        'ETag': asset.etag,
+        'Vary': 'Accept-Encoding',
+        'X-Geo-Level': level,
+    }
+    if request.headers.get('If-None-Match') == asset.etag:
+        return web.Response(status=304, headers=headers)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return web.Response(body=asset.gzip_body, content_type='application/json', headers=headers)
+    return web.Response(body=asset.body, content_type='application/json', headers=headers)
+
+
+async def _on_startup(app: web.Application):
+    # 共享 keep-alive 连接池
+    connector = aiohttp.TCPConnector(limit=256, limit_per_host=128, keepalive_timeout=60)
+    app["upstream"] = aiohttp.ClientSession(connector=connector, auto_decompress=False)
+    for prefix, limit in ROUTE_LIMITS.items():
+        _semaphores[prefix] = asyncio.Semaphore(limit.max_concurrency)
+    global _span_writer
+    if TRACE_FILE:
+        _span_writer = SpanWriter(TRACE_FILE)
+
+
+async def _on_cleanup(app: web.Application):
+    global _span_writer
+    await app["upstream"].close()
+    if _span_writer is not None:
+        await asyncio.get_running_loop().run_in_executor(None, _span_writer.close)
+        _span_writer = None
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[cors_middleware])
+    app.router.add_get('/health', health)
+    app.router.add_get('/geo', geo)
+    app.router.add_get('/geo/{name}', geo)
+    app.router.add_route('*', '/api/{path:.*}', proxy)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        RAG_SERVER = sys.argv[1]
-    
+        RAG_SERVER = sys.argv[1].rstrip('/')
+
     print("=" * 60)
     print("🚀 CORS 代理服务器启动")
     print("=" * 60)
     print(f"📡 目标 RAG 服务器: {RAG_SERVER}")
-    print(f"🌐 本地代理地址: http://localhost:8001")
+    print(f"🌐 本地代理地址: http://localhost:{PROXY_PORT}")
     print(f"📝 用法: python3 proxy_server.py [RAG服务器地址]")
+    print(f"🗄️  搜索缓存 TTL: {CACHE_TTL:.0f}s（最多 {CACHE_MAX_ENTRIES} 条）")
     print("=" * 60)
     print()
-    
-    app.run(host='0.0.0.0', port=8001, debug=False)
+
+    # handler_cancellation：浏览器断开（超时 / 重新提交）时取消处理函数，不再为它等待上游
+    web.run_app(create_app(), host=PROXY_HOST, port=PROXY_PORT, handler_cancellation=True)
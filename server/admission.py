@@ -0,0 +1,160 @@
+"""
+准入控制与过载降级：在途请求上限、按优先级排序的有界等待队列，以及按排队深度决定的降级级别
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from observability import Counter, Histogram, metrics_registry
+
+# ==================== 准入控制与降级 ====================
+# 搜索端点最多同时处理 max_in_flight 个请求，其余按优先级排队（有界队列 + 排队超时）。
+# 过载时尽早拒绝（429 / 503 + Retry-After），或按排队深度自动降级：先关闭 LLM 精排，再关闭 rerank。
+
+PRIORITY_CLASSES = ("interactive", "batch", "eval")  # 排在前面的优先级更高
+# 各优先级最多能用到的排队名额比例：批量 / 评测流量更早被拒绝，为交互请求留出空间
+QUEUE_SHARE = {"interactive": 1.0, "batch": 0.5, "eval": 0.25}
+
+# 降级级别
+DEGRADE_NONE, DEGRADE_NO_LLM, DEGRADE_NO_RERANK = 0, 1, 2
+
+ADMISSION_REJECTED = metrics_registry.register(Counter(
+    "rag_admission_rejected_total", "Requests shed by admission control", ("priority", "reason")))
+ADMISSION_WAIT = metrics_registry.register(Histogram(
+    "rag_admission_wait_seconds", "Time spent queued before admission", ("priority",)))
+DEGRADED = metrics_registry.register(Counter(
+    "rag_degraded_requests_total", "Requests served with LLM ranking / reranking switched off", ("level",)))
+
+class AdmissionController:
+    """在途请求上限 + 按优先级排序的有界等待队列（只在事件循环线程中使用）"""
+    
+    def __init__(self, max_in_flight: int = 8, max_queue: int = 64, queue_timeout: float = 5.0,
+                 degrade_llm_at: float = 0.25, degrade_rerank_at: float = 0.75):
+        self.configure(max_in_flight, max_queue, queue_timeout, degrade_llm_at, degrade_rerank_at)
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # (优先级, 序号, future) 小顶堆
+        self._seq = itertools.count()
+        self._service_time = 1.0  # 请求处理耗时的指数滑动平均（秒），用于估算 Retry-After
+    
+    def configure(self, max_in_flight: int, max_queue: int, queue_timeout: float,
+                  degrade_llm_at: float, degrade_rerank_at: float):
+        """degrade_*_at：排队名额占用比例达到该值时进入对应降级级别"""
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.degrade_llm_at = degrade_llm_at
+        self.degrade_rerank_at = degrade_rerank_at
+    
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+    
+    def degrade_level(self) -> int:
+        if self.max_queue == 0:
+            fill = 1.0 if self.in_flight >= self.max_in_flight else 0.0
+        else:
+            fill = self.queued / self.max_queue
+        if fill >= self.degrade_rerank_at:
+            return DEGRADE_NO_RERANK
+        if fill >= self.degrade_llm_at:
+            return DEGRADE_NO_LLM
+        return DEGRADE_NONE
+    
+    def retry_after(self) -> int:
+        """按当前排队长度和平均处理耗时估算多久后重试（秒）"""
+        return max(1, math.ceil((self.queued + 1) * self._service_time / self.max_in_flight))
+    
+    def _rejection(self, priority: str, reason: str) -> HTTPException:
+        ADMISSION_REJECTED.inc(priority=priority, reason=reason)
+        # 交互请求被拒说明服务整体过载（503）；批量 / 评测流量被拒是让调用方退避（429）
+        status = 503 if priority == "interactive" else 429
+        return HTTPException(status_code=status, detail=f"Server overloaded ({reason}), please retry later",
+                             headers={"Retry-After": str(self.retry_after())})
+    
+    def _evict_lowest(self, rank: int) -> bool:
+        """队列满时，挤掉排在最后且优先级低于 rank 的等待者"""
+        victim = max(self._waiters, key=lambda w: (w[0], w[1]), default=None)
+        if victim is None or victim[0] <= rank:
+            return False
+        self._waiters.remove(victim)
+        heapq.heapify(self._waiters)
+        victim[2].set_exception(self._rejection(PRIORITY_CLASSES[victim[0]], "evicted"))
+        return True
+    
+    async def _acquire(self, priority: str):
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return
+        
+        rank = PRIORITY_CLASSES.index(priority)
+        share = int(self.max_queue * QUEUE_SHARE[priority])
+        if self.queued >= share:
+            # 队列满时可以挤掉更低优先级的等待者，但挤掉之后仍须在本优先级的排队名额比例之内，
+            # 否则 batch 可以靠挤掉 eval 占满整个队列
+            if self.queued < self.max_queue or self.queued - 1 >= share or not self._evict_lowest(rank):
+                raise self._rejection(priority, "queue_full")
+        
+        entry = (rank, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(entry[2], timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._rejection(priority, "queue_timeout")
+        except asyncio.CancelledError:
+            # 已被分配名额但调用方在此期间断开：把名额交给下一个等待者
+            fut = entry[2]
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self._release()
+            raise
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+    
+    def _release(self):
+        self.in_flight -= 1
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+                break
+    
+    @asynccontextmanager
+    async def admit(self, priority: str):
+        """占用一个处理名额，yield 本次请求的降级级别"""
+        wait_start = time.time()
+        await self._acquire(priority)
+        ADMISSION_WAIT.observe(time.time() - wait_start, priority=priority)
+        level = self.degrade_level()
+        if level:
+            DEGRADED.inc(level=level)
+        start = time.time()
+        try:
+            yield level
+        finally:
+            self._service_time = 0.9 * self._service_time + 0.1 * (time.time() - start)
+            self._release()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "degrade_level": self.degrade_level(),
+            "avg_service_ms": round(self._service_time * 1000, 1),
+        }
+def _request_priority(header_value: Optional[str]) -> str:
+    """X-Request-Priority 请求头：interactive（默认）/ batch / eval"""
+    priority = (header_value or "interactive").strip().lower()
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority '{priority}', expected one of {list(PRIORITY_CLASSES)}")
+    return priority
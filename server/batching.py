@@ -0,0 +1,170 @@
+"""
+跨请求微批处理：并发请求的查询编码 / 向量检索在很短的时间窗内合并成一批执行
+"""
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from observability import Histogram, ObservedExecutor, _fields, logger, metrics_registry
+
+# ==================== 跨请求微批处理 ====================
+# 并发请求在一个很短的时间窗内（或凑满 max_batch_size）合并成一批处理，提高 GPU / CPU 利用率：
+# - 查询编码：按 Embedding 模型排队，一批查询一次 encode
+# - 向量检索：按城市索引版本排队，一批查询向量堆成矩阵一次 index.search，再按各自的 k 拆回
+# 每个目标同时只跑一批：上一批执行期间到达的请求自动攒成下一批，负载越高批越大，空闲时几乎不增加延迟。
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+BATCH_WAIT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+EMBED_BATCH_SIZE = metrics_registry.register(Histogram(
+    "rag_embedding_batch_size", "Queries encoded together per embedding batch", ("model",),
+    buckets=BATCH_SIZE_BUCKETS))
+EMBED_QUEUE_WAIT = metrics_registry.register(Histogram(
+    "rag_embedding_queue_wait_seconds", "Time a query waited for its embedding batch to start", ("model",),
+    buckets=BATCH_WAIT_BUCKETS))
+SEARCH_BATCH_SIZE = metrics_registry.register(Histogram(
+    "rag_search_batch_size", "Query vectors searched together per FAISS call", ("city",),
+    buckets=BATCH_SIZE_BUCKETS))
+SEARCH_QUEUE_WAIT = metrics_registry.register(Histogram(
+    "rag_search_queue_wait_seconds", "Time a query vector waited for its FAISS batch to start", ("city",),
+    buckets=BATCH_WAIT_BUCKETS))
+
+class _BatchQueue:
+    """单个目标（模型 / 索引）的待处理队列"""
+    
+    def __init__(self, target, label: str):
+        self.target = target
+        self.label = label
+        self.items: List[Tuple[Any, asyncio.Future, float]] = []  # (请求参数, future, 入队时间)
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.running = False
+
+class MicroBatcher(ABC):
+    """跨请求微批处理的公共部分；子类实现 _process(target, payloads) -> 与 payloads 一一对应的结果
+    
+    批次在专用线程池中执行（每个目标同一时间最多一个批次在执行，排队的批次数不超过目标数），
+    不占用事件循环默认 executor 的线程。
+    """
+    
+    def __init__(self, batch_size_metric: Histogram, queue_wait_metric: Histogram, label_name: str,
+                 max_batch_size: int = 32, max_wait_ms: float = 2.0, max_workers: int = 2):
+        self.batch_size_metric = batch_size_metric
+        self.queue_wait_metric = queue_wait_metric
+        self.label_name = label_name
+        self.configure(max_batch_size, max_wait_ms)
+        self._queues: Dict[int, _BatchQueue] = {}  # id(target) -> 队列
+        self._executor = ObservedExecutor(max_workers=max_workers, thread_name_prefix=type(self).__name__)
+        self.batches = 0
+        self.items = 0
+    
+    def configure(self, max_batch_size: int = 32, max_wait_ms: float = 2.0):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1
+    
+    @abstractmethod
+    def _process(self, target, payloads: List[Any]) -> List[Any]:
+        """在线程池中处理一个批次（阻塞）"""
+    
+    async def submit(self, target, payload, label: str = "default"):
+        """将请求加入该目标的队列，等待所在批次处理完成"""
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(id(target))
+        if queue is None:
+            queue = self._queues[id(target)] = _BatchQueue(target, label)
+        future = loop.create_future()
+        queue.items.append((payload, future, time.time()))
+        
+        if not queue.running:
+            if len(queue.items) >= self.max_batch_size or self.max_wait == 0:
+                self._flush(queue)
+            elif queue.timer is None:
+                queue.timer = loop.call_later(self.max_wait, self._flush, queue)
+        return await future
+    
+    def _flush(self, queue: _BatchQueue):
+        if queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+        # 已取消（客户端断开）的请求不再处理
+        queue.items = [item for item in queue.items if not item[1].done()]
+        if not queue.items:
+            self._queues.pop(id(queue.target), None)
+            return
+        batch, queue.items = queue.items[:self.max_batch_size], queue.items[self.max_batch_size:]
+        queue.running = True
+        asyncio.ensure_future(self._run(queue, batch))
+    
+    async def _run(self, queue: _BatchQueue, batch: List[Tuple[Any, asyncio.Future, float]]):
+        start = time.time()
+        labels = {self.label_name: queue.label}
+        for _, _, enqueued_at in batch:
+            self.queue_wait_metric.observe(start - enqueued_at, **labels)
+        self.batch_size_metric.observe(len(batch), **labels)
+        self.batches += 1
+        self.items += len(batch)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self._process, queue.target, [payload for payload, _, _ in batch])
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            queue.running = False
+            logger.debug(f"{type(self).__name__} batch done", extra=_fields(
+                size=len(batch), elapsed_ms=round((time.time() - start) * 1000, 1), **labels))
+            # 执行期间攒下的请求：已满一批立即执行，否则按时间窗等待
+            if len(queue.items) >= self.max_batch_size or (queue.items and self.max_wait == 0):
+                self._flush(queue)
+            elif queue.items:
+                queue.timer = loop.call_later(self.max_wait, self._flush, queue)
+            else:
+                self._queues.pop(id(queue.target), None)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "queued": sum(len(q.items) for q in self._queues.values()),
+        }
+
+class EmbeddingBatcher(MicroBatcher):
+    """查询编码合批：target 为 Embedding 模型，payload 为查询文本，结果为该查询的向量
+    
+    encode(queries, model) 执行一批编码（rag_server 中为 RAGModels.encode_queries）
+    """
+    
+    def __init__(self, encode: Callable[[List[str], Any], np.ndarray], max_batch_size: int = 32,
+                 max_wait_ms: float = 2.0):
+        # 同一模型的批次串行执行，两个线程够默认模型与一个注册表模型同时编码
+        super().__init__(EMBED_BATCH_SIZE, EMBED_QUEUE_WAIT, "model", max_batch_size, max_wait_ms, max_workers=2)
+        self._encode = encode
+    
+    def _process(self, model, queries: List[str]) -> np.ndarray:
+        return self._encode(queries, model)
+
+class SearchBatcher(MicroBatcher):
+    """向量检索合批：target 为城市索引版本（CityIndexHandle），payload 为 (查询向量, k)"""
+    
+    def __init__(self, max_batch_size: int = 64, max_wait_ms: float = 1.0, max_workers: int = 9):
+        # 每个城市（索引版本）同一时间一个批次，线程数与城市数相同即可让各城市并行
+        super().__init__(SEARCH_BATCH_SIZE, SEARCH_QUEUE_WAIT, "city", max_batch_size, max_wait_ms, max_workers)
+    
+    def _process(self, handle, payloads: List[Tuple[np.ndarray, int]]) -> List[List[Tuple[float, Dict[str, Any]]]]:
+        query_mat = np.vstack([vec for vec, _ in payloads]).astype('float32')
+        return handle.search_batch(query_mat, [k for _, k in payloads])
@@ -0,0 +1,111 @@
+"""
+CPU 推理基准测试 - 对比 PyTorch FP32 与 int8 / ONNX 后端的吞吐
+
+运行方式：
+    python benchmark_cpu_inference.py \
+        --embedding-model /path/to/embedding-model \
+        --reranker-model /path/to/reranker-model \
+        --backends torch,int8,onnx --threads 8
+
+输出每个后端的 Embedding 查询吞吐（queries/s）、Reranker 吞吐（pairs/s）
+以及相对 torch 后端的加速比，用于选择 --cpu-backend。
+"""
+
+import argparse
+import os
+import time
+from typing import Dict, List
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")  # 基准测试只测 CPU 路径
+
+# OpenMP 线程池在导入 numpy / torch 时创建：--threads 须在导入 rag_server 之前写入 OMP_NUM_THREADS
+_early_parser = argparse.ArgumentParser(add_help=False)
+_early_parser.add_argument("--threads", type=int, default=None)
+_early_threads = _early_parser.parse_known_args()[0].threads
+if _early_threads and _early_threads > 0:
+    os.environ["OMP_NUM_THREADS"] = str(_early_threads)
+
+import rag_server
+from rag_server import RAGModels, CPU_BACKENDS, WARMUP_QUERIES, configure_cpu_threads, configure_logging
+
+# 基准查询（与前端示例查询风格一致）
+BENCH_QUERIES = [
+    "外滩附近的餐厅", "五道口火锅店", "南山区电影院", "天河区生日蛋糕",
+    "春熙路咖啡店", "武昌站附近的酒店", "西湖边适合约会的餐厅", "观前街小吃",
+    "解放碑附近的火锅", "光谷附近的健身房", "三里屯酒吧", "陆家嘴商务午餐",
+]
+
+BENCH_DOCUMENT = "店名：示例商户 - 类型：餐饮/火锅 - 地址：示例路1号 - 城市：上海 - 区域：黄浦区 - 商圈：外滩"
+
+
+def bench_backend(backend: str, embedding_model: str, reranker_model: str, rounds: int) -> Dict[str, float]:
+    """加载指定后端的模型并测量吞吐"""
+    models = RAGModels()
+    models.load_embedding_model(embedding_model, backend=backend)
+    models.load_reranker_model(reranker_model, backend=backend)
+    models.warmup(WARMUP_QUERIES)
+
+    result = {"embedding_backend": models.embedding_backend, "reranker_backend": models.reranker_backend}
+
+    if models.embedding_model is not None:
+        start = time.time()
+        for _ in range(rounds):
+            for query in BENCH_QUERIES:
+                models.encode_query(query)
+        elapsed = time.time() - start
+        result["embedding_qps"] = rounds * len(BENCH_QUERIES) / elapsed
+        result["embedding_ms"] = elapsed * 1000 / (rounds * len(BENCH_QUERIES))
+
+    if models.reranker_model is not None:
+        # 与 perform_rag_search 一致：每个查询 rerank top_k × 5 个候选，batch_size=1
+        pairs = [[query, BENCH_DOCUMENT] for query in BENCH_QUERIES for _ in range(25)]
+        start = time.time()
+        for _ in range(rounds):
+            models.reranker_model.predict(pairs, batch_size=1)
+        elapsed = time.time() - start
+        result["rerank_pairs_per_s"] = rounds * len(pairs) / elapsed
+
+    return result
+
+
+def print_report(results: Dict[str, Dict[str, float]]):
+    baseline = results.get("torch", {})
+    print("\n" + "=" * 78)
+    print(f"{'backend':10s} {'embed q/s':>12s} {'embed ms':>10s} {'speedup':>8s} {'rerank p/s':>12s} {'speedup':>8s}")
+    print("-" * 78)
+    for backend, r in results.items():
+        embed_speedup = r.get("embedding_qps", 0) / baseline["embedding_qps"] if baseline.get("embedding_qps") else 0
+        rerank_speedup = r.get("rerank_pairs_per_s", 0) / baseline["rerank_pairs_per_s"] if baseline.get("rerank_pairs_per_s") else 0
+        print(f"{backend:10s} {r.get('embedding_qps', 0):12.1f} {r.get('embedding_ms', 0):10.1f} "
+              f"{embed_speedup:7.2f}x {r.get('rerank_pairs_per_s', 0):12.1f} {rerank_speedup:7.2f}x")
+    print("=" * 78)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CPU inference backends for the RAG server")
+    parser.add_argument("--embedding-model", type=str, default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--reranker-model", type=str, default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    parser.add_argument("--backends", type=str, default=",".join(CPU_BACKENDS), help="Comma-separated backends to compare")
+    parser.add_argument("--threads", type=int, default=None, help="Fixed CPU thread count")
+    parser.add_argument("--rounds", type=int, default=3, help="Benchmark rounds per backend")
+    args = parser.parse_args()
+
+    configure_logging(level="info", fmt="text")
+    if rag_server.DEVICE != "cpu":
+        print("⚠️  CUDA is visible; results will not reflect the CPU path")
+    configure_cpu_threads(args.threads)
+
+    backends: List[str] = [b.strip() for b in args.backends.split(",") if b.strip()]
+    results = {}
+    for backend in backends:
+        if backend not in CPU_BACKENDS:
+            print(f"⚠️  Unknown backend: {backend}")
+            continue
+        print(f"\n🏁 Benchmarking backend: {backend}")
+        results[backend] = bench_backend(backend, args.embedding_model, args.reranker_model, args.rounds)
+
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
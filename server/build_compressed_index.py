@@ -0,0 +1,239 @@
+"""
+向量降维 + 标量/乘积量化 离线工具
+
+对每个城市的 FAISS 索引拟合降维（PCA 或 Matryoshka 截断）和编码（SQ8 / PQ），
+用抽样查询对比全精度 Flat 检索的召回率，输出 recall-vs-size 报告；
+选定配置后可生成新的版本目录，通过 /admin/indexes/reload 热切换上线。
+
+查询侧投影：
+    降维矩阵以 IndexPreTransform 的形式写入 .faiss 文件，检索时 FAISS 自动对查询向量做同样的投影。
+    encode_query 仍只编码一次全维向量，多城市检索时每个城市按各自的 PCA 基投影。
+
+运行方式：
+    # 1. 扫描配置，输出报告
+    python build_compressed_index.py --data-dir /path/to/data --cities shanghai,beijing \
+        --reductions none,pca,matryoshka --dims 256,512,1024 --encodings flat,sq8,pq \
+        --report compression_report.json
+
+    # 2. 生成选定配置的新版本（写入 versions/{target-version}/）
+    python build_compressed_index.py --data-dir /path/to/data --cities all \
+        --emit pca:512:sq8 --target-version 1028-pca512sq8
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import faiss
+
+ALL_CITIES = ["shanghai", "beijing", "guangzhou", "shenzhen", "hangzhou", "suzhou", "chengdu", "chongqing", "wuhan"]
+
+
+def index_paths(data_dir: str, city_en: str, version: str) -> Tuple[str, str]:
+    """与 rag_server.CityVectorDB.index_paths 相同的文件布局"""
+    filename = f"faiss_merchant_index_vllm_{city_en}_{version}"
+    version_dir = os.path.join(data_dir, "versions", version)
+    base_dir = version_dir if os.path.isdir(version_dir) else data_dir
+    return (
+        os.path.join(base_dir, f"{filename}.faiss"),
+        os.path.join(base_dir, f"{filename}_metadata.json"),
+    )
+
+
+def load_vectors(index_path: str) -> Tuple[np.ndarray, int]:
+    """从已有索引中还原全部向量，返回 (vectors, metric_type)"""
+    index = faiss.read_index(index_path)
+    if hasattr(index, "make_direct_map"):
+        index.make_direct_map()
+    vectors = index.reconstruct_n(0, index.ntotal).astype("float32")
+    return vectors, index.metric_type
+
+
+def is_normalized(vectors: np.ndarray, sample: int = 1000) -> bool:
+    norms = np.linalg.norm(vectors[:sample], axis=1)
+    return bool(np.allclose(norms, 1.0, atol=1e-3))
+
+
+def build_index(vectors: np.ndarray, metric: int, reduction: str, dim: int, encoding: str,
+                pq_m: Optional[int], train_size: int, normalized: bool):
+    """构建 降维 + 编码 索引；降维部分作为 IndexPreTransform 存在索引里"""
+    d_in = vectors.shape[1]
+    out_dim = d_in if reduction == "none" else dim
+
+    if encoding == "flat":
+        spec = "Flat"
+    elif encoding == "sq8":
+        spec = "SQ8"
+    elif encoding == "pq":
+        m = pq_m or max(1, out_dim // 8)
+        if out_dim % m != 0:
+            raise ValueError(f"PQ m={m} must divide dim={out_dim}")
+        spec = f"PQ{m}"
+    else:
+        raise ValueError(f"Unknown encoding: {encoding}")
+
+    inner = faiss.index_factory(out_dim, spec, metric)
+    if reduction == "none":
+        index = inner
+    else:
+        index = faiss.IndexPreTransform(inner)
+        if reduction == "pca":
+            index.prepend_transform(faiss.PCAMatrix(d_in, out_dim))
+        elif reduction == "matryoshka":
+            # Matryoshka 截断：取前 out_dim 维；原向量归一化时截断后重新归一化
+            if normalized:
+                index.prepend_transform(faiss.NormalizationTransform(out_dim, 2.0))
+            truncate = faiss.LinearTransform(d_in, out_dim, False)
+            A = np.zeros((out_dim, d_in), dtype="float32")
+            A[np.arange(out_dim), np.arange(out_dim)] = 1.0
+            faiss.copy_array_to_vector(A.ravel(), truncate.A)
+            truncate.is_trained = True
+            index.prepend_transform(truncate)
+        else:
+            raise ValueError(f"Unknown reduction: {reduction}")
+
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        train_rows = rng.choice(len(vectors), size=min(train_size, len(vectors)), replace=False)
+        index.train(vectors[train_rows])
+    index.add(vectors)
+    return index
+
+
+def recall_at_k(approx: np.ndarray, exact: np.ndarray, k: int) -> float:
+    hits = [len(set(a[:k]) & set(e[:k])) / k for a, e in zip(approx, exact)]
+    return float(np.mean(hits))
+
+
+def drop_self(ids: np.ndarray, query_rows: np.ndarray, k: int) -> np.ndarray:
+    """以库内向量作为查询时，去掉查询自身，保留前 k 个"""
+    out = np.full((len(ids), k), -1, dtype="int64")
+    for i, (row, qid) in enumerate(zip(ids, query_rows)):
+        kept = [x for x in row if x != qid][:k]
+        out[i, :len(kept)] = kept
+    return out
+
+
+def evaluate_city(vectors: np.ndarray, metric: int, configs: List[Tuple[str, int, str]], args) -> List[Dict]:
+    """对一个城市评估所有配置，返回报告行"""
+    rng = np.random.default_rng(42)
+    query_rows = rng.choice(len(vectors), size=min(args.num_queries, len(vectors)), replace=False)
+    queries = vectors[query_rows]
+    k = args.k
+    normalized = is_normalized(vectors)
+
+    exact = faiss.IndexFlat(vectors.shape[1], metric)
+    exact.add(vectors)
+    _, gt = exact.search(queries, k + 1)
+    gt = drop_self(gt, query_rows, k)
+    full_bytes = faiss.serialize_index(exact).nbytes
+
+    rows = []
+    for reduction, dim, encoding in configs:
+        try:
+            start = time.time()
+            index = build_index(vectors, metric, reduction, dim, encoding, args.pq_m, args.train_size, normalized)
+            build_s = time.time() - start
+        except Exception as e:
+            print(f"  ⚠️  {reduction}:{dim}:{encoding} skipped: {e}")
+            continue
+
+        start = time.time()
+        _, ids = index.search(queries, k + 1)
+        search_ms = (time.time() - start) * 1000 / len(queries)
+        ids = drop_self(ids, query_rows, k)
+
+        size_bytes = faiss.serialize_index(index).nbytes
+        row = {
+            "config": f"{reduction}:{dim if reduction != 'none' else vectors.shape[1]}:{encoding}",
+            "size_mb": size_bytes / 1024 / 1024,
+            "bytes_per_vector": size_bytes / len(vectors),
+            "compression": full_bytes / size_bytes,
+            "recall@1": recall_at_k(ids, gt, 1),
+            f"recall@{k}": recall_at_k(ids, gt, k),
+            "search_ms_per_query": search_ms,
+            "build_s": build_s,
+        }
+        rows.append(row)
+        print(f"  {row['config']:24s} {row['size_mb']:9.1f} MB  x{row['compression']:5.1f}  "
+              f"recall@1={row['recall@1']:.3f}  recall@{k}={row[f'recall@{k}']:.3f}  {search_ms:.2f} ms/q")
+    return rows
+
+
+def parse_configs(args) -> List[Tuple[str, int, str]]:
+    reductions = [r.strip() for r in args.reductions.split(",") if r.strip()]
+    dims = [int(d) for d in args.dims.split(",") if d.strip()]
+    encodings = [e.strip() for e in args.encodings.split(",") if e.strip()]
+    configs = []
+    for reduction in reductions:
+        for dim in ([0] if reduction == "none" else dims):
+            for encoding in encodings:
+                configs.append((reduction, dim, encoding))
+    return configs
+
+
+def emit_version(data_dir: str, city_en: str, source_version: str, target_version: str,
+                 vectors: np.ndarray, metric: int, spec: str, args):
+    """按选定配置生成新版本目录"""
+    reduction, dim, encoding = spec.split(":")
+    index = build_index(vectors, metric, reduction, int(dim), encoding, args.pq_m, args.train_size,
+                        is_normalized(vectors))
+    out_dir = os.path.join(data_dir, "versions", target_version)
+    os.makedirs(out_dir, exist_ok=True)
+    filename = f"faiss_merchant_index_vllm_{city_en}_{target_version}"
+    faiss.write_index(index, os.path.join(out_dir, f"{filename}.faiss"))
+    _, src_meta = index_paths(data_dir, city_en, source_version)
+    shutil.copyfile(src_meta, os.path.join(out_dir, f"{filename}_metadata.json"))
+    print(f"  💾 {city_en}: wrote {spec} → versions/{target_version}/")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit dimensionality reduction + SQ8/PQ encodings per city and report recall vs size")
+    parser.add_argument("--data-dir", type=str, required=True, help="Vector database directory")
+    parser.add_argument("--cities", type=str, default="all", help="Comma-separated English city names, or 'all'")
+    parser.add_argument("--source-version", type=str, default="1028", help="Index version to compress")
+    parser.add_argument("--reductions", type=str, default="none,pca,matryoshka", help="none / pca / matryoshka")
+    parser.add_argument("--dims", type=str, default="256,512,1024", help="Target dimensions for pca / matryoshka")
+    parser.add_argument("--encodings", type=str, default="flat,sq8,pq", help="flat / sq8 / pq")
+    parser.add_argument("--pq-m", type=int, default=None, help="PQ sub-quantizers (default: dim / 8)")
+    parser.add_argument("--train-size", type=int, default=50000, help="Vectors used to train PCA / quantizers")
+    parser.add_argument("--num-queries", type=int, default=1000, help="Sampled in-corpus queries for recall evaluation")
+    parser.add_argument("--k", type=int, default=10, help="Recall cutoff")
+    parser.add_argument("--report", type=str, default="compression_report.json", help="Output report path")
+    parser.add_argument("--emit", type=str, default=None, help="Write a new version with this config, e.g. pca:512:sq8")
+    parser.add_argument("--target-version", type=str, default=None, help="Version name for --emit")
+    args = parser.parse_args()
+
+    cities = ALL_CITIES if args.cities == "all" else [c.strip() for c in args.cities.split(",") if c.strip()]
+    if args.emit and not args.target_version:
+        parser.error("--emit requires --target-version")
+
+    report = {"source_version": args.source_version, "k": args.k, "cities": {}}
+    configs = parse_configs(args)
+
+    for city_en in cities:
+        index_path, _ = index_paths(args.data_dir, city_en, args.source_version)
+        if not os.path.exists(index_path):
+            print(f"⚠️  {city_en}: {index_path} not found")
+            continue
+
+        vectors, metric = load_vectors(index_path)
+        print(f"\n📦 {city_en}: {len(vectors)} vectors × {vectors.shape[1]} dims")
+
+        if args.emit:
+            emit_version(args.data_dir, city_en, args.source_version, args.target_version, vectors, metric, args.emit, args)
+        else:
+            report["cities"][city_en] = evaluate_city(vectors, metric, configs, args)
+
+    if not args.emit:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📝 Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+地图几何预处理 - 为 china*.json 生成多级简化、量化的 TopoJSON
+
+原始 GeoJSON（160–580 KB）坐标为全精度浮点数，相邻省份的公共边界各存一份，前端首屏整份加载。
+本工具离线生成几个细节级别（low / medium / high）：
+
+1. 拓扑：按交点（多个环共用、且相邻点不同的点）把每个环切成弧段，相邻省份的公共边界只存一条弧，
+   几何对象按弧索引引用（反向引用为 ~index），与 TopoJSON 规范一致
+2. 简化：每条弧单独做 Douglas-Peucker 简化，交点作为端点保留 —— 公共边界只简化一次，
+   简化后相邻省份之间不会出现缝隙或重叠；小于约一个像素的孤立岛屿在低级别中去掉
+3. 量化：坐标映射到整数网格（transform.scale / translate），弧内坐标做差分编码
+
+前端用 topojson-client 的 topojson.feature() 还原为 GeoJSON 后交给 echarts.registerMap；
+proxy_server.py 的 /geo 端点按请求的渲染宽度返回合适的级别（带 ETag 与长缓存头）。
+
+运行方式：
+    # 处理仓库根目录的 china.json / china_full.json / china_provinces.json，输出到 static/geo/
+    python build_map_geometry.py
+
+    # 只生成部分文件 / 级别，保留更多属性
+    python build_map_geometry.py --inputs ../china_provinces.json --levels low,medium --keep-properties name,adcode,center
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_INPUTS = ["china.json", "china_full.json", "china_provinces.json"]
+DEFAULT_OUTPUT_DIR = os.path.join(REPO_ROOT, "static", "geo")
+
+# 细节级别：tolerance 为 Douglas-Peucker 容差（度），约为 max_width_px 宽度下渲染全国地图时半个像素；
+# quantization 为每个方向的量化网格数，量化误差小于容差的一半
+LEVELS = {
+    "low": {"tolerance": 0.04, "quantization": 10000, "max_width_px": 1000},
+    "medium": {"tolerance": 0.01, "quantization": 100000, "max_width_px": 4000},
+    "high": {"tolerance": 0.0025, "quantization": 100000, "max_width_px": 16000},
+}
+
+Point = Tuple[float, float]
+
+
+def iter_polygons(geometry: Optional[Dict[str, Any]]) -> List[List[List[Point]]]:
+    """Polygon / MultiPolygon -> [多边形[环[点]]]，去掉环末尾与起点重复的闭合点"""
+    if not geometry:
+        return []
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        raise ValueError(f"Unsupported geometry type: {geometry['type']}")
+
+    result = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            points = [(float(p[0]), float(p[1])) for p in ring]
+            if len(points) > 1 and points[0] == points[-1]:
+                points.pop()
+            if len(points) >= 3:
+                rings.append(points)
+        if rings:
+            result.append(rings)
+    return result
+
+
+def find_junctions(rings: List[List[Point]]) -> set:
+    """交点：相邻点超过两个（边界在此分叉），或共用该点的环集合与前后点不同（公共边界在此开始 / 结束）"""
+    owners: Dict[Point, set] = defaultdict(set)
+    neighbors: Dict[Point, set] = defaultdict(set)
+    for ring_id, ring in enumerate(rings):
+        n = len(ring)
+        for i, point in enumerate(ring):
+            owners[point].add(ring_id)
+            neighbors[point].add(ring[i - 1])
+            neighbors[point].add(ring[(i + 1) % n])
+
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            if len(neighbors[point]) > 2:
+                junctions.add(point)
+            elif len(owners[point]) > 1 and (owners[point] != owners[ring[i - 1]] or owners[point] != owners[ring[(i + 1) % n]]):
+                junctions.add(point)
+    return junctions
+
+
+def cut_ring(ring: List[Point], junctions: set) -> List[List[Point]]:
+    """在交点处把环切成首尾相接的弧；没有交点的环（岛屿）整体作为一条闭合弧"""
+    cuts = [i for i, point in enumerate(ring) if point in junctions]
+    if not cuts:
+        # 旋转到最小点开头：同一个环无论从哪里开始、哪个方向存储，都得到相同（或互为反向）的弧
+        start = min(range(len(ring)), key=lambda i: ring[i])
+        rotated = ring[start:] + ring[:start]
+        return [rotated + [rotated[0]]]
+    rotated = ring[cuts[0]:] + ring[:cuts[0]]
+    closed = rotated + [rotated[0]]
+    offsets = [i - cuts[0] for i in cuts] + [len(ring)]
+    return [closed[a:b + 1] for a, b in zip(offsets, offsets[1:])]
+
+
+class ArcTable:
+    """去重后的弧；add 返回弧索引，与已有弧方向相反时返回 ~index"""
+
+    def __init__(self):
+        self.arcs: List[List[Point]] = []
+        self._index: Dict[Tuple[Point, ...], int] = {}
+
+    def add(self, arc: List[Point]) -> int:
+        key = tuple(arc)
+        if key in self._index:
+            return self._index[key]
+        if key[::-1] in self._index:
+            return ~self._index[key[::-1]]
+        self._index[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return len(self.arcs) - 1
+
+
+def douglas_peucker(points: List[Point], tolerance: float) -> List[Point]:
+    """保留首尾点的 Douglas-Peucker 简化（首尾重合的闭合弧按到端点的距离计算）"""
+    if len(points) <= 2:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+    pending = [(0, len(points) - 1)]
+    while pending:
+        a, b = pending.pop()
+        if b - a < 2:
+            continue
+        ax, ay = points[a]
+        dx, dy = points[b][0] - ax, points[b][1] - ay
+        seg_sq = dx * dx + dy * dy
+        best, best_sq = -1, tolerance_sq
+        for i in range(a + 1, b):
+            px, py = points[i][0] - ax, points[i][1] - ay
+            t = max(0.0, min(1.0, (px * dx + py * dy) / seg_sq)) if seg_sq > 0 else 0.0
+            dist_sq = (px - t * dx) ** 2 + (py - t * dy) ** 2
+            if dist_sq > best_sq:
+                best, best_sq = i, dist_sq
+        if best >= 0:
+            keep[best] = True
+            pending.append((a, best))
+            pending.append((best, b))
+    simplified = [point for point, kept in zip(points, keep) if kept]
+    if simplified[0] == simplified[-1] and len(simplified) < 4:
+        # 闭合弧至少保留 3 个不同的点，否则环退化为线段
+        step = (len(points) - 1) / 3
+        simplified = [points[0], points[round(step)], points[round(2 * step)], points[-1]]
+    return simplified
+
+
+def _extent(points: List[Point]) -> float:
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return max(max(xs) - min(xs), max(ys) - min(ys))
+
+
+def build_topology(geojson: Dict[str, Any]) -> Tuple[ArcTable, List[List[List[List[int]]]]]:
+    """返回 (弧表, 每个要素的 [多边形[环[弧引用]]])"""
+    features = geojson.get("features", [])
+    feature_polygons = [iter_polygons(feature.get("geometry")) for feature in features]
+    all_rings = [ring for polygons in feature_polygons for polygon in polygons for ring in polygon]
+    junctions = find_junctions(all_rings)
+
+    arcs = ArcTable()
+    topology = [
+        [[[arcs.add(arc) for arc in cut_ring(ring, junctions)] for ring in polygon] for polygon in polygons]
+        for polygons in feature_polygons
+    ]
+    return arcs, topology
+
+
+def encode_level(name: str, geojson: Dict[str, Any], arcs: ArcTable, topology, level: Dict[str, Any],
+                 keep_properties: Optional[List[str]]) -> Tuple[Dict[str, Any], int]:
+    """生成一个细节级别的 TopoJSON，返回 (topology, 保留的点数)"""
+    tolerance = level["tolerance"]
+    simplified = [douglas_peucker(arc, tolerance) for arc in arcs.arcs]
+
+    # 量化（所有弧共用一个 transform），去掉量化后重合的相邻点
+    points = [point for arc in simplified for point in arc]
+    if points:
+        x0, y0 = min(p[0] for p in points), min(p[1] for p in points)
+        x1, y1 = max(p[0] for p in points), max(p[1] for p in points)
+    else:
+        x0 = y0 = x1 = y1 = 0.0
+    q = level["quantization"]
+    kx = (x1 - x0) / (q - 1) if x1 > x0 else 1.0
+    ky = (y1 - y0) / (q - 1) if y1 > y0 else 1.0
+    quantized_arcs = []
+    for arc in simplified:
+        quantized = []
+        for x, y in arc:
+            qp = (round((x - x0) / kx), round((y - y0) / ky))
+            if not quantized or qp != quantized[-1]:
+                quantized.append(qp)
+        if len(quantized) == 1:
+            quantized.append(quantized[0])
+        quantized_arcs.append(quantized)
+
+    def _arc(ref: int) -> int:
+        return ref if ref >= 0 else ~ref
+
+    def _droppable(ring_refs: List[int]) -> bool:
+        # 只由一条闭合弧组成（不与其他环相接）且小于约一个像素的岛屿 / 孔洞
+        if len(ring_refs) == 1 and _extent(arcs.arcs[_arc(ring_refs[0])]) < 2 * tolerance:
+            return True
+        # 简化、量化后不足 3 个不同点的环（两个交点之间的细长碎片）已退化为线段
+        return len({point for ref in ring_refs for point in quantized_arcs[_arc(ref)]}) < 3
+
+    # 要素只剩可去掉的环时保留最大的一个多边形
+    level_topology = []
+    for polygons in topology:
+        kept = [[polygon[0]] + [hole for hole in polygon[1:] if not _droppable(hole)]
+                for polygon in polygons if not _droppable(polygon[0])]
+        if not kept and polygons:
+            largest = max(polygons, key=lambda polygon: _extent([p for ref in polygon[0] for p in arcs.arcs[_arc(ref)]]))
+            kept = [[largest[0]]]
+        level_topology.append(kept)
+
+    # 只输出被引用的弧，重新编号；差分编码：首点为绝对坐标，其余为与前一点的差
+    used = sorted({_arc(ref) for polygons in level_topology for polygon in polygons for ring in polygon for ref in ring})
+    renumber = {old: new for new, old in enumerate(used)}
+    encoded_arcs = []
+    total_points = 0
+    for i in used:
+        quantized = quantized_arcs[i]
+        total_points += len(quantized)
+        encoded_arcs.append([list(quantized[0])] + [[x - px, y - py] for (px, py), (x, y) in zip(quantized, quantized[1:])])
+
+    geometries = []
+    for feature, polygons in zip(geojson.get("features", []), level_topology):
+        properties = feature.get("properties") or {}
+        if keep_properties is not None:
+            properties = {key: properties[key] for key in keep_properties if key in properties}
+        refs = [[[renumber[ref] if ref >= 0 else ~renumber[~ref] for ref in ring] for ring in polygon] for polygon in polygons]
+        if not refs:
+            geometries.append({"type": None, "properties": properties})
+        elif len(refs) == 1:
+            geometries.append({"type": "Polygon", "arcs": refs[0], "properties": properties})
+        else:
+            geometries.append({"type": "MultiPolygon", "arcs": refs, "properties": properties})
+
+    return {
+        "type": "Topology",
+        "bbox": [x0, y0, x1, y1],
+        "transform": {"scale": [kx, ky], "translate": [x0, y0]},
+        "objects": {name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": encoded_arcs,
+    }, total_points
+
+
+def process_file(path: str, output_dir: str, levels: List[str], keep_properties: Optional[List[str]]) -> Dict[str, Any]:
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, "r", encoding="utf-8") as f:
+        geojson = json.load(f)
+
+    start = time.time()
+    arcs, topology = build_topology(geojson)
+    source_points = sum(len(arc) for arc in arcs.arcs)
+    print(f"\n🗺️  {name}: {len(geojson.get('features', []))} features, {len(arcs.arcs)} arcs, "
+          f"{source_points} points after topology ({time.time() - start:.1f}s)")
+
+    entry = {"source": os.path.basename(path), "source_bytes": os.path.getsize(path), "levels": {}}
+    for level_name in levels:
+        level = LEVELS[level_name]
+        topo, points = encode_level(name, geojson, arcs, topology, level, keep_properties)
+        body = json.dumps(topo, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        filename = f"{name}.{level_name}.topo.json"
+        with open(os.path.join(output_dir, filename), "wb") as f:
+            f.write(body)
+        entry["levels"][level_name] = {
+            "file": filename,
+            "bytes": len(body),
+            "gzip_bytes": len(gzip.compress(body, compresslevel=9, mtime=0)),
+            "sha256": hashlib.sha256(body).hexdigest()[:16],
+            "points": points,
+            **level,
+        }
+        print(f"  {level_name:7s} {points:7d} points  {len(body) / 1024:7.1f} KB  "
+              f"(gzip {entry['levels'][level_name]['gzip_bytes'] / 1024:.1f} KB, "
+              f"x{entry['source_bytes'] / len(body):.1f} smaller than source)")
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build simplified, quantized multi-resolution TopoJSON from the China GeoJSON files")
+    parser.add_argument("--inputs", type=str, default=",".join(os.path.join(REPO_ROOT, f) for f in DEFAULT_INPUTS),
+                        help="Comma-separated GeoJSON files")
+    parser.add_argument("--output-dir", type=str, default=DEFAULT_OUTPUT_DIR, help="Where .topo.json files and manifest.json are written")
+    parser.add_argument("--levels", type=str, default=",".join(LEVELS), help="Comma-separated levels: " + " / ".join(LEVELS))
+    parser.add_argument("--keep-properties", type=str, default="name,adcode,center",
+                        help="Comma-separated feature properties to keep ('all' keeps everything)")
+    args = parser.parse_args()
+
+    levels = [level.strip() for level in args.levels.split(",") if level.strip()]
+    unknown = [level for level in levels if level not in LEVELS]
+    if unknown:
+        parser.error(f"Unknown levels: {unknown}")
+    keep_properties = None if args.keep_properties == "all" else [p.strip() for p in args.keep_properties.split(",") if p.strip()]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    manifest_path = os.path.join(args.output_dir, "manifest.json")
+    manifest = {"levels": LEVELS, "files": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest["files"] = json.load(f).get("files", {})
+
+    for path in [p.strip() for p in args.inputs.split(",") if p.strip()]:
+        if not os.path.exists(path):
+            print(f"⚠️  {path} not found")
+            continue
+        name = os.path.splitext(os.path.basename(path))[0]
+        manifest["files"][name] = process_file(path, args.output_dir, levels, keep_properties)
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"\n📝 Manifest written to {manifest_path}")
+
+
+if __name__ == "__main__":
+    main()
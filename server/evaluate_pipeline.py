@@ -0,0 +1,358 @@
+"""
+检索质量与延迟离线评测 - LocalSearchBench
+
+对带标注的查询集（query, city, 相关商户 ID）在进程内调用 perform_rag_search，
+扫描 retriever / reranker / candidate_multiplier / LLM 精排开关的组合，
+在一张表中输出 recall@k、nDCG@k、MRR 以及各阶段延迟（p50 / p95）。
+
+每个配置的逐条结果缓存在 --cache-dir/{config_id}.jsonl（config_id 由配置、数据目录、各城市索引版本和查询集内容决定），
+中断后重新运行会跳过已完成的查询；配置不变时直接复用缓存出报告。
+
+查询集格式（JSONL 或 JSON 数组）：
+    {"id": "q1", "query": "外滩附近的餐厅", "city": "上海", "relevant_ids": ["123", "456"]}
+
+模型写法：name=path[@index_version]，逗号分隔；reranker 可写 none 表示不重排。
+@index_version 用于与该 Embedding 模型配套构建的索引版本（评测期间切换，不改写 manifest）；
+不带 @index_version 的模型使用启动时加载的版本（--index-version 或 manifest）。
+
+运行方式：
+    python evaluate_pipeline.py --data-dir /path/to/data --queries eval/queries.jsonl \
+        --retrievers qwen3-8b=/models/Qwen3-Embedding-8B \
+        --rerankers qwen3-8b=/models/Qwen3-Reranker-8B,none \
+        --multipliers 3,5,10 --llm-ranking off,on --config config.yaml \
+        --k 1,5,10 --concurrency 8 --report eval_report.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import rag_server
+from rag_server import RAGModels, CPU_BACKENDS, MERCHANT_ID_FIELDS, configure_logging
+
+# 结果 metrics 中记录的各阶段耗时
+STAGES = [
+    ("embedding_time_ms", "embed"),
+    ("retrieval_time_ms", "faiss"),
+    ("rerank_time_ms", "rerank"),
+    ("llm_ranking_time_ms", "llm"),
+    ("latency_ms", "total"),
+]
+
+ModelSpec = Tuple[str, Optional[str], Optional[str]]  # (name, path, index_version)
+
+
+def parse_model_specs(value: str) -> List[ModelSpec]:
+    """'name=path@version,none' -> [(name, path, version), ("none", None, None)]"""
+    specs = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if item.lower() == "none":
+            specs.append(("none", None, None))
+            continue
+        name, path = item.split("=", 1) if "=" in item else ("", item)
+        path, _, version = path.partition("@")
+        specs.append((name or os.path.basename(path.rstrip("/")), path, version or None))
+    return specs
+
+
+def load_queries(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        rows = json.loads(text)
+    else:
+        rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    queries = []
+    for i, row in enumerate(rows[:limit] if limit else rows):
+        relevant = row.get("relevant_ids") or row.get("relevant_merchant_ids") or row.get("relevant") or []
+        queries.append({
+            "id": str(row.get("id", i)),
+            "query": row["query"],
+            "city": row.get("city", "上海"),
+            "relevant_ids": [str(x) for x in relevant],
+        })
+    return queries
+
+
+def doc_id(doc: Dict[str, Any]) -> Optional[str]:
+    for field in MERCHANT_ID_FIELDS:
+        if doc.get(field) is not None:
+            return str(doc[field])
+    return None
+
+
+def recall_at_k(ranked: List[str], relevant: set, k: int) -> float:
+    return len(set(ranked[:k]) & relevant) / len(relevant)
+
+
+def ndcg_at_k(ranked: List[str], relevant: set, k: int) -> float:
+    dcg = sum(1.0 / math.log2(i + 2) for i, d in enumerate(ranked[:k]) if d in relevant)
+    ideal = sum(1.0 / math.log2(i + 2) for i in range(min(k, len(relevant))))
+    return dcg / ideal
+
+
+def reciprocal_rank(ranked: List[str], relevant: set) -> float:
+    for i, d in enumerate(ranked):
+        if d in relevant:
+            return 1.0 / (i + 1)
+    return 0.0
+
+
+def retriever_index_versions(retriever: ModelSpec, default_versions: Dict[str, str]) -> Dict[str, str]:
+    """retriever 使用的各城市索引版本：指定了 @index_version 时所有城市用它，否则用启动时加载的版本"""
+    return {city: retriever[2] or version for city, version in default_versions.items()}
+
+
+def config_id(config: Dict[str, Any], queries_digest: str) -> str:
+    payload = json.dumps({**config, "queries": queries_digest}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+class ResultCache:
+    """每个配置一个 JSONL 文件：首行为配置，之后每条查询一行，逐条追加"""
+
+    def __init__(self, cache_dir: str, cid: str, config: Dict[str, Any]):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f"{cid}.jsonl")
+        self.results: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 中断时写了一半的行
+                    if "query_id" in row:
+                        self.results[row["query_id"]] = row
+        else:
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"config": config}, ensure_ascii=False) + "\n")
+
+    def pending(self, queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """尚未完成的查询（出错的查询续跑时重试）"""
+        return [q for q in queries if "ranked_ids" not in self.results.get(q["id"], {})]
+
+    def add(self, row: Dict[str, Any]):
+        self.results[row["query_id"]] = row
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def prepare_models(models: RAGModels, loaded: Dict[str, Optional[str]], retriever: ModelSpec, reranker: ModelSpec,
+                   index_versions: Dict[str, str], backend: str):
+    """切换到一组 retriever / reranker（向量库与 LLM 精排器复用）；loaded 记录当前已加载的模型路径
+
+    index_versions 为该 retriever 要使用的各城市索引版本（见 retriever_index_versions）。
+    """
+    _, path, _ = retriever
+    if loaded.get("retriever") != path:
+        models.embedding_model = None
+        models.load_embedding_model(path, backend=backend)
+        loaded["retriever"] = path
+
+    _, path, _ = reranker
+    if path is None:
+        models.reranker_model = None
+    elif loaded.get("reranker") != path:
+        models.reranker_model = None
+        models.load_reranker_model(path, backend=backend)
+    loaded["reranker"] = path
+
+    if models.vector_db:
+        # 上一个 retriever 切换过的城市也要切回来
+        for city, version in index_versions.items():
+            if version and models.vector_db.versions.get(city) != version:
+                models.vector_db.swap_city(city, version, write_manifest=False)
+
+    if rag_server.DEVICE == "cuda":
+        rag_server.torch.cuda.empty_cache()
+
+
+async def run_config(config: Dict[str, Any], queries: List[Dict[str, Any]], cache: ResultCache,
+                     concurrency: int, batch_size: int):
+    """并发执行未缓存的查询；每批结束后打印进度"""
+    pending = cache.pending(queries)
+    if not pending:
+        print(f"   ♻️  all {len(queries)} queries cached")
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(q: Dict[str, Any]):
+        async with semaphore:
+            try:
+                result = await rag_server.perform_rag_search(
+                    query=q["query"],
+                    city=q["city"],
+                    top_k=config["top_k"],
+                    retriever=config["retriever"],
+                    reranker=config["reranker"],
+                    use_llm_ranking=config["llm_ranking"],
+                    use_reranker=config["reranker"] != "none",
+                    candidate_multiplier=config["candidate_multiplier"],
+                )
+                row = {
+                    "query_id": q["id"],
+                    "ranked_ids": [doc_id(doc) for doc in result["sources"]],
+                    "timings": {stage: result["metrics"].get(stage, 0.0) for stage, _ in STAGES},
+                }
+            except Exception as e:
+                row = {"query_id": q["id"], "error": str(getattr(e, "detail", e))[:200]}
+            cache.add(row)
+
+    start = time.time()
+    for i in range(0, len(pending), batch_size):
+        await asyncio.gather(*(_one(q) for q in pending[i:i + batch_size]))
+        done = min(i + batch_size, len(pending))
+        print(f"   {done}/{len(pending)} queries ({done / (time.time() - start):.1f} q/s)")
+
+
+def summarize(cid: str, config: Dict[str, Any], queries: List[Dict[str, Any]], cache: ResultCache,
+              ks: List[int]) -> Dict[str, Any]:
+    rows = [cache.results[q["id"]] for q in queries if q["id"] in cache.results]
+    ok = [row for row in rows if "error" not in row]
+    relevant = {q["id"]: set(q["relevant_ids"]) for q in queries}
+    judged = [row for row in ok if relevant[row["query_id"]]]
+
+    summary = {"config_id": cid, **config, "queries": len(rows), "errors": len(rows) - len(ok), "judged": len(judged)}
+    for k in ks:
+        summary[f"recall@{k}"] = float(np.mean([recall_at_k(r["ranked_ids"], relevant[r["query_id"]], k) for r in judged])) if judged else 0.0
+        summary[f"ndcg@{k}"] = float(np.mean([ndcg_at_k(r["ranked_ids"], relevant[r["query_id"]], k) for r in judged])) if judged else 0.0
+    summary["mrr"] = float(np.mean([reciprocal_rank(r["ranked_ids"], relevant[r["query_id"]]) for r in judged])) if judged else 0.0
+    for stage, label in STAGES:
+        values = [r["timings"].get(stage, 0.0) for r in ok]
+        summary[f"{label}_p50_ms"] = float(np.percentile(values, 50)) if values else 0.0
+        summary[f"{label}_p95_ms"] = float(np.percentile(values, 95)) if values else 0.0
+    return summary
+
+
+def print_report(summaries: List[Dict[str, Any]], ks: List[int]):
+    k_max = max(ks)
+    header = (f"{'retriever':16s} {'reranker':16s} {'mult':>4s} {'llm':>4s} "
+              + " ".join(f"{f'R@{k}':>6s}" for k in ks)
+              + f" {f'nDCG@{k_max}':>8s} {'MRR':>6s} "
+              + " ".join(f"{label:>7s}" for _, label in STAGES) + f" {'p95':>7s} {'err':>4s}")
+    print("\n" + "=" * len(header))
+    print(header)
+    print("-" * len(header))
+    for s in summaries:
+        print(f"{s['retriever'][:16]:16s} {s['reranker'][:16]:16s} {s['candidate_multiplier']:4d} "
+              f"{'on' if s['llm_ranking'] else 'off':>4s} "
+              + " ".join(f"{s[f'recall@{k}']:6.3f}" for k in ks)
+              + f" {s[f'ndcg@{k_max}']:8.3f} {s['mrr']:6.3f} "
+              + " ".join(f"{s[f'{label}_p50_ms']:7.1f}" for _, label in STAGES)
+              + f" {s['total_p95_ms']:7.1f} {s['errors']:4d}")
+    print("=" * len(header))
+    print("Latency columns are p50 in ms; p95 is end-to-end.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality and latency of RAG pipeline configurations")
+    parser.add_argument("--data-dir", type=str, default=os.getenv("RAG_DATA_DIR"), help="Vector database directory")
+    parser.add_argument("--queries", type=str, required=True, help="Labelled query set (JSONL or JSON array)")
+    parser.add_argument("--retrievers", type=str,
+                        default=os.getenv("EMBEDDING_MODEL_PATH", "sentence-transformers/all-MiniLM-L6-v2"),
+                        help="Comma-separated embedding models: name=path[@index_version]")
+    parser.add_argument("--rerankers", type=str,
+                        default=os.getenv("RERANKER_MODEL_PATH", "cross-encoder/ms-marco-MiniLM-L-6-v2"),
+                        help="Comma-separated rerankers: name=path, or none")
+    parser.add_argument("--multipliers", type=str, default="5", help="Comma-separated candidate_multiplier values")
+    parser.add_argument("--llm-ranking", type=str, default="off", help="off, on, or off,on")
+    parser.add_argument("--config", type=str, default=None, help="Path to config.yaml for LLM ranking")
+    parser.add_argument("--index-version", type=str, default=None, help="Index version to load (overrides manifest.json)")
+    parser.add_argument("--k", type=str, default="1,5,10", help="Cutoffs for recall@k / nDCG@k")
+    parser.add_argument("--top-k", type=int, default=None, help="Results requested per query (default: max k)")
+    parser.add_argument("--backend", type=str, default=None, choices=CPU_BACKENDS, help="Model backend (default: torch on GPU, int8 on CPU)")
+    parser.add_argument("--no-gpu", action="store_true", help="Keep FAISS indexes on CPU")
+    parser.add_argument("--concurrency", type=int, default=4, help="Queries in flight at once")
+    parser.add_argument("--batch-size", type=int, default=32, help="Queries per batch between progress reports")
+    parser.add_argument("--limit", type=int, default=None, help="Only evaluate the first N queries")
+    parser.add_argument("--cache-dir", type=str, default="eval_cache", help="Per-configuration result cache")
+    parser.add_argument("--report", type=str, default="eval_report.json", help="Output report path")
+    args = parser.parse_args()
+
+    configure_logging(level="warning", fmt="text")
+    ks = sorted({int(k) for k in args.k.split(",") if k.strip()})
+    top_k = args.top_k or max(ks)
+    queries = load_queries(args.queries, args.limit)
+    queries_digest = hashlib.sha1(json.dumps(queries, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    cities = sorted({q["city"] for q in queries})
+    backend = args.backend or ("torch" if rag_server.DEVICE == "cuda" else "int8")
+    print(f"📋 {len(queries)} queries across {len(cities)} cities, top_k={top_k}, backend={backend}")
+
+    retrievers = parse_model_specs(args.retrievers)
+    rerankers = parse_model_specs(args.rerankers)
+    multipliers = [int(m) for m in args.multipliers.split(",") if m.strip()]
+    llm_modes = [mode.strip().lower() == "on" for mode in args.llm_ranking.split(",") if mode.strip()]
+
+    models = RAGModels(data_dir=args.data_dir, use_gpu=not args.no_gpu, config_path=args.config,
+                       index_version=args.index_version)
+    rag_server.models = models
+    if not models.vector_db:
+        raise SystemExit("❌ No vector databases loaded. Please specify --data-dir")
+    # 启动时加载的版本（--index-version 或 manifest）；不带 @index_version 的 retriever 使用这些版本
+    loaded_versions = models.vector_db.versions
+    default_versions = {city: loaded_versions.get(city) for city in cities}
+
+    # 整个扫描在同一个事件循环中运行（LLM 精排器的锁绑定在事件循环上）
+    summaries = asyncio.run(sweep(args, models, queries, queries_digest, default_versions, ks, top_k, backend,
+                                  retrievers, rerankers, multipliers, llm_modes))
+
+    print_report(summaries, ks)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump({"queries": args.queries, "k": ks, "configs": summaries}, f, ensure_ascii=False, indent=2)
+    print(f"\n📝 Report written to {args.report}")
+
+
+async def sweep(args, models: RAGModels, queries: List[Dict[str, Any]], queries_digest: str,
+                default_versions: Dict[str, str],
+                ks: List[int], top_k: int, backend: str, retrievers: List[ModelSpec], rerankers: List[ModelSpec],
+                multipliers: List[int], llm_modes: List[bool]) -> List[Dict[str, Any]]:
+    summaries = []
+    loaded: Dict[str, Optional[str]] = {}
+    # 外层按模型分组，每组模型只加载一次
+    for retriever, reranker in itertools.product(retrievers, rerankers):
+        models_ready = False
+        index_versions = retriever_index_versions(retriever, default_versions)
+        for multiplier, llm_ranking in itertools.product(multipliers, llm_modes):
+            config = {
+                "data_dir": os.path.abspath(args.data_dir),
+                "retriever": retriever[0],
+                "retriever_path": retriever[1],
+                "index_version": retriever[2],
+                "index_versions": index_versions,
+                "reranker": reranker[0],
+                "reranker_path": reranker[1],
+                "candidate_multiplier": multiplier,
+                "llm_ranking": llm_ranking,
+                "top_k": top_k,
+                "backend": backend,
+            }
+            cid = config_id(config, queries_digest)
+            cache = ResultCache(args.cache_dir, cid, config)
+            print(f"\n🏁 [{cid}] retriever={retriever[0]} reranker={reranker[0]} "
+                  f"multiplier={multiplier} llm={'on' if llm_ranking else 'off'}")
+
+            if cache.pending(queries):
+                if not models_ready:
+                    prepare_models(models, loaded, retriever, reranker, index_versions, backend)
+                    models_ready = True
+                await run_config(config, queries, cache, args.concurrency, args.batch_size)
+            summaries.append(summarize(cid, config, queries, cache, ks))
+    return summaries
+
+
+if __name__ == "__main__":
+    main()
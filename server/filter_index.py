@@ -0,0 +1,836 @@
+"""
+检索过滤用的内存索引：查询地点解析、商户名前缀补全、附近检索的网格空间索引与营业时间位图
+
+均按城市（索引版本）从商户元数据构建，构建完成后只读，可被多个请求线程共享。
+"""
+
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from observability import Counter, Histogram, logger, metrics_registry
+
+# ==================== 商户元数据字段 ====================
+
+# 元数据中可能作为商户唯一 ID 的字段（按优先级）
+MERCHANT_ID_FIELDS = ("merchant_id", "id", "poi_id", "shop_id")
+
+# 地点解析与区域过滤使用的元数据字段
+AREA_FIELDS = ("district", "business_area", "landmark")
+
+def _area_values(doc: Dict[str, Any]) -> List[str]:
+    """商户的区县 / 商圈 / 地标取值（字段可能是字符串或字符串列表）"""
+    values = []
+    for field in AREA_FIELDS:
+        value = doc.get(field)
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, str) and item.strip():
+                values.append(item.strip())
+    return values
+
+
+# ==================== 查询地点解析 ====================
+# 在查询文本中识别城市 / 省份 / 区县 / 商圈 / 地标：城市与省份把请求路由到对应城市的索引，
+# 区县 / 商圈 / 地标把检索范围缩小到这些区域的商户（见 CityIndexHandle.search_in_areas）。
+# 词典来自 china_full.json 的行政区名称和各城市元数据的 district / business_area / landmark 取值，
+# 由 Aho-Corasick 自动机一次扫描完成全部匹配（微秒级），不额外调用 LLM。
+
+# china_full.json 只有省级行政区：按 adcode 把省份名映射到已支持的城市
+CITY_PROVINCE_ADCODE = {
+    "上海": 310000,
+    "北京": 110000,
+    "广州": 440000,
+    "深圳": 440000,
+    "杭州": 330000,
+    "苏州": 320000,
+    "成都": 510000,
+    "重庆": 500000,
+    "武汉": 420000,
+}
+ADMIN_SUFFIXES = ("特别行政区", "维吾尔自治区", "壮族自治区", "回族自治区", "自治区", "省", "市")
+AREA_SUFFIXES = ("新区", "街道", "商圈", "区", "县", "镇")
+MIN_AREA_TERM_LEN = 2      # 更短的区域词（单字）误匹配太多，不收录
+MAX_AREA_ROUTE_CITIES = 2  # 查询中只有区域词时，区域词对应的城市不超过该数量才自动路由
+
+LOCATION_PARSES = metrics_registry.register(Counter(
+    "rag_location_parses_total", "Queries run through the location parser by outcome", ("result",)))
+
+def _strip_suffix(name: str, suffixes: Tuple[str, ...], min_len: int = 2) -> Optional[str]:
+    for suffix in suffixes:
+        if name.endswith(suffix) and len(name) - len(suffix) >= min_len:
+            return name[:-len(suffix)]
+    return None
+
+class AhoCorasick:
+    """多模式串匹配自动机（goto / fail / output）；build() 之后只读，可被多个线程共享"""
+    
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, Any]]] = [[]]  # 节点 -> [(模式长度, payload)]
+    
+    @property
+    def nodes(self) -> int:
+        return len(self._goto)
+    
+    def add(self, pattern: str, payload: Any):
+        node = 0
+        for ch in pattern:
+            child = self._goto[node].get(ch)
+            if child is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][ch] = child
+            node = child
+        self._out[node].append((len(pattern), payload))
+    
+    def build(self) -> "AhoCorasick":
+        """BFS 计算 fail 指针，并把 fail 链上的输出合并到每个节点"""
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in self._goto[node].items():
+                pending.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+        return self
+    
+    def find_all(self, text: str) -> List[Tuple[int, int, Any]]:
+        """返回所有匹配 (start, end, payload)，可能互相重叠"""
+        found = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length, payload in self._out[node]:
+                found.append((i + 1 - length, i + 1, payload))
+        return found
+
+class QueryLocation:
+    """一次查询的地点解析结果"""
+    
+    def __init__(self, cities: List[str], areas: Dict[str, List[str]], matches: List[Dict[str, Any]], parse_us: float):
+        self.cities = cities      # 识别出的城市（中文，按出现顺序）
+        self.areas = areas        # 城市 -> 区域取值（district / business_area / landmark 原值）
+        self.matches = matches    # 命中的词及其位置
+        self.parse_us = parse_us
+        self.routed = False       # 是否据此改写了请求的城市（由调用方设置）
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "cities": self.cities,
+            "areas": self.areas,
+            "matches": self.matches,
+            "parse_us": round(self.parse_us, 1),
+            "routed": self.routed,
+        }
+
+class LocationParser:
+    """城市 / 省份 / 区域词典 + Aho-Corasick 自动机（进程内；重建时整体替换，解析无需加锁）"""
+    
+    def __init__(self):
+        self._automaton: Optional[AhoCorasick] = None
+        self._city_to_en: Dict[str, str] = {}
+        self._admin_geojson: Optional[str] = None
+        self._sources: Dict[str, List[Dict[str, Any]]] = {}  # 构建区域词典时各城市的元数据列表
+        self._building = False
+        self._lock = threading.Lock()
+        self.terms = 0
+        self.includes_areas = False
+        self.build_s = 0.0
+        self.parsed = 0
+        self.detected = 0
+    
+    @property
+    def ready(self) -> bool:
+        return self._automaton is not None
+    
+    def build(self, city_to_en: Dict[str, str], admin_geojson: Optional[str] = None,
+              metadata: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+        """构建词典
+        
+        Args:
+            city_to_en: 支持的城市（中文 -> 英文）
+            admin_geojson: china_full.json 路径（省级行政区名称）
+            metadata: 城市 -> 商户元数据；提供时收录区县 / 商圈 / 地标
+        """
+        start = time.time()
+        terms: Dict[str, set] = defaultdict(set)  # 词 -> {(kind, city, value)}
+        
+        for city, city_en in city_to_en.items():
+            for term in (city, city + "市", city_en.lower()):
+                terms[term].add(("city", city, city))
+        
+        if admin_geojson and os.path.exists(admin_geojson):
+            try:
+                with open(admin_geojson, "r", encoding="utf-8") as f:
+                    features = json.load(f).get("features", [])
+                cities_by_adcode = defaultdict(list)
+                for city, adcode in CITY_PROVINCE_ADCODE.items():
+                    if city in city_to_en:
+                        cities_by_adcode[adcode].append(city)
+                for feature in features:
+                    props = feature.get("properties") or {}
+                    name = props.get("name")
+                    if not name or props.get("adcode") not in cities_by_adcode:
+                        continue
+                    for term in {name, _strip_suffix(name, ADMIN_SUFFIXES) or name}:
+                        for city in cities_by_adcode[props["adcode"]]:
+                            terms[term].add(("province", city, name))
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to read admin names from {admin_geojson}: {e}")
+        
+        if metadata:
+            area_terms: Dict[str, set] = defaultdict(set)
+            for city, docs in metadata.items():
+                for value in {value for doc in docs for value in _area_values(doc)}:
+                    for term in {value.lower(), _strip_suffix(value.lower(), AREA_SUFFIXES, MIN_AREA_TERM_LEN)}:
+                        if term and len(term) >= MIN_AREA_TERM_LEN:
+                            area_terms[term].add((city, value))
+            # 大多数城市都有的取值（如“市中心”“火车站”）没有区分度，不作为过滤条件
+            generic_limit = len(metadata) // 2 if len(metadata) >= 4 else len(metadata)
+            for term, entries in area_terms.items():
+                if len({city for city, _ in entries}) <= generic_limit:
+                    terms[term].update(("area", city, value) for city, value in entries)
+        
+        automaton = AhoCorasick()
+        for term, entries in terms.items():
+            automaton.add(term, tuple(sorted(entries)))
+        self._automaton = automaton.build()
+        self._city_to_en, self._admin_geojson, self._sources = dict(city_to_en), admin_geojson, dict(metadata or {})
+        self.terms = len(terms)
+        self.includes_areas = bool(metadata)
+        self.build_s = time.time() - start
+        logger.info(f"🗺️  Location parser ready: {self.terms} terms, {automaton.nodes} nodes "
+                    f"({'with' if metadata else 'without'} areas, {self.build_s:.2f}s)")
+    
+    def refresh(self, metadata: Dict[str, List[Dict[str, Any]]]):
+        """热切换 / 压缩后元数据列表对象变化时，在后台线程重建区域词典（重建完成前继续使用旧词典）
+        
+        启动时的区域词典尚未构建完成时不做任何事。
+        """
+        with self._lock:
+            if self._building or not self.includes_areas:
+                return
+            if metadata.keys() == self._sources.keys() and all(
+                    metadata[city] is docs for city, docs in self._sources.items()):
+                return
+            self._building = True
+        
+        def _rebuild():
+            try:
+                self.build(self._city_to_en, self._admin_geojson, metadata)
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to rebuild location parser: {e}")
+            finally:
+                with self._lock:
+                    self._building = False
+        
+        threading.Thread(target=_rebuild, name="location-parser", daemon=True).start()
+    
+    def parse(self, query: str) -> QueryLocation:
+        """识别查询中的地点；显式提到的城市 / 省份优先，否则由区域词推断城市"""
+        start = time.perf_counter()
+        automaton = self._automaton
+        if automaton is None:
+            return QueryLocation([], {}, [], 0.0)
+        
+        # 最左最长、互不重叠：“浦东新区”不会再拆出“浦东”
+        found = sorted(automaton.find_all(query.lower()), key=lambda m: (m[0], m[0] - m[1]))
+        matches, area_entries, explicit = [], [], []
+        end = 0
+        for match_start, match_end, entries in found:
+            if match_start < end:
+                continue
+            end = match_end
+            city_entries = [e for e in entries if e[0] == "city"] or [e for e in entries if e[0] == "province"]
+            kind = city_entries[0][0] if city_entries else "area"
+            matches.append({"term": query[match_start:match_end], "kind": kind, "start": match_start, "end": match_end})
+            if city_entries:
+                explicit.extend(city for _, city, _ in city_entries if city not in explicit)
+            else:
+                area_entries.append(entries)
+        
+        if explicit:
+            cities = explicit
+        else:
+            cities = []
+            for entries in area_entries:
+                cities.extend(city for _, city, _ in entries if city not in cities)
+            if len(cities) > MAX_AREA_ROUTE_CITIES:
+                cities = []
+        
+        areas: Dict[str, List[str]] = {}
+        for entries in area_entries:
+            for _, city, value in entries:
+                if city in cities and value not in areas.setdefault(city, []):
+                    areas[city].append(value)
+        areas = {city: values for city, values in areas.items() if values}
+        
+        self.parsed += 1
+        if cities:
+            self.detected += 1
+        LOCATION_PARSES.inc(result="area" if areas else ("city" if cities else "none"))
+        return QueryLocation(cities, areas, matches, (time.perf_counter() - start) * 1e6)
+    
+    def stats(self) -> Dict[str, Any]:
+        automaton = self._automaton
+        return {
+            "ready": automaton is not None,
+            "terms": self.terms,
+            "nodes": automaton.nodes if automaton else 0,
+            "includes_areas": self.includes_areas,
+            "build_s": round(self.build_s, 3),
+            "parsed": self.parsed,
+            "detected": self.detected,
+        }
+# ==================== 商户名自动补全 ====================
+# 每个城市一份前缀索引：商户名和品牌别名规范化后排序存放，前缀查询用二分查找定位区间，
+# 在区间内按评分 / 人气取 top-N。命中条目很多的短前缀（如单字）在构建时预先算好结果，
+# 其余前缀的区间不超过 AUTOCOMPLETE_HOT_RANGE 条，单次查询在 1 ms 以内。
+# 与逐字符的 dict trie 相比，排序数组 + numpy 分数列的内存占用小一个数量级。
+
+AUTOCOMPLETE_BRAND_FIELDS = ("brand", "brand_name")
+AUTOCOMPLETE_POPULARITY_FIELDS = ("review_count", "comment_count", "popularity")
+AUTOCOMPLETE_FIELDS = ("name", "address", "district", "business_area", "category", "rating", "avg_price")
+AUTOCOMPLETE_TOP_N = 20        # 每次查询最多返回的候选数
+AUTOCOMPLETE_HOT_RANGE = 1024  # 命中条目超过该数量的前缀在构建时预先算好 top-N
+_PREFIX_END = "\U0010ffff"     # 大于任何字符：[prefix, prefix + _PREFIX_END) 即以 prefix 开头的区间
+
+AUTOCOMPLETE_LATENCY = metrics_registry.register(Histogram(
+    "rag_autocomplete_seconds", "Merchant name autocomplete lookup latency", (),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)))
+
+def _normalize_name(text: str) -> str:
+    """全角转半角、小写、去掉空白：“星巴克（国贸店）”与“星巴克(国贸店)”规范化后相同"""
+    return "".join(unicodedata.normalize("NFKC", text).lower().split())
+
+def _as_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _merchant_popularity(doc: Dict[str, Any]) -> float:
+    """补全排序分：评分（0-5）+ log10(1 + 评论数 / 人气值)"""
+    reviews = max((_as_float(doc.get(field)) for field in AUTOCOMPLETE_POPULARITY_FIELDS), default=0.0)
+    return _as_float(doc.get("rating")) + math.log10(1 + max(0.0, reviews))
+
+def _merchant_aliases(doc: Dict[str, Any]) -> set:
+    """商户名、品牌字段，以及去掉分店后缀的品牌名（“星巴克(国贸店)” -> “星巴克”）"""
+    aliases = set()
+    for value in [doc.get("name")] + [doc.get(field) for field in AUTOCOMPLETE_BRAND_FIELDS]:
+        if isinstance(value, str):
+            key = _normalize_name(value)
+            if key:
+                aliases.add(key)
+                brand = key.split("(", 1)[0]
+                if brand and brand != key:
+                    aliases.add(brand)
+    return aliases
+
+class PrefixIndex:
+    """单个城市的商户名前缀索引（排序的别名列表 + 对应的元数据行号和排序分）"""
+    
+    def __init__(self, metadata: List[Dict[str, Any]]):
+        start = time.time()
+        entries = []
+        for row, doc in enumerate(metadata):
+            score = _merchant_popularity(doc)
+            entries.extend((alias, row, score) for alias in _merchant_aliases(doc))
+        entries.sort(key=lambda entry: entry[0])
+        
+        self.metadata = metadata  # 构建时的元数据列表；热切换 / 压缩后列表对象变化即需重建
+        self.keys: List[str] = [alias for alias, _, _ in entries]
+        self.rows = np.fromiter((row for _, row, _ in entries), dtype='int32', count=len(entries))
+        self.scores = np.fromiter((score for _, _, score in entries), dtype='float32', count=len(entries))
+        self.merchants = len({row for _, row, _ in entries})
+        del entries
+        self.hot: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._precompute_hot()
+        self.nbytes = (
+            sys.getsizeof(self.keys) + sum(sys.getsizeof(key) for key in self.keys)
+            + self.rows.nbytes + self.scores.nbytes + sys.getsizeof(self.hot)
+            + sum(sys.getsizeof(prefix) + rows.nbytes + scores.nbytes for prefix, (rows, scores) in self.hot.items())
+        )
+        self.build_s = time.time() - start
+    
+    def _precompute_hot(self):
+        """逐层找出命中条目超过 AUTOCOMPLETE_HOT_RANGE 的前缀，预先算好 top-N"""
+        keys = self.keys
+        pending = [(0, len(keys), 1)]
+        while pending:
+            lo, hi, depth = pending.pop()
+            i = lo
+            while i < hi:
+                if len(keys[i]) < depth:
+                    i += 1
+                    continue
+                prefix = keys[i][:depth]
+                j = bisect.bisect_left(keys, prefix + _PREFIX_END, i, hi)
+                if j - i > AUTOCOMPLETE_HOT_RANGE:
+                    self.hot[prefix] = self._top(i, j)
+                    pending.append((i, j, depth + 1))
+                i = j
+    
+    def _top(self, lo: int, hi: int, exclude: frozenset = frozenset()) -> Tuple[np.ndarray, np.ndarray]:
+        """区间内按分数取 top-N 商户（同一商户的多个别名只保留一次，exclude 中的行跳过）"""
+        scores = self.scores[lo:hi]
+        # 每个商户最多 3~4 个别名，多取几倍再去重即可
+        take = min(len(scores), (AUTOCOMPLETE_TOP_N + len(exclude)) * 4)
+        order = np.argpartition(-scores, take - 1)[:take] if take < len(scores) else np.arange(len(scores))
+        order = order[np.argsort(-scores[order], kind='stable')]
+        rows, seen = [], set()
+        for i in order:
+            row = int(self.rows[lo + i])
+            if row not in seen and row not in exclude:
+                seen.add(row)
+                rows.append(lo + i)
+                if len(rows) >= AUTOCOMPLETE_TOP_N:
+                    break
+        positions = np.asarray(rows, dtype='int64')
+        return self.rows[positions], self.scores[positions]
+    
+    def lookup(self, prefix: str, limit: int = 10, exclude: frozenset = frozenset()) -> List[Tuple[float, int]]:
+        """返回 [(score, 元数据行号)]，按分数降序；exclude 为要跳过的行号（已删除 / 被覆盖的商户）"""
+        key = _normalize_name(prefix)
+        if not key:
+            return []
+        top = self.hot.get(key)
+        if top is not None and exclude:
+            rows, scores = top
+            keep = np.fromiter((int(row) not in exclude for row in rows), dtype=bool, count=len(rows))
+            # 预先算好的 top-N 被墓碑删掉太多时回到区间内重新选
+            top = (rows[keep], scores[keep]) if keep.sum() >= min(limit, len(rows)) else None
+        if top is None:
+            lo = bisect.bisect_left(self.keys, key)
+            hi = bisect.bisect_left(self.keys, key + _PREFIX_END, lo)
+            if lo == hi:
+                return []
+            top = self._top(lo, hi, exclude)
+        rows, scores = top
+        return [(float(score), int(row)) for row, score in zip(rows[:limit], scores[:limit])]
+
+class MerchantAutocomplete:
+    """各城市的 PrefixIndex；元数据变化（热切换 / 压缩）后在后台线程重建，重建完成前继续使用旧索引
+    
+    前缀索引只覆盖 base 段：查询时按当前索引版本跳过墓碑行，并在 delta 段（商户数少）中线性匹配新增 / 修改的商户。
+    """
+    
+    def __init__(self):
+        self._indexes: Dict[str, PrefixIndex] = {}
+        self._building: set = set()
+        self._lock = threading.Lock()
+        self.lookups = 0
+    
+    def refresh(self, metadata: Dict[str, List[Dict[str, Any]]]):
+        """检查各城市的索引是否对应当前元数据，过期或缺失的城市交给一个后台线程重建"""
+        with self._lock:
+            stale = {
+                city: docs for city, docs in metadata.items()
+                if city not in self._building and (city not in self._indexes or self._indexes[city].metadata is not docs)
+            }
+            self._building.update(stale)
+        if stale:
+            threading.Thread(target=self._build, args=(stale,), name="autocomplete-build", daemon=True).start()
+    
+    def _build(self, stale: Dict[str, List[Dict[str, Any]]]):
+        for city, docs in stale.items():
+            try:
+                index = PrefixIndex(docs)
+                self._indexes[city] = index
+                logger.info(f"🔤 Autocomplete index for {city}: {index.merchants} merchants, {len(index.keys)} aliases, "
+                            f"{len(index.hot)} hot prefixes, {index.nbytes / 1024 / 1024:.1f} MB ({index.build_s:.2f}s)")
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to build autocomplete index for {city}: {e}")
+            finally:
+                with self._lock:
+                    self._building.discard(city)
+    
+    def suggest(self, prefix: str, cities: List[str], limit: int = 10,
+                handles: Optional[Dict[str, "CityIndexHandle"]] = None) -> List[Dict[str, Any]]:
+        """多个城市的候选按分数合并；传入各城市当前的 CityIndexHandle 时应用其墓碑与 delta 段"""
+        self.lookups += 1
+        hits = []
+        for city in cities:
+            index = self._indexes.get(city)
+            handle = (handles or {}).get(city)
+            if index is not None:
+                # 墓碑是 handle.metadata 的行号；前缀索引仍在为新版本重建时行号对不上，暂不过滤
+                exclude = handle.tombstones if handle is not None and index.metadata is handle.metadata else frozenset()
+                hits.extend((score, city, index.metadata[row]) for score, row in index.lookup(prefix, limit, exclude))
+            if handle is not None and handle.delta_metadata:
+                hits.extend((score, city, doc) for score, doc in self._match_delta(prefix, handle))
+        suggestions = []
+        for score, city, doc in heapq.nlargest(limit, hits, key=lambda hit: hit[0]):
+            suggestion = {field: doc[field] for field in MERCHANT_ID_FIELDS + AUTOCOMPLETE_FIELDS if field in doc}
+            suggestion["city"] = city
+            suggestion["score"] = round(score, 3)
+            suggestions.append(suggestion)
+        return suggestions
+    
+    @staticmethod
+    def _match_delta(prefix: str, handle: "CityIndexHandle") -> List[Tuple[float, Dict[str, Any]]]:
+        key = _normalize_name(prefix)
+        if not key:
+            return []
+        return [(_merchant_popularity(doc), doc) for doc in handle.delta_docs()
+                if any(alias.startswith(key) for alias in _merchant_aliases(doc))]
+    
+    def ready_cities(self) -> List[str]:
+        return list(self._indexes)
+    
+    def stats(self) -> Dict[str, Any]:
+        indexes = dict(self._indexes)
+        return {
+            "cities": {
+                city: {
+                    "merchants": index.merchants,
+                    "aliases": len(index.keys),
+                    "hot_prefixes": len(index.hot),
+                    "memory_mb": round(index.nbytes / 1024 / 1024, 2),
+                }
+                for city, index in indexes.items()
+            },
+            "memory_mb": round(sum(index.nbytes for index in indexes.values()) / 1024 / 1024, 2),
+            "building": sorted(self._building),
+            "lookups": self.lookups,
+        }
+# ==================== 附近检索（网格空间索引）====================
+# 请求带 lat / lng / radius_m 时，先用空间索引找出半径内的商户，FAISS 只在这些商户中检索，
+# 每个候选带上 distance_m 后再 rerank —— “附近”不再依赖模型从地址文本推断地理位置。
+# 空间索引按城市（索引版本）构建：坐标按 GEO_CELL_DEG 网格分桶排序，查询时只取覆盖半径的网格行，
+# 再用 haversine 精确过滤。没有坐标的商户用同一区县有坐标商户的质心代替（geo_precision=district）。
+
+GEO_COORD_FIELDS = (("latitude", "longitude"), ("lat", "lng"), ("lat", "lon"))
+GEO_CELL_DEG = 0.01          # 网格边长（度），纬度方向约 1.1 km
+GEO_MAX_RADIUS_M = 50000.0
+GEO_CITY_MARGIN_DEG = 0.1    # 判断坐标属于哪个城市时，城市商户外包框向外扩展的范围
+EARTH_RADIUS_M = 6371008.8
+_METERS_PER_DEG = math.pi * EARTH_RADIUS_M / 180
+
+def _valid_coords(lat: float, lng: float) -> Optional[Tuple[float, float]]:
+    if -90 <= lat <= 90 and -180 <= lng <= 180 and (lat, lng) != (0.0, 0.0):
+        return lat, lng
+    return None
+
+def _merchant_coords(doc: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    """商户坐标 (lat, lng)：支持 latitude/longitude、lat/lng 字段，以及 location（dict、“经度,纬度”字符串或 [经度, 纬度]）"""
+    for lat_field, lng_field in GEO_COORD_FIELDS:
+        if doc.get(lat_field) is not None and doc.get(lng_field) is not None:
+            return _valid_coords(_as_float(doc[lat_field]), _as_float(doc[lng_field]))
+    location = doc.get("location")
+    if isinstance(location, dict):
+        lat = location.get("lat", location.get("latitude"))
+        lng = location.get("lng", location.get("lon", location.get("longitude")))
+        if lat is not None and lng is not None:
+            return _valid_coords(_as_float(lat), _as_float(lng))
+    elif isinstance(location, str) and "," in location:
+        lng, lat = location.split(",", 1)  # 高德格式：经度在前
+        return _valid_coords(_as_float(lat), _as_float(lng))
+    elif isinstance(location, (list, tuple)) and len(location) == 2:
+        return _valid_coords(_as_float(location[1]), _as_float(location[0]))  # GeoJSON 顺序：[经度, 纬度]
+    return None
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """球面距离（米）；参数可以是标量或 numpy 数组"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _cell_key(cy, cx):
+    """网格行列号 -> 单个整数键（按行优先排序，同一行内相邻网格的键连续）"""
+    return (np.asarray(cy, dtype='int64') + 9000) * 40000 + (np.asarray(cx, dtype='int64') + 18000)
+
+class GeoIndex:
+    """单个城市的网格空间索引：按网格键排序的 (行号, 纬度, 经度) 数组 + 每个非空网格的起止位置"""
+    
+    def __init__(self, metadata: List[Dict[str, Any]]):
+        start = time.time()
+        coords: List[Optional[Tuple[float, float]]] = [_merchant_coords(doc) for doc in metadata]
+        
+        # 区县质心：同一区县有坐标商户的平均位置
+        sums: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0, 0])
+        for doc, point in zip(metadata, coords):
+            district = doc.get("district")
+            if point is not None and isinstance(district, str) and district:
+                acc = sums[district]
+                acc[0] += point[0]
+                acc[1] += point[1]
+                acc[2] += 1
+        self.district_centroids = {district: (lat / n, lng / n) for district, (lat, lng, n) in sums.items()}
+        
+        rows, lats, lngs = [], [], []
+        self.exact = self.approximate = 0
+        for row, (doc, point) in enumerate(zip(metadata, coords)):
+            if point is None:
+                point = self.district_centroids.get(doc.get("district"))
+                if point is None:
+                    continue
+                self.approximate += 1
+            else:
+                self.exact += 1
+            rows.append(row)
+            lats.append(point[0])
+            lngs.append(point[1])
+        
+        lat = np.asarray(lats, dtype='float64')
+        lng = np.asarray(lngs, dtype='float64')
+        keys = _cell_key(np.floor(lat / GEO_CELL_DEG), np.floor(lng / GEO_CELL_DEG))
+        order = np.argsort(keys, kind='stable')
+        self.rows = np.asarray(rows, dtype='int64')[order]
+        self.lat = lat[order]
+        self.lng = lng[order]
+        # cell_keys[i] 对应的条目为 [cell_offsets[i], cell_offsets[i + 1])
+        self.cell_keys, first = np.unique(keys[order], return_index=True)
+        self.cell_offsets = np.append(first, len(order)).astype('int64')
+        
+        if len(lat):
+            self.centroid = (float(lat.mean()), float(lng.mean()))
+            self.bbox = (float(lat.min()), float(lat.max()), float(lng.min()), float(lng.max()))
+        else:
+            self.centroid = self.bbox = None
+        self.build_s = time.time() - start
+    
+    def query(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        """半径内的元数据行号"""
+        if not len(self.rows):
+            return np.empty(0, dtype='int64')
+        dlat = radius_m / _METERS_PER_DEG
+        dlng = radius_m / (_METERS_PER_DEG * max(math.cos(math.radians(lat)), 1e-6))
+        cys = np.arange(math.floor((lat - dlat) / GEO_CELL_DEG), math.floor((lat + dlat) / GEO_CELL_DEG) + 1)
+        cx0 = math.floor((lng - dlng) / GEO_CELL_DEG)
+        cx1 = math.floor((lng + dlng) / GEO_CELL_DEG)
+        # 每一行网格在键空间中连续，一次 searchsorted 得到该行覆盖的条目区间
+        lo = np.searchsorted(self.cell_keys, _cell_key(cys, cx0))
+        hi = np.searchsorted(self.cell_keys, _cell_key(cys, cx1), side='right')
+        spans = [np.arange(self.cell_offsets[a], self.cell_offsets[b]) for a, b in zip(lo, hi) if b > a]
+        if not spans:
+            return np.empty(0, dtype='int64')
+        idx = np.concatenate(spans)
+        within = haversine_m(lat, lng, self.lat[idx], self.lng[idx]) <= radius_m
+        return self.rows[idx[within]]
+    
+    def distance_to(self, lat: float, lng: float, doc: Dict[str, Any]) -> Optional[Tuple[float, str]]:
+        """(距离米数, 精度 exact / district)；商户和所在区县都没有坐标时返回 None"""
+        point, precision = _merchant_coords(doc), "exact"
+        if point is None:
+            point, precision = self.district_centroids.get(doc.get("district")), "district"
+            if point is None:
+                return None
+        return float(haversine_m(lat, lng, point[0], point[1])), precision
+    
+    def distance_fields(self, lat: float, lng: float, doc: Dict[str, Any]) -> Dict[str, Any]:
+        located = self.distance_to(lat, lng, doc)
+        if located is None:
+            return {}
+        return {"distance_m": round(located[0]), "geo_precision": located[1]}
+    
+    def contains(self, lat: float, lng: float) -> bool:
+        if self.bbox is None:
+            return False
+        lat_min, lat_max, lng_min, lng_max = self.bbox
+        return (lat_min - GEO_CITY_MARGIN_DEG <= lat <= lat_max + GEO_CITY_MARGIN_DEG
+                and lng_min - GEO_CITY_MARGIN_DEG <= lng <= lng_max + GEO_CITY_MARGIN_DEG)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "exact": self.exact,
+            "district_centroid": self.approximate,
+            "cells": len(self.cell_keys),
+            "build_s": round(self.build_s, 3),
+        }
+
+# ==================== 营业时间索引 ====================
+# 加载索引时把商户的 business_hours 文本解析成一周的营业位图（7 天 × 96 个 15 分钟时段 = 84 字节），
+# “现在还营业的”这类查询在 FAISS 检索阶段就排除该时段确定不营业的商户（营业时间缺失或无法解析的保留），
+# 关门的商户不再消耗 rerank / LLM 精排的额度。时段向外取整：只要时段内有一分钟在营业就算营业。
+
+HOURS_SLOT_MINUTES = 15
+DAY_SLOTS = 24 * 60 // HOURS_SLOT_MINUTES
+WEEK_SLOTS = 7 * DAY_SLOTS
+HOURS_BYTES = WEEK_SLOTS // 8
+HOURS_TZ = timezone(timedelta(hours=8), "Asia/Shanghai")  # 商户数据均为国内城市
+OPEN_FILTER_OVERFETCH = 4  # 索引不支持过滤检索时，普通检索多取的倍数
+
+OPEN_FILTERS = metrics_registry.register(Counter(
+    "rag_open_filter_total", "Searches run with the open-at-time filter by outcome", ("result",)))
+
+# 查询中表示“此刻营业”的说法（请求未显式传 open_now 时据此开启过滤）
+OPEN_NOW_PATTERN = re.compile(r"(现在|此刻|当前|目前|这会儿?)(还)?(在)?(营业|开门|开着)|还(在)?(营业|开门|开着)|正在营业|营业中|open now", re.I)
+
+_WEEKDAY_CHARS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6, "七": 6}
+_EN_WEEKDAYS = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+_CN_DAY = r"(?:周|星期|礼拜)"
+_EN_DAY = r"(?:mon|tue|wed|thu|fri|sat|sun)"
+_TIME = r"(?P<{0}n>次日|第二天|凌晨)?\s*(?P<{0}h>\d{{1,2}})\s*(?::(?P<{0}m>\d{{2}})|点(?:(?P<{0}mm>\d{{2}})分?|(?P<{0}half>半))?)"
+_HOURS_TOKEN = re.compile(
+    r"(?P<closed>暂停营业|暂停服务|歇业|停业|已关闭|已关店|永久关闭|closed permanently)"
+    r"|(?P<all_day>24\s*小时|全天|通宵|0?0:00\s*[-~至到]\s*24:00|24/7)"
+    rf"|(?P<days>{_CN_DAY}(?P<d1>[一二三四五六日天七1-7])(?:\s*[-~至到]\s*{_CN_DAY}?(?P<d2>[一二三四五六日天七1-7]))?"
+    rf"|\b(?P<e1>{_EN_DAY})[a-z]*\.?(?:\s*(?:-|~|to)\s*(?P<e2>{_EN_DAY})[a-z]*\.?)?)"
+    r"|(?P<every>每天|每日|天天|全年|daily|everyday)"
+    r"|(?P<workdays>工作日|weekdays?)"
+    r"|(?P<weekend>周末|双休日|weekends?)"
+    r"|(?P<holiday>法定节假日|节假日|节日|春节|holidays?)"
+    r"|(?P<rest>休息|不营业|闭店|店休|公休|closed|休)"
+    rf"|(?P<range>{_TIME.format('s')}\s*(?:-|~|—|–|至|到|to)\s*{_TIME.format('e')})",
+    re.I,
+)
+
+def _hours_minute(match: "re.Match", prefix: str) -> Optional[int]:
+    hour = int(match.group(prefix + "h"))
+    minute = match.group(prefix + "m") or match.group(prefix + "mm")
+    minute = 30 if match.group(prefix + "half") else int(minute or 0)
+    if hour > 24 or minute >= 60 or (hour == 24 and minute):
+        return None
+    return hour * 60 + minute
+
+def _day_index(token: str) -> int:
+    token = token.lower()
+    if token.isdigit():
+        return (int(token) - 1) % 7
+    return _EN_WEEKDAYS[token] if token in _EN_WEEKDAYS else _WEEKDAY_CHARS[token]
+
+def _span_bits(start: int, end: int) -> int:
+    """周时段 [start, end) 的位掩码（时段 0 在最高位，与 np.unpackbits 的顺序一致；超过周日末尾的部分绕回周一）"""
+    bits = 0
+    while start < end:
+        stop = min(end, WEEK_SLOTS * (start // WEEK_SLOTS + 1))
+        lo, hi = start % WEEK_SLOTS, stop - WEEK_SLOTS * (start // WEEK_SLOTS)
+        bits |= ((1 << (hi - lo)) - 1) << (WEEK_SLOTS - hi)
+        start = stop
+    return bits
+
+_DAY_MASKS = [_span_bits(day * DAY_SLOTS, (day + 1) * DAY_SLOTS) for day in range(7)]
+_ALL_WEEK = frozenset(range(7))
+
+@lru_cache(maxsize=65536)
+def parse_business_hours(text: str) -> Optional[bytes]:
+    """business_hours 文本 -> 84 字节的周营业位图；无法解析时返回 None（按“营业时间未知”处理）
+    
+    支持“10:00-22:00”、“周一至周五 09:00-18:00；周六、周日 10:00-20:00”、“11:00-14:00,17:00-21:30”、
+    “18:00-次日02:00”（跨夜）、“24小时营业”、“周一休息”、“暂停营业”等写法；节假日专属时间忽略。
+    """
+    text = unicodedata.normalize("NFKC", text).strip()
+    if not text:
+        return None
+    bits = 0
+    parsed = False
+    days: Optional[set] = None  # None：尚未指定星期，时间段作用于全周
+    last = None  # 上一个 token 类型：星期 token 连续出现时取并集，否则开始新的一组
+    for match in _HOURS_TOKEN.finditer(text):
+        kind = match.lastgroup  # 最外层的分支名（内层分组先于外层结束）
+        if kind == "closed":
+            return bytes(HOURS_BYTES)
+        if kind in ("days", "every", "workdays", "weekend", "holiday"):
+            if kind == "days":
+                first = _day_index(match.group("d1") or match.group("e1"))
+                second = _day_index(match.group("d2") or match.group("e2") or match.group("d1") or match.group("e1"))
+                selected = {(first + i) % 7 for i in range((second - first) % 7 + 1)}
+            else:
+                selected = {"every": set(_ALL_WEEK), "workdays": {0, 1, 2, 3, 4}, "weekend": {5, 6}, "holiday": set()}[kind]
+            if last in ("days", "holiday") and days is not None:
+                days = days | selected
+            else:
+                days = set(selected)
+            last = "holiday" if kind == "holiday" else "days"
+            continue
+        if kind == "rest":
+            if days:
+                for day in days:
+                    bits &= ~_DAY_MASKS[day]
+                parsed = True
+                # “周一休息 10:00-22:00”：之后未指定星期的时间段作用于其余日子
+                days = set(_ALL_WEEK) - days
+            last = "rest"
+            continue
+        # 时间段
+        if kind == "all_day":
+            start, end = 0, 24 * 60
+        else:
+            start, end = _hours_minute(match, "s"), _hours_minute(match, "e")
+            if start is None or end is None:
+                continue
+            if match.group("sn") in ("次日", "第二天"):
+                start += 24 * 60
+            if match.group("en") in ("次日", "第二天") or end <= start:
+                end += 24 * 60  # 跨夜营业
+        parsed = True
+        last = "range"
+        for day in (_ALL_WEEK if days is None else days):
+            first_slot = day * DAY_SLOTS + start // HOURS_SLOT_MINUTES
+            last_slot = day * DAY_SLOTS + -(-end // HOURS_SLOT_MINUTES)
+            bits |= _span_bits(first_slot, last_slot)
+    if not parsed:
+        return None
+    return bits.to_bytes(HOURS_BYTES, "big")
+
+def _hours_text(doc: Dict[str, Any]) -> Optional[str]:
+    hours = doc.get("business_hours")
+    if isinstance(hours, list):
+        hours = "；".join(str(item) for item in hours if item)
+    return hours if isinstance(hours, str) and hours.strip() else None
+
+def week_slot(when: datetime) -> int:
+    """时间点所在的周时段编号（周一 00:00 为 0）；无时区的时间按北京时间处理"""
+    if when.tzinfo is not None:
+        when = when.astimezone(HOURS_TZ)
+    return when.weekday() * DAY_SLOTS + (when.hour * 60 + when.minute) // HOURS_SLOT_MINUTES
+
+class OpeningHours:
+    """单个城市的营业时间位图：bits[row] 为第 row 个商户的周营业位图，known[row] 表示营业时间是否解析成功"""
+    
+    def __init__(self, metadata: List[Dict[str, Any]]):
+        start = time.time()
+        empty = bytes(HOURS_BYTES)
+        packed, known = [], []
+        for doc in metadata:
+            text = _hours_text(doc)
+            bitmap = parse_business_hours(text) if text else None
+            packed.append(bitmap or empty)
+            known.append(bitmap is not None)
+        self.bits = np.frombuffer(b"".join(packed), dtype='uint8').reshape(len(packed), HOURS_BYTES)
+        self.known = np.asarray(known, dtype=bool)
+        self.build_s = time.time() - start
+    
+    def open_mask(self, slot: int) -> np.ndarray:
+        """每个商户在该时段是否可能营业（营业时间未知的算作可能营业）"""
+        column = (self.bits[:, slot >> 3] >> (7 - (slot & 7))) & 1
+        return column.astype(bool) | ~self.known
+    
+    @staticmethod
+    def doc_open(doc: Dict[str, Any], slot: int) -> Optional[bool]:
+        """单个商户（delta 段或检索结果）在该时段是否营业；营业时间未知时返回 None"""
+        text = _hours_text(doc)
+        bitmap = parse_business_hours(text) if text else None
+        if bitmap is None:
+            return None
+        return bool((bitmap[slot >> 3] >> (7 - (slot & 7))) & 1)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "parsed": int(self.known.sum()),
+            "unknown": int((~self.known).sum()),
+            "bytes": int(self.bits.nbytes + self.known.nbytes),
+            "build_s": round(self.build_s, 3),
+        }
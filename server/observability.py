@@ -0,0 +1,523 @@
+"""
+RAG 服务的可观测性基础设施：Prometheus 指标、W3C traceparent 链路追踪与结构化日志
+
+rag_server 与拆分出的 filter_index / registry / batching / admission 共用这里的指标注册表、tracer 和 logger。
+"""
+
+import bisect
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import requests
+
+# ==================== 监控指标（Prometheus 文本格式）====================
+# 轻量实现：只做加锁计数，/metrics 抓取时再渲染，常驻开启的开销可以忽略
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric(ABC):
+    metric_type = "untyped"
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"] + self._samples()
+    
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """渲染该指标的样本行"""
+
+class Counter(_Metric):
+    metric_type = "counter"
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+    
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), func=None):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._func = func  # 抓取时计算的无标签 gauge
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+    
+    def _samples(self) -> List[str]:
+        if self._func is not None:
+            try:
+                return [f"{self.name} {float(self._func())}"]
+            except Exception:
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = None):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        # key -> [每个桶的计数（非累计，最后一个为 +Inf）, sum, count]
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(e[0]), e[1], e[2])) for key, e in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+    
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry()
+
+STAGE_LATENCY = metrics_registry.register(Histogram(
+    "rag_stage_latency_seconds", "Latency of each search pipeline stage", ("stage", "city", "model")))
+REQUEST_LATENCY = metrics_registry.register(Histogram(
+    "rag_request_latency_seconds", "End-to-end HTTP request latency", ("path", "status")))
+LLM_RETRIES = metrics_registry.register(Counter(
+    "rag_llm_retries_total", "LLM ranking call retries", ("model",)))
+LLM_RATE_LIMITED = metrics_registry.register(Counter(
+    "rag_llm_rate_limited_total", "LLM ranking calls answered with HTTP 429", ("model",)))
+FALLBACKS = metrics_registry.register(Counter(
+    "rag_fallbacks_total", "Pipeline stages that fell back to a cheaper result", ("stage", "reason")))
+CACHE_HITS = metrics_registry.register(Counter(
+    "rag_cache_hits_total", "Requests served without recomputation", ("cache",)))
+IN_FLIGHT = metrics_registry.register(Gauge(
+    "rag_in_flight_requests", "HTTP requests currently being processed"))
+
+# 线程池（事件循环默认 executor、FAISS 多城市检索、微批处理）的排队任务数，抓取时计算
+_observed_executors: List["ObservedExecutor"] = []
+
+class ObservedExecutor(ThreadPoolExecutor):
+    """自行统计已提交 / 已开始的任务数（排队深度 = 两者之差），不依赖 ThreadPoolExecutor 的私有队列
+    
+    创建时登记到 _observed_executors，shutdown 时移除。
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._count_lock = threading.Lock()
+        self.submitted = 0
+        self.started = 0  # 含未执行就被取消的任务
+        _observed_executors.append(self)
+    
+    @property
+    def queue_depth(self) -> int:
+        with self._count_lock:
+            return self.submitted - self.started
+    
+    def _mark_started(self):
+        with self._count_lock:
+            self.started += 1
+    
+    def submit(self, fn, /, *args, **kwargs):
+        def _run():
+            self._mark_started()
+            return fn(*args, **kwargs)
+        
+        with self._count_lock:
+            self.submitted += 1
+        try:
+            future = super().submit(_run)
+        except RuntimeError:  # 已 shutdown
+            with self._count_lock:
+                self.submitted -= 1
+            raise
+        # 排队中被取消（如 shutdown(cancel_futures=True)）的任务不会执行 _run
+        future.add_done_callback(lambda f: self._mark_started() if f.cancelled() else None)
+        return future
+    
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        if self in _observed_executors:
+            _observed_executors.remove(self)
+
+def _executor_queue_depth() -> int:
+    return sum(ex.queue_depth for ex in list(_observed_executors))
+
+EXECUTOR_QUEUE_DEPTH = metrics_registry.register(Gauge(
+    "rag_executor_queue_depth", "Tasks waiting for a worker thread", func=_executor_queue_depth))
+
+def _city_metric_label(cities: List[str]) -> str:
+    """城市标签：单城市检索用城市名，多城市检索统一记为 multi，避免城市组合产生无界的时间序列"""
+    return cities[0] if len(cities) == 1 else "multi"
+
+def _model_label(model_name: Optional[str]) -> str:
+    """模型标签只保留路径最后一段，避免暴露本地目录"""
+    return os.path.basename(str(model_name).rstrip("/")) if model_name else "unknown"
+
+# ==================== 链路追踪（W3C traceparent）====================
+# 与 OpenTelemetry 的 span 模型保持一致：traceparent 头跨进程传播（代理 / HF / MCP 客户端 → 本服务 → LLM），
+# span 按 OTLP/JSON（ExportTraceServiceRequest）导出到本地文件（每批一行，与 collector 的 file exporter 相同）
+# 或 OTLP/HTTP collector（/v1/traces），采样率可配置（父 span 已采样时跟随父 span）
+
+TRACE_SERVICE_NAME = "rag-server"
+# OTLP SpanKind / StatusCode
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+STATUS_CODE_OK, STATUS_CODE_ERROR = 1, 2
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """解析 traceparent：00-<trace_id>-<span_id>-<flags>，返回 (trace_id, span_id, sampled)"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 0x01)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """OTLP AnyValue（intValue 按 proto3 JSON 约定编码为字符串）"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, (int, np.integer)):
+        return {"intValue": str(int(value))}
+    if isinstance(value, (float, np.floating)):
+        return {"doubleValue": float(value)}
+    return {"stringValue": str(value)}
+
+def otlp_trace_request(spans: List[Dict[str, Any]], service_name: str = TRACE_SERVICE_NAME) -> Dict[str, Any]:
+    """把 Span.to_otlp() 的结果包装成 OTLP ExportTraceServiceRequest"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "rag_server"}, "spans": spans}],
+    }]}
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: Dict[str, Any],
+                 kind: int = SPAN_KIND_INTERNAL):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes)
+        self.status = "OK"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+    
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+    
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+    
+    def set_error(self, error: Any):
+        self.status = "ERROR"
+        self.attributes["error"] = str(error)[:200]
+    
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP/JSON Span（未设置的属性值不导出）"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)}
+                           for key, value in self.attributes.items() if value is not None],
+            "status": {"code": STATUS_CODE_ERROR if self.status == "ERROR" else STATUS_CODE_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status == "ERROR" and "error" in self.attributes:
+            span["status"]["message"] = str(self.attributes["error"])
+        return span
+
+class SpanExporter:
+    """后台线程批量导出，不阻塞请求线程"""
+    
+    def __init__(self, target: str, batch_size: int = 64, flush_interval: float = 2.0):
+        self.target = target
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=10000)
+        self.dropped = 0
+        threading.Thread(target=self._run, name="span-exporter", daemon=True).start()
+    
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span.to_otlp())
+        except queue.Full:
+            self.dropped += 1
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size and time.time() < deadline:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.warning(f"⚠️ Span export failed ({len(batch)} spans): {e}")
+    
+    def _write(self, batch: List[Dict[str, Any]]):
+        payload = otlp_trace_request(batch)
+        if self.target.startswith(("http://", "https://")):
+            requests.post(self.target, json=payload, timeout=5).raise_for_status()
+        else:
+            path = self.target[len("file:"):] if self.target.startswith("file:") else self.target
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.0, exporter: Optional[SpanExporter] = None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+    
+    def configure(self, sample_rate: float, export_target: Optional[str]):
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.exporter = SpanExporter(export_target) if export_target else None
+        if self.exporter:
+            logger.info(f"🔭 Tracing: sample_rate={self.sample_rate}, export → {export_target}")
+    
+    def _new_span(self, name: str, traceparent: Optional[str], attributes: Dict[str, Any], kind: int) -> Span:
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes, kind)
+        remote = parse_traceparent(traceparent)
+        if remote:
+            trace_id, parent_id, sampled = remote
+            # 父 span 已采样则跟随；否则按本地采样率决定
+            sampled = sampled or random.random() < self.sample_rate
+            return Span(name, trace_id, parent_id, sampled, attributes, kind)
+        return Span(name, os.urandom(16).hex(), None, random.random() < self.sample_rate, attributes, kind)
+    
+    def _finish(self, span: Span):
+        span.end_ns = time.time_ns()
+        if span.sampled and self.exporter is not None:
+            self.exporter.export(span)
+    
+    @contextmanager
+    def span(self, name: str, traceparent: Optional[str] = None, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        """创建子 span（或在 traceparent 下创建根 span），并设为当前 span"""
+        span = self._new_span(name, traceparent, attributes, kind)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span)
+    
+    def current_traceparent(self) -> Optional[str]:
+        span = _current_span.get()
+        return span.traceparent if span is not None else None
+
+tracer = Tracer()
+
+# ==================== 结构化日志 ====================
+# 日志经 QueueHandler 入队，由 QueueListener 后台线程写 stdout / 文件，请求线程不做同步 I/O；
+# 每条日志带 request_id / trace_id，DEBUG 日志按请求采样（同一请求的 DEBUG 日志要么全记、要么全丢）
+
+logger = logging.getLogger("rag_server")
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("rag_request_id", default=None)
+_debug_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("rag_debug_sampled", default=True)
+
+LOG_FORMATS = ("json", "text")
+
+LOGS_DROPPED = metrics_registry.register(Counter(
+    "rag_log_records_dropped_total", "Log records dropped because the log queue was full"))
+
+def _fields(**fields) -> Dict[str, Any]:
+    """结构化字段：logger.info("msg", extra=_fields(k=v))"""
+    return {"fields": fields}
+
+class RequestContextFilter(logging.Filter):
+    """在调用线程中附加请求上下文，并丢弃未被采样请求的 DEBUG 日志"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and not _debug_sampled.get():
+            return False
+        span = _current_span.get()
+        record.request_id = _request_id.get() or "-"
+        record.trace_id = span.trace_id if span is not None else "-"
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """一行一个 JSON 对象，便于日志系统检索"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("request_id", "trace_id"):
+            value = getattr(record, key, "-")
+            if value != "-":
+                entry[key] = value
+        entry.update(getattr(record, "fields", None) or {})
+        # 经过 _DroppingQueueHandler 的记录只带已格式化的 exc_text
+        exc = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc:
+            entry["exc"] = exc
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+_exc_formatter = logging.Formatter()
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃并计数，而不是阻塞请求线程"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """合并 msg / args，异常在调用线程格式化为 exc_text 后保留
+        
+        基类会把异常格式化进 msg 并清空 exc_info / exc_text，JsonFormatter 就输出不了 "exc" 字段
+        """
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = _exc_formatter.formatException(record.exc_info)
+        record = copy.copy(record)  # 不影响同一 logger 上的其他 handler
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None  # traceback 会让栈帧一直存活到监听线程处理完
+        record.exc_text = exc_text
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DROPPED.inc()
+
+_log_state: Dict[str, Any] = {"listener": None, "debug_sample_rate": 1.0}
+
+def configure_logging(level: str = "info", fmt: str = "json", debug_sample_rate: float = 1.0,
+                      log_file: Optional[str] = None, queue_size: int = 10000):
+    """配置 rag_server logger；可重复调用（后一次覆盖前一次）"""
+    if _log_state["listener"] is not None:
+        _log_state["listener"].stop()
+    
+    target = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+    
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=queue_size)
+    handler = _DroppingQueueHandler(log_queue)
+    handler.addFilter(RequestContextFilter())
+    logger.handlers = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    
+    listener = logging.handlers.QueueListener(log_queue, target)
+    listener.start()
+    _log_state["listener"] = listener
+    _log_state["debug_sample_rate"] = max(0.0, min(1.0, debug_sample_rate))
+
+def shutdown_logging():
+    """刷出队列中剩余的日志"""
+    if _log_state["listener"] is not None:
+        _log_state["listener"].stop()
+        _log_state["listener"] = None
+
+def bind_request_context(request_id: str):
+    """请求开始时绑定 request id，并决定该请求的 DEBUG 日志是否采样"""
+    _request_id.set(request_id)
+    _debug_sampled.set(random.random() < _log_state["debug_sample_rate"])
@@ -25,10 +25,11 @@ LLM 精排（新增）：
     - 配置文件需包含 LLM API keys 和相关配置（参考 auto_rag_merchant_search.py）
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any, Tuple
+from typing import List, Dict, Optional, Any, Tuple, Union, Callable
 import uvicorn
 import argparse
 import os
@@ -36,11 +37,49 @@ import time
 from datetime import datetime
 from pathlib import Path
 import threading
+import heapq
+import sys
+import uuid
+import logging
+import logging.handlers
+import mmap
+import tempfile
+import multiprocessing
+import gzip
+import base64
+import secrets
+import pickle
+import fcntl
+import shutil
+from collections import OrderedDict, defaultdict
+from collections.abc import Sequence
+from multiprocessing.connection import Listener, Client
+from contextlib import AsyncExitStack, contextmanager, asynccontextmanager, nullcontext
+
+# CPU 推理线程数须在 numpy / torch 导入之前写入环境变量：OpenMP 线程池在库初始化时按 OMP_NUM_THREADS 创建，
+# 之后再设置只对子进程生效。多进程模式下工作进程和模型服务进程继承这里设置的环境变量。
+def _early_cpu_threads() -> Optional[int]:
+    """启动前读取 --cpu-threads（仅直接运行本脚本时）或 RAG_CPU_THREADS"""
+    value = os.getenv("RAG_CPU_THREADS")
+    argv = sys.argv[1:] if os.path.basename(sys.argv[0]) == "rag_server.py" else []
+    for i, arg in enumerate(argv):
+        if arg == "--cpu-threads" and i + 1 < len(argv):
+            value = argv[i + 1]
+        elif arg.startswith("--cpu-threads="):
+            value = arg.split("=", 1)[1]
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+_cpu_threads = _early_cpu_threads()
+if _cpu_threads and _cpu_threads > 0:
+    os.environ["OMP_NUM_THREADS"] = str(_cpu_threads)
 
 # 基础依赖
 import json
+import re
 import yaml
-import requests
 import numpy as np
 import aiohttp
 import asyncio
@@ -58,6 +97,31 @@ except ImportError as e:
     HAS_GPU = False
     print(f"⚠️ PyTorch/FAISS not found: {e}, using CPU mode")
 
+# 可选：更快的 JSON 编码与 brotli 压缩（未安装时使用标准库 json / gzip）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 拆分出的模块；rag_server 重新导出这些名称，benchmark / evaluate 等脚本仍可直接从 rag_server 导入
+from observability import (
+    CACHE_HITS, FALLBACKS, IN_FLIGHT, LLM_RATE_LIMITED, LLM_RETRIES, LOG_FORMATS, REQUEST_LATENCY, STAGE_LATENCY,
+    SPAN_KIND_CLIENT, SPAN_KIND_SERVER, Counter, Histogram, ObservedExecutor, _city_metric_label, _fields, _model_label,
+    bind_request_context, configure_logging, logger, metrics_registry, shutdown_logging, tracer,
+)
+from filter_index import (
+    AUTOCOMPLETE_LATENCY, AUTOCOMPLETE_TOP_N, GEO_MAX_RADIUS_M, HOURS_TZ, MERCHANT_ID_FIELDS, OPEN_FILTERS,
+    OPEN_FILTER_OVERFETCH, OPEN_NOW_PATTERN, GeoIndex, LocationParser, MerchantAutocomplete, OpeningHours,
+    QueryLocation, _area_values, _valid_coords, haversine_m, week_slot,
+)
+from registry import ModelRegistry, ModelRoute, RegisteredModel, load_registry_file
+from batching import EmbeddingBatcher, SearchBatcher
+from admission import DEGRADE_NO_LLM, DEGRADE_NO_RERANK, AdmissionController, _request_priority
+
 app = FastAPI(
     title="LocalSearchBench RAG API",
     description="RAG Search API with GPU support",
@@ -82,6 +146,20 @@ class RAGSearchRequest(BaseModel):
     retriever: str = "qwen3-embedding-8b"  # 默认使用 Qwen3-Embedding-8B
     reranker: str = "qwen3-reranker-8b"    # 默认使用 Qwen3-Reranker-8B
     use_llm_ranking: bool = True  # 是否启用 LLM 精排（默认启用）
+    # 多城市检索：城市列表（如 ["上海", "杭州"]）或 "all"；设置后覆盖 city 字段
+    cities: Optional[Union[List[str], str]] = None
+    # 根据查询中的城市 / 区县 / 商圈 / 地标自动路由与过滤（未显式传 city / cities 时才改写城市）
+    auto_location: bool = True
+    # 附近检索：用户坐标（WGS84 / GCJ-02 与商户数据一致即可）与半径；设置后只返回半径内的商户
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    radius_m: float = 3000.0
+    # 营业时间过滤：只返回该时刻可能营业的商户（营业时间未知的保留）；open_at 为 ISO 8601 时间（无时区按北京时间），
+    # open_now 为 None 时根据查询中的“现在还营业 / 营业中”等说法自动开启
+    open_now: Optional[bool] = None
+    open_at: Optional[str] = None
+    # sources 字段裁剪：字段列表、逗号分隔的字段名，或配置名（full / ui / mcp / ids，见 SOURCE_FIELD_PROFILES）
+    fields: Optional[Union[List[str], str]] = None
 
 class WebSearchRequest(BaseModel):
     query: str
@@ -92,21 +170,478 @@ class AgenticSearchRequest(BaseModel):
     model: str = "gpt-4.1"
     max_iterations: int = 5
 
+class IndexReloadRequest(BaseModel):
+    version: str  # 要加载的索引版本（versions/{version}/ 或平铺布局中的版本后缀）
+    cities: Union[List[str], str] = "all"  # 城市列表（中文）或 "all"
+
+class MerchantUpsertRequest(BaseModel):
+    merchants: List[Dict[str, Any]]  # 商户元数据，需包含 ID 字段（merchant_id/id/poi_id/shop_id）
+
+class MerchantDeleteRequest(BaseModel):
+    merchant_ids: List[str]
+
+class RAGPageRequest(BaseModel):
+    cursor: str  # 上一页响应中的 next_cursor
+    page_size: Optional[int] = None  # 默认与首次搜索的 top_k 相同
+    fields: Optional[Union[List[str], str]] = None  # 同 RAGSearchRequest.fields
+
 class SearchResult(BaseModel):
     answer: str
     sources: List[Dict[str, Any]]
     metrics: Dict[str, Any]  # 改为 Any 以支持混合类型（float、int、str）
     reasoning_steps: Optional[List[str]] = None
     processing_time: float
+    next_cursor: Optional[str] = None  # 有更多结果时返回，传给 /api/rag/search/next 获取下一页
 
 # ==================== 城市向量数据库加载器 ====================
 
+FILTER_BITMAP_MIN_ROWS = 4096   # 过滤检索的候选行数超过该值时使用位图 IDSelector
+EXACT_FILTER_MAX_ROWS = 20000   # 索引不支持 IDSelector 时，精确计算回退最多处理的行数
+
+class SharedMetadata(Sequence):
+    """只读元数据：JSONL 数据文件 + 行偏移数组，均通过 mmap 打开
+    
+    多个工作进程打开同一份文件时共享操作系统页缓存，每条商户在访问时才解析，
+    不会像 json.load 那样在每个进程里各复制一份完整的 Python 对象。
+    """
+    
+    def __init__(self, data_path: str, offsets_path: str):
+        self._offsets = np.load(offsets_path, mmap_mode="r")
+        self._file = open(data_path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if len(self._offsets) > 1 else b""
+    
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._mm[int(self._offsets[i]):int(self._offsets[i + 1])])
+    
+    @classmethod
+    def open(cls, meta_path: str) -> "SharedMetadata":
+        """打开 meta_path 对应的 JSONL 缓存，缺失或过期时先从 JSON 生成（原子写入，多进程同时生成也安全）"""
+        data_path, offsets_path = f"{meta_path}.jsonl", f"{meta_path}.offsets.npy"
+        fresh = all(os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(meta_path)
+                    for p in (data_path, offsets_path))
+        if not fresh:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            suffix = f".{os.getpid()}.tmp"
+            offsets = [0]
+            with open(data_path + suffix, "wb") as f:
+                for doc in metadata:
+                    line = json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\n"
+                    f.write(line)
+                    offsets.append(offsets[-1] + len(line))
+            with open(offsets_path + suffix, "wb") as f:
+                np.save(f, np.asarray(offsets, dtype="int64"))
+            os.replace(offsets_path + suffix, offsets_path)
+            os.replace(data_path + suffix, data_path)
+            logger.info(f"📝 Built shared metadata cache: {data_path} ({len(metadata)} merchants)")
+        return cls(data_path, offsets_path)
+
+
+def hit_order_key(metric_type: int) -> Callable[[Tuple], float]:
+    """检索结果 (score, ...) 的归并键：L2 距离越小越相似，内积越大越相似（取负后同样按升序归并）"""
+    if metric_type == faiss.METRIC_INNER_PRODUCT:
+        return lambda hit: -hit[0]
+    return lambda hit: hit[0]
+
+
+class CityIndexHandle:
+    """单个城市某一版本的 FAISS 索引 + 元数据，使用引用计数管理生命周期
+    
+    热切换时旧版本被标记为 retired，等所有在途请求 release 之后才真正释放内存。
+    
+    增量更新：
+    - base 段：离线构建的 FAISS 索引，行号即元数据下标
+    - delta 段：IndexIDMap(IndexFlat)，存放在线 upsert 的商户向量
+    - tombstones：被删除或被新版本覆盖的 base 行号，检索时过滤
+    """
+    
+    def __init__(self, city: str, version: str, index, metadata: List[Dict[str, Any]], device_tag: str,
+                 gpu_lock: Optional[threading.Lock] = None):
+        self.city = city
+        self.version = version
+        self.index = index
+        self.metadata = metadata
+        self.device_tag = device_tag
+        # GPU 索引共用一个 StandardGpuResources，它不是线程安全的：同一 CityVectorDB 的 GPU 调用串行执行
+        self._gpu_lock = gpu_lock if gpu_lock is not None and device_tag == "🚀 GPU" else nullcontext()
+        self.loaded_at = datetime.now().isoformat()
+        self._refcount = 0
+        self._retired = False
+        self._lock = threading.Lock()
+        
+        # 增量段（延迟初始化）
+        self._delta_lock = threading.Lock()
+        self.delta_index = None
+        self.delta_metadata: Dict[int, Dict[str, Any]] = {}  # delta id -> 商户元数据
+        self.delta_vectors: Dict[int, np.ndarray] = {}  # delta id -> 向量（压缩时使用）
+        self.tombstones = frozenset()  # 被删除/覆盖的 base 行号
+        self._next_delta_id = 0
+        self._id_field = None
+        self._id_to_row: Optional[Dict[str, int]] = None  # 商户 ID -> base 行号
+        self._id_to_delta: Dict[str, int] = {}  # 商户 ID -> delta id
+        
+        # 区域倒排（地点过滤，延迟构建）
+        self._area_lock = threading.Lock()
+        self._area_rows: Optional[Dict[str, np.ndarray]] = None  # 区域取值 -> base 行号
+        self._geo_index: Optional["GeoIndex"] = None  # 坐标网格索引（附近检索，延迟构建）
+        self._hours: Optional["OpeningHours"] = None  # 营业时间位图（营业中过滤，延迟构建）
+    
+    @property
+    def pending_changes(self) -> int:
+        """尚未压缩进 base 段的变更数量"""
+        return len(self.delta_metadata) + len(self.tombstones)
+    
+    @property
+    def hit_key(self) -> Callable[[Tuple], float]:
+        """本索引度量下的结果归并键（见 hit_order_key）"""
+        return hit_order_key(self.index.metric_type)
+    
+    @property
+    def live_count(self) -> int:
+        return len(self.metadata) - len(self.tombstones) + len(self.delta_metadata)
+    
+    def merchant_id(self, doc: Dict[str, Any], row: Optional[int] = None) -> Optional[str]:
+        """获取商户 ID；元数据没有 ID 字段时使用 base 行号"""
+        if self._id_field is None:
+            sample = self.metadata[0] if self.metadata else doc
+            self._id_field = next((f for f in MERCHANT_ID_FIELDS if f in sample), "")
+        if self._id_field and doc.get(self._id_field) is not None:
+            return str(doc[self._id_field])
+        if doc.get("merchant_id") is not None:
+            return str(doc["merchant_id"])
+        return str(row) if row is not None else None
+    
+    def delta_docs(self) -> List[Dict[str, Any]]:
+        """delta 段中商户元数据的快照"""
+        with self._delta_lock:
+            return list(self.delta_metadata.values())
+    
+    def _ensure_id_map(self):
+        if self._id_to_row is None:
+            self._id_to_row = {self.merchant_id(doc, row): row for row, doc in enumerate(self.metadata)}
+    
+    def _ensure_delta_index(self):
+        if self.delta_index is None:
+            self.delta_index = faiss.IndexIDMap(faiss.IndexFlat(self.index.d, self.index.metric_type))
+    
+    def upsert(self, docs: List[Dict[str, Any]], vectors: np.ndarray) -> Dict[str, int]:
+        """写入 delta 段；已存在的商户会被覆盖（base 行打墓碑，旧 delta 删除）"""
+        with self._delta_lock:
+            self._ensure_id_map()
+            self._ensure_delta_index()
+            tombstones = set(self.tombstones)
+            inserted = updated = 0
+            for doc, vec in zip(docs, vectors):
+                merchant_id = self.merchant_id(doc)
+                if merchant_id is None:
+                    raise ValueError(f"Merchant is missing an ID field ({', '.join(MERCHANT_ID_FIELDS)})")
+                if merchant_id in self._id_to_row:
+                    tombstones.add(self._id_to_row.pop(merchant_id))
+                    updated += 1
+                elif merchant_id in self._id_to_delta:
+                    self._remove_delta(self._id_to_delta.pop(merchant_id))
+                    updated += 1
+                else:
+                    inserted += 1
+                
+                delta_id = self._next_delta_id
+                self._next_delta_id += 1
+                vec = np.asarray(vec, dtype='float32').reshape(1, -1)
+                self.delta_index.add_with_ids(vec, np.array([delta_id], dtype='int64'))
+                self.delta_metadata[delta_id] = dict(doc)
+                self.delta_vectors[delta_id] = vec[0]
+                self._id_to_delta[merchant_id] = delta_id
+            self.tombstones = frozenset(tombstones)
+        return {"inserted": inserted, "updated": updated}
+    
+    def delete(self, merchant_ids: List[str]) -> Dict[str, Any]:
+        """删除商户：base 行打墓碑，delta 段直接移除"""
+        with self._delta_lock:
+            self._ensure_id_map()
+            tombstones = set(self.tombstones)
+            deleted, not_found = 0, []
+            for merchant_id in map(str, merchant_ids):
+                if merchant_id in self._id_to_row:
+                    tombstones.add(self._id_to_row.pop(merchant_id))
+                    deleted += 1
+                elif merchant_id in self._id_to_delta:
+                    self._remove_delta(self._id_to_delta.pop(merchant_id))
+                    deleted += 1
+                else:
+                    not_found.append(merchant_id)
+            self.tombstones = frozenset(tombstones)
+        return {"deleted": deleted, "not_found": not_found}
+    
+    def _remove_delta(self, delta_id: int):
+        self.delta_index.remove_ids(np.array([delta_id], dtype='int64'))
+        self.delta_metadata.pop(delta_id, None)
+        self.delta_vectors.pop(delta_id, None)
+    
+    def search(self, query_vec: np.ndarray, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """检索 base + delta 两段，过滤墓碑后按相似度从高到低返回 (score, metadata)（L2 距离升序、内积降序）"""
+        return self.search_batch(query_vec, [k])[0]
+    
+    def search_batch(self, query_mat: np.ndarray, ks: List[int]) -> List[List[Tuple[float, Dict[str, Any]]]]:
+        """一次 FAISS 调用检索多个查询向量（按最大的 k 检索），再按各自的 k 截断"""
+        tombstones = self.tombstones
+        k_max = max(ks)
+        results: List[List[Tuple[float, Dict[str, Any]]]] = [[] for _ in ks]
+        
+        # base 段：多取墓碑数量的候选，保证过滤后仍有 k 个
+        fetch_k = min(k_max + len(tombstones), self.index.ntotal)
+        if fetch_k > 0:
+            with self._gpu_lock:
+                distances, indices = self.index.search(query_mat, fetch_k)
+            for hits, k, row_ids, row_dists in zip(results, ks, indices, distances):
+                for idx, dist in zip(row_ids, row_dists):
+                    if 0 <= idx < len(self.metadata) and int(idx) not in tombstones:
+                        hits.append((float(dist), self.metadata[idx]))
+                        if len(hits) >= k:
+                            break
+        
+        # delta 段
+        if self.delta_metadata:
+            with self._delta_lock:
+                delta_k = min(k_max, self.delta_index.ntotal)
+                if delta_k > 0:
+                    distances, indices = self.delta_index.search(query_mat, delta_k)
+                    for i, (k, row_ids, row_dists) in enumerate(zip(ks, indices, distances)):
+                        delta_hits = [
+                            (float(dist), self.delta_metadata[int(idx)])
+                            for idx, dist in zip(row_ids[:k], row_dists[:k])
+                            if int(idx) in self.delta_metadata
+                        ]
+                        results[i] = list(heapq.merge(results[i], delta_hits, key=self.hit_key))[:k]
+        
+        return results
+    
+    def area_rows(self) -> Dict[str, np.ndarray]:
+        """district / business_area / landmark 取值 -> 含该取值的 base 行号（首次调用时扫描一遍元数据）"""
+        if self._area_rows is None:
+            with self._area_lock:
+                if self._area_rows is None:
+                    rows = defaultdict(list)
+                    for row, doc in enumerate(self.metadata):
+                        for value in set(_area_values(doc)):
+                            rows[value].append(row)
+                    self._area_rows = {value: np.asarray(r, dtype='int64') for value, r in rows.items()}
+        return self._area_rows
+    
+    def search_in_areas(self, query_vec: np.ndarray, k: int, areas: List[str],
+                        open_slot: Optional[int] = None) -> Optional[List[Tuple[float, Dict[str, Any]]]]:
+        """只在 areas 内的商户中检索（base 段用区域倒排做 ID 过滤，delta 段按元数据过滤）
+        
+        该城市没有这些区域、或索引不支持过滤检索时返回 None，由调用方退回普通检索
+        """
+        area_rows = self.area_rows()
+        row_sets = [area_rows[area] for area in areas if area in area_rows]
+        if not row_sets and not self.delta_metadata:
+            return None
+        wanted = set(areas)
+        rows = np.unique(np.concatenate(row_sets)) if row_sets else np.empty(0, dtype='int64')
+        try:
+            hits = self._search_filtered(query_vec, k, rows, lambda doc: bool(wanted & set(_area_values(doc))), open_slot)
+        except Exception as e:
+            logger.warning(f"⚠️  {self.city}: area-filtered search unsupported by this index ({e}), searching unfiltered")
+            return None
+        return hits if row_sets or hits else None
+    
+    def geo_index(self) -> "GeoIndex":
+        """商户坐标的网格空间索引（首次调用时构建）"""
+        if self._geo_index is None:
+            with self._area_lock:
+                if self._geo_index is None:
+                    self._geo_index = GeoIndex(self.metadata)
+        return self._geo_index
+    
+    def search_near(self, query_vec: np.ndarray, k: int, near: Tuple[float, float, float],
+                    open_slot: Optional[int] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """只在 (lat, lng, radius_m) 范围内的商户中检索，结果带 distance_m / geo_precision 字段"""
+        geo = self.geo_index()
+        lat, lng, radius_m = near
+        rows = geo.query(lat, lng, radius_m)
+        
+        def _within(doc: Dict[str, Any]) -> bool:
+            located = geo.distance_to(lat, lng, doc)
+            return located is not None and located[0] <= radius_m
+        
+        hits = self._search_filtered(query_vec, k, rows, _within, open_slot)
+        return [(dist, {**doc, **geo.distance_fields(lat, lng, doc)}) for dist, doc in hits]
+    
+    def hours_index(self) -> "OpeningHours":
+        """商户营业时间位图（首次调用时解析全部 business_hours）"""
+        if self._hours is None:
+            with self._area_lock:
+                if self._hours is None:
+                    self._hours = OpeningHours(self.metadata)
+        return self._hours
+    
+    def search_open(self, query_vec: np.ndarray, k: int, open_slot: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """只在 open_slot 时段可能营业的商户中检索（营业时间未知的商户保留）"""
+        hours = self.hours_index()
+        mask = hours.open_mask(open_slot)
+        keep = lambda doc: OpeningHours.doc_open(doc, open_slot) is not False
+        if mask.all():
+            # base 段没有确定关门的商户：普通检索，只需过滤 delta 段
+            fetch_k = k * OPEN_FILTER_OVERFETCH if self.delta_metadata else k
+        else:
+            try:
+                return self._search_filtered(query_vec, k, np.flatnonzero(mask), keep)
+            except Exception as e:
+                logger.warning(f"⚠️  {self.city}: open-hours filtered search unsupported by this index ({e}), over-fetching")
+            fetch_k = k * OPEN_FILTER_OVERFETCH
+        return [hit for hit in self.search(query_vec, fetch_k) if keep(hit[1])][:k]
+    
+    def _search_filtered(self, query_vec: np.ndarray, k: int, rows: np.ndarray,
+                         keep_delta: Callable[[Dict[str, Any]], bool],
+                         open_slot: Optional[int] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """base 段只在 rows 中检索，delta 段检索全部后用 keep_delta 过滤；按相似度从高到低返回 (score, metadata)
+        
+        指定 open_slot 时再排除该时段确定不营业的商户
+        """
+        if open_slot is not None:
+            rows = rows[self.hours_index().open_mask(open_slot)[rows]]
+            keep_area = keep_delta
+            keep_delta = lambda doc: keep_area(doc) and OpeningHours.doc_open(doc, open_slot) is not False
+        hits = []
+        tombstones = self.tombstones
+        if tombstones and len(rows):
+            rows = rows[~np.isin(rows, np.fromiter(tombstones, dtype='int64'))]
+        if len(rows):
+            distances, indices = self._search_rows(query_vec, min(k, len(rows)), rows)
+            hits = [(float(dist), self.metadata[idx]) for idx, dist in zip(indices, distances) if idx >= 0]
+        
+        # delta 段：商户数少，全部检索后过滤
+        if self.delta_metadata:
+            with self._delta_lock:
+                if self.delta_index.ntotal > 0:
+                    distances, indices = self.delta_index.search(query_vec, self.delta_index.ntotal)
+                    delta_hits = [
+                        (float(dist), self.delta_metadata[int(idx)])
+                        for idx, dist in zip(indices[0], distances[0])
+                        if int(idx) in self.delta_metadata and keep_delta(self.delta_metadata[int(idx)])
+                    ][:k]
+                    hits = list(heapq.merge(hits, delta_hits, key=self.hit_key))[:k]
+        return hits
+    
+    def _search_rows(self, query_vec: np.ndarray, k: int, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """在指定的 base 行中检索：优先 FAISS IDSelector，不支持时取出这些行的向量精确计算"""
+        try:
+            if len(rows) > FILTER_BITMAP_MIN_ROWS:
+                # 行数多（如营业中过滤）时用位图选择器，避免逐个插入哈希集合
+                mask = np.zeros(self.index.ntotal, dtype=bool)
+                mask[rows] = True
+                bitmap = np.packbits(mask, bitorder='little')
+                selector = faiss.IDSelectorBitmap(self.index.ntotal, faiss.swig_ptr(bitmap))
+            else:
+                selector = faiss.IDSelectorBatch(len(rows), faiss.swig_ptr(rows))
+            ivf = faiss.try_extract_index_ivf(self.index)
+            if ivf is not None:
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            with self._gpu_lock:
+                distances, indices = self.index.search(query_vec, k, params=params)
+            return distances[0], indices[0]
+        except (RuntimeError, TypeError, AttributeError):
+            # GPU 索引等不支持 SearchParameters：区域内商户通常不多，直接精确计算
+            if len(rows) > EXACT_FILTER_MAX_ROWS:
+                raise RuntimeError(f"{len(rows)} rows exceed the exact-search fallback limit")
+            with self._gpu_lock:
+                vectors = self.index.reconstruct_batch(rows)
+            if self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+                scores = vectors @ query_vec[0]
+                order = np.argsort(-scores)[:k]
+            else:
+                scores = ((vectors - query_vec[0]) ** 2).sum(axis=1)
+                order = np.argsort(scores)[:k]
+            return scores[order], rows[order]
+    
+    def snapshot_changes(self) -> Tuple[frozenset, List[Dict[str, Any]], Optional[np.ndarray]]:
+        """获取压缩所需的 (墓碑, delta 元数据, delta 向量) 快照"""
+        with self._delta_lock:
+            delta_ids = sorted(self.delta_metadata)
+            docs = [self.delta_metadata[i] for i in delta_ids]
+            vectors = np.vstack([self.delta_vectors[i] for i in delta_ids]) if delta_ids else None
+            return self.tombstones, docs, vectors
+    
+    @property
+    def refcount(self) -> int:
+        return self._refcount
+    
+    def acquire(self) -> "CityIndexHandle":
+        with self._lock:
+            self._refcount += 1
+        return self
+    
+    def release(self):
+        with self._lock:
+            self._refcount -= 1
+            should_free = self._retired and self._refcount == 0
+        if should_free:
+            self._free()
+    
+    def retire(self):
+        """标记为旧版本：没有在途请求时立即释放，否则由最后一个 release 释放"""
+        with self._lock:
+            self._retired = True
+            should_free = self._refcount == 0
+        if should_free:
+            self._free()
+    
+    def _free(self):
+        logger.info(f"♻️  {self.city}: released index version {self.version}")
+        self.index = None
+        self.metadata = None
+
+
+def _index_nbytes(index) -> int:
+    """估算 FAISS 索引的内存：向量数 × 每条编码字节数；无法获取编码大小时按 float32 原始向量计"""
+    try:
+        code_size = index.sa_code_size()
+    except (RuntimeError, AttributeError):
+        code_size = index.d * 4
+    return int(index.ntotal) * int(code_size)
+
+
 class CityVectorDB:
-    """管理所有城市的FAISS向量数据库（1028版本）"""
+    """管理所有城市的FAISS向量数据库（支持版本化目录与热切换）
+    
+    目录结构：
+        data_dir/
+        ├── manifest.json                                    # 每个城市当前生效的版本
+        ├── faiss_merchant_index_vllm_{city}_1028.faiss      # 旧的平铺布局（1028 版本）
+        ├── faiss_merchant_index_vllm_{city}_1028_metadata.json
+        └── versions/
+            └── {version}/
+                ├── faiss_merchant_index_vllm_{city}_{version}.faiss
+                └── faiss_merchant_index_vllm_{city}_{version}_metadata.json
+    
+    没有 manifest.json 时所有城市使用 default_version（默认 1028）。
+    index_version（--index-version）让启动时所有城市加载该版本，manifest 中按城市的记录保留不动。
     
-    def __init__(self, data_dir: str, use_gpu: bool = True):
+    shared=True（多进程模式）：索引以 mmap 只读方式打开、元数据使用 SharedMetadata，
+    各工作进程共享同一份页缓存；增量更新被禁用，热更新通过 manifest.json 在进程间同步。
+    """
+    
+    DEFAULT_INDEX_VERSION = "1028"
+    # 版本名只作为 versions/ 下的单级目录名和文件名后缀，不允许路径分隔符或以 "." 开头（"..")
+    VERSION_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+    
+    def __init__(self, data_dir: str, use_gpu: bool = True, index_version: Optional[str] = None, shared: bool = False):
         self.data_dir = data_dir
-        self.use_gpu = use_gpu and torch.cuda.is_available()
+        self.shared = shared
+        # mmap 的只读索引留在 CPU 上，由各工作进程共享
+        self.use_gpu = use_gpu and not shared and torch.cuda.is_available()
         # 城市映射：中文 -> 英文（用于文件名）
         self.city_to_en = {
             "上海": "shanghai",
@@ -119,9 +654,27 @@ class CityVectorDB:
             "重庆": "chongqing",
             "武汉": "wuhan"
         }
-        self.indexes = {}  # key 为中文城市名
-        self.metadata = {}  # key 为中文城市名
+        self._handles: Dict[str, CityIndexHandle] = {}  # key 为中文城市名
+        self._lock = threading.Lock()
+        # 每个城市的写锁：串行化 upsert/delete/压缩/热切换（检索不受影响）
+        self._update_locks = {city: threading.Lock() for city in self.city_to_en}
+        self._compactor_stop = threading.Event()
+        self._manifest_watcher_stop = threading.Event()
+        self._gpu_lock = threading.Lock()  # 串行化所有使用 gpu_resources 的调用（检索、CPU/GPU 间拷贝）
+        self.keep_compacted_versions = 3  # 每个城市保留的压缩版本数（可回滚），更旧的在压缩后删除
         self.gpu_resources = None
+        # 多城市并发检索线程池（FAISS search 会释放 GIL）
+        self._search_executor = ObservedExecutor(
+            max_workers=len(self.city_to_en), thread_name_prefix="faiss-city"
+        )
+        
+        # 版本清单与热更新任务
+        self.manifest_path = os.path.join(data_dir, "manifest.json")
+        self.index_version = index_version
+        self.manifest = self._read_manifest()
+        self.reload_jobs: Dict[str, Dict[str, Any]] = {}
+        self._reload_lock = threading.Lock()  # 同一时间只运行一个热更新任务
+        self.jobs_dir: Optional[str] = None  # 多进程模式：任务状态写入各工作进程共享的目录（见 share_reload_jobs）
         
         # 初始化 GPU 资源
         # 注意：GPU 兼容性检查应该在启动脚本中完成（start_rag_server.sh）
@@ -129,57 +682,529 @@ class CityVectorDB:
         if self.use_gpu:
             try:
                 self.gpu_resources = faiss.StandardGpuResources()
-                print(f"🚀 GPU resources initialized for FAISS")
+                logger.info(f"🚀 GPU resources initialized for FAISS")
             except Exception as e:
-                print(f"⚠️  Failed to initialize GPU resources: {e}")
-                print(f"⚠️  Falling back to CPU mode")
+                logger.warning(f"⚠️  Failed to initialize GPU resources: {e}")
+                logger.warning(f"⚠️  Falling back to CPU mode")
                 self.use_gpu = False
                 self.gpu_resources = None
         
         self.load_all_cities()
     
+    @property
+    def indexes(self) -> Dict[str, Any]:
+        """当前生效版本的索引（key 为中文城市名）"""
+        with self._lock:
+            return {city: handle.index for city, handle in self._handles.items()}
+    
+    @property
+    def metadata(self) -> Dict[str, List[Dict[str, Any]]]:
+        """当前生效版本的元数据（key 为中文城市名）"""
+        with self._lock:
+            return {city: handle.metadata for city, handle in self._handles.items()}
+    
+    @property
+    def versions(self) -> Dict[str, str]:
+        """每个城市当前生效的索引版本"""
+        with self._lock:
+            return {city: handle.version for city, handle in self._handles.items()}
+    
+    @property
+    def nbytes(self) -> int:
+        """各城市当前版本索引的估算内存（字节）"""
+        return sum(_index_nbytes(index) for index in self.indexes.values())
+    
+    # ---------- 版本清单 ----------
+    
+    def _read_manifest(self) -> Dict[str, Any]:
+        """读取 manifest.json"""
+        manifest = {"default_version": self.DEFAULT_INDEX_VERSION, "cities": {}}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest.update(json.load(f))
+                logger.info(f"📒 Index manifest loaded: {self.manifest_path}")
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to read index manifest {self.manifest_path}: {e}")
+        return manifest
+    
+    def _write_manifest(self):
+        """原子写入 manifest.json（先写临时文件再 rename）"""
+        self.manifest["updated_at"] = datetime.now().isoformat()
+        tmp_path = f"{self.manifest_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        except Exception as e:
+            logger.warning(f"⚠️  Failed to write index manifest: {e}")
+    
+    @property
+    def default_version(self) -> str:
+        """启动时加载的默认版本：--index-version 优先，否则为 manifest 中的 default_version"""
+        return self.index_version or self.manifest["default_version"]
+    
+    def version_for(self, city_cn: str) -> str:
+        """启动时某个城市要加载的版本"""
+        if self.index_version:
+            return self.index_version
+        city_en = self.city_to_en[city_cn]
+        return self.manifest["cities"].get(city_en, self.manifest["default_version"])
+    
+    def check_version(self, version: str):
+        """校验版本名（来自请求或 manifest），防止拼出 data_dir 之外的路径"""
+        if not isinstance(version, str) or not self.VERSION_PATTERN.match(version):
+            raise ValueError(f"Invalid index version {version!r}: only letters, digits, '.', '_' and '-' are allowed")
+    
+    def index_paths(self, city_en: str, version: str) -> Tuple[str, str]:
+        """返回 (faiss 文件, 元数据文件) 路径；优先 versions/{version}/，否则回退到平铺布局"""
+        self.check_version(version)
+        filename = f"faiss_merchant_index_vllm_{city_en}_{version}"
+        version_dir = os.path.join(self.data_dir, "versions", version)
+        base_dir = version_dir if os.path.isdir(version_dir) else self.data_dir
+        return (
+            os.path.join(base_dir, f"{filename}.faiss"),
+            os.path.join(base_dir, f"{filename}_metadata.json"),
+        )
+    
+    def list_versions(self) -> List[str]:
+        """列出磁盘上可用的索引版本"""
+        found = set()
+        versions_dir = os.path.join(self.data_dir, "versions")
+        if os.path.isdir(versions_dir):
+            found.update(name for name in os.listdir(versions_dir)
+                         if os.path.isdir(os.path.join(versions_dir, name)))
+        # 平铺布局中的旧版本
+        if os.path.isdir(self.data_dir):
+            for name in os.listdir(self.data_dir):
+                if name.startswith("faiss_merchant_index_vllm_") and name.endswith(".faiss"):
+                    found.add(name[:-len(".faiss")].rsplit("_", 1)[-1])
+        return sorted(found)
+    
+    # ---------- 加载与热切换 ----------
+    
+    def _load_city(self, city_cn: str, version: str) -> CityIndexHandle:
+        """加载某个城市的某一版本（不影响当前生效版本）"""
+        city_en = self.city_to_en[city_cn]
+        index_path, meta_path = self.index_paths(city_en, version)
+        if not os.path.exists(index_path) or not os.path.exists(meta_path):
+            raise FileNotFoundError(f"{city_cn}: files for version {version} not found")
+        
+        # 加载 FAISS 索引 (先加载到CPU)
+        # build_compressed_index.py 生成的压缩索引带 IndexPreTransform，查询投影由 FAISS 在检索时完成
+        cpu_index = self._read_index_shared(index_path) if self.shared else faiss.read_index(index_path)
+        index = cpu_index
+        device_tag = "💻 CPU"
+        
+        # 如果启用GPU，将索引转移到GPU
+        if self.use_gpu:
+            try:
+                with self._gpu_lock:
+                    index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, cpu_index)
+                device_tag = "🚀 GPU"
+            except Exception as e:
+                logger.warning(f"⚠️  {city_cn}: GPU transfer failed ({e}), using CPU")
+        
+        if self.shared:
+            metadata = SharedMetadata.open(meta_path)
+        else:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+        
+        return CityIndexHandle(city_cn, version, index, metadata, device_tag, self._gpu_lock)
+    
+    def _read_index_shared(self, index_path: str):
+        """以 mmap 只读方式打开索引；当前 FAISS 版本或索引类型不支持时退回普通读取"""
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", None) or getattr(faiss, "IO_FLAG_MMAP", 0)
+        try:
+            return faiss.read_index(index_path, flags | getattr(faiss, "IO_FLAG_READ_ONLY", 0))
+        except Exception as e:
+            logger.warning(f"⚠️  mmap not supported for {os.path.basename(index_path)} ({e}), loading a private copy")
+            return faiss.read_index(index_path)
+    
     def load_all_cities(self):
         """加载所有城市的向量数据库"""
         device_info = "GPU" if self.use_gpu else "CPU"
-        print(f"\n📦 Loading vector databases from: {self.data_dir}")
-        print(f"💻 Device: {device_info}")
+        logger.info(f"📦 Loading vector databases from: {self.data_dir}")
+        logger.info(f"💻 Device: {device_info}")
         
-        for city_cn, city_en in self.city_to_en.items():
+        for city_cn in self.city_to_en:
+            version = self.version_for(city_cn)
             try:
-                # 加载 1028 版本的数据（文件名使用英文）
-                index_path = os.path.join(self.data_dir, f"faiss_merchant_index_vllm_{city_en}_1028.faiss")
-                meta_path = os.path.join(self.data_dir, f"faiss_merchant_index_vllm_{city_en}_1028_metadata.json")
-                
-                if not os.path.exists(index_path) or not os.path.exists(meta_path):
-                    print(f"⚠️  {city_cn}: Files not found")
+                handle = self._load_city(city_cn, version)
+            except FileNotFoundError:
+                logger.warning(f"⚠️  {city_cn}: Files not found (version {version})")
+                continue
+            except Exception as e:
+                logger.error(f"❌ Failed to load {city_cn}: {e}")
+                continue
+            
+            with self._lock:
+                self._handles[city_cn] = handle
+            logger.info(f"✅ {city_cn}: {handle.index.ntotal} vectors, {len(handle.metadata)} merchants "
+                  f"[{handle.device_tag}] (version {version})")
+        
+        logger.info(f"🎉 Loaded {len(self._handles)}/{len(self.city_to_en)} cities successfully on {device_info}!")
+    
+    def _install_handle(self, city_cn: str, new_handle: CityIndexHandle, write_manifest: bool = True,
+                        compacted: bool = False) -> Dict[str, Any]:
+        """原子替换当前版本并更新 manifest；旧版本在在途请求结束后释放
+        
+        compacted=True 表示新版本由旧版本的增量压缩而来，旧版本的增量并未丢弃。
+        """
+        with self._lock:
+            old_handle = self._handles.get(city_cn)
+            self._handles[city_cn] = new_handle
+            self.manifest["cities"][self.city_to_en[city_cn]] = new_handle.version
+        if write_manifest:
+            self._write_manifest()
+        
+        old_version = old_handle.version if old_handle else None
+        if old_handle is not None:
+            if old_handle.pending_changes and old_handle.version != new_handle.version and not compacted:
+                logger.warning(f"⚠️  {city_cn}: discarding {old_handle.pending_changes} uncompacted incremental changes")
+            old_handle.retire()
+        logger.info(f"🔁 {city_cn}: swapped index {old_version} → {new_handle.version} ({new_handle.index.ntotal} vectors)")
+        return {"city": city_cn, "old_version": old_version, "new_version": new_handle.version,
+                "vectors": new_handle.index.ntotal}
+    
+    def swap_city(self, city_cn: str, version: str, write_manifest: bool = True) -> Dict[str, Any]:
+        """加载新版本并原子替换当前版本"""
+        with self._update_locks[city_cn]:
+            return self._install_handle(city_cn, self._load_city(city_cn, version), write_manifest)
+    
+    def start_manifest_watcher(self, interval_s: float = 5.0):
+        """多进程模式：某个工作进程热更新后会改写 manifest.json，其他进程据此跟随切换
+        
+        跟随切换时不回写 manifest，避免多个进程用各自的旧副本互相覆盖。
+        """
+        def _mtime() -> Optional[float]:
+            try:
+                return os.path.getmtime(self.manifest_path)
+            except OSError:
+                return None
+        
+        def _loop():
+            last_mtime = _mtime()
+            with self._lock:
+                last_cities = dict(self.manifest["cities"])
+            while not self._manifest_watcher_stop.wait(interval_s):
+                mtime = _mtime()
+                if mtime is None or mtime == last_mtime:
                     continue
-                
-                # 加载 FAISS 索引 (先加载到CPU)
-                cpu_index = faiss.read_index(index_path)
-                
-                # 如果启用GPU，将索引转移到GPU
-                if self.use_gpu:
+                last_mtime = mtime
+                manifest = self._read_manifest()
+                # 只跟随发生变化的城市记录；--index-version 启动时未变化的旧记录不应覆盖它
+                changed = {city_en: version for city_en, version in manifest["cities"].items()
+                           if last_cities.get(city_en) != version}
+                last_cities = dict(manifest["cities"])
+                for city_cn, city_en in self.city_to_en.items():
+                    version = changed.get(city_en)
+                    with self._lock:
+                        handle = self._handles.get(city_cn)
+                    if version is None or handle is None or handle.version == version:
+                        continue
                     try:
-                        # 将CPU索引转换为GPU索引（使用中文作为 key）
-                        self.indexes[city_cn] = faiss.index_cpu_to_gpu(self.gpu_resources, 0, cpu_index)
-                        device_tag = "🚀 GPU"
+                        self.swap_city(city_cn, version, write_manifest=False)
                     except Exception as e:
-                        print(f"⚠️  {city_cn}: GPU transfer failed ({e}), using CPU")
-                        self.indexes[city_cn] = cpu_index
-                        device_tag = "💻 CPU"
-                else:
-                    self.indexes[city_cn] = cpu_index
-                    device_tag = "💻 CPU"
-                
-                # 加载元数据（使用中文作为 key）
-                with open(meta_path, "r", encoding="utf-8") as f:
-                    self.metadata[city_cn] = json.load(f)
-                
-                print(f"✅ {city_cn}: {self.indexes[city_cn].ntotal} vectors, {len(self.metadata[city_cn])} merchants [{device_tag}]")
+                        logger.error(f"❌ {city_cn}: failed to follow manifest to version {version}: {e}")
+        
+        threading.Thread(target=_loop, name="manifest-watcher", daemon=True).start()
+    
+    # ---------- 增量更新与压缩 ----------
+    
+    def _current_handle(self, city_cn: str) -> CityIndexHandle:
+        with self._lock:
+            if city_cn not in self._handles:
+                raise ValueError(f"City '{city_cn}' not loaded. Available cities: {list(self._handles.keys())}")
+            return self._handles[city_cn]
+    
+    def upsert_merchants(self, city_cn: str, docs: List[Dict[str, Any]], vectors: np.ndarray) -> Dict[str, Any]:
+        """写入新增/修改的商户（只需这些商户的向量）"""
+        with self._update_locks[city_cn]:
+            handle = self._current_handle(city_cn)
+            if vectors.ndim != 2 or vectors.shape[1] != handle.index.d:
+                raise ValueError(f"{city_cn}: embedding dimension {vectors.shape[-1]} does not match "
+                                 f"the index dimension {handle.index.d} (version {handle.version})")
+            result = handle.upsert(docs, vectors)
+        result["pending_changes"] = handle.pending_changes
+        return result
+    
+    def delete_merchants(self, city_cn: str, merchant_ids: List[str]) -> Dict[str, Any]:
+        """删除商户（打墓碑，检索时过滤）"""
+        with self._update_locks[city_cn]:
+            handle = self._current_handle(city_cn)
+            result = handle.delete(merchant_ids)
+        result["pending_changes"] = handle.pending_changes
+        return result
+    
+    def compact_city(self, city_cn: str, persist: bool = True) -> Optional[Dict[str, Any]]:
+        """将 delta 段和墓碑合并进 base 段，生成新版本并原子切换
+        
+        持有城市写锁期间不接受新的增量写入，但检索照常使用旧版本。
+        persist=True 时新版本写入 versions/{version}/ 并记录到 manifest，重启后仍然生效，
+        同一城市只保留最近 keep_compacted_versions 个压缩版本。
+        
+        压缩要从 base 段取回向量后重建索引，PQ/SQ 等有损编码或带预变换的索引取回的只是近似值，
+        反复压缩会逐步损失精度，因此拒绝压缩（抛出 ValueError），应离线重建后热切换。
+        """
+        with self._update_locks[city_cn]:
+            handle = self._current_handle(city_cn)
+            if not handle.pending_changes:
+                return None
+            
+            start = time.time()
+            tombstones, delta_docs, delta_vectors = handle.snapshot_changes()
+            
+            if self.use_gpu and handle.device_tag == "🚀 GPU":
+                with self._gpu_lock:
+                    cpu_index = faiss.index_gpu_to_cpu(handle.index)
+            else:
+                cpu_index = handle.index
+            lossy_type = self._lossy_index_type(cpu_index)
+            if lossy_type:
+                raise ValueError(f"{city_cn}: cannot compact a {lossy_type} index without losing precision; "
+                                 f"rebuild it offline and switch with /admin/indexes/reload")
+            if hasattr(cpu_index, "make_direct_map"):
+                cpu_index.make_direct_map()
+            base_vectors = cpu_index.reconstruct_n(0, cpu_index.ntotal)
+            keep = np.ones(cpu_index.ntotal, dtype=bool)
+            if tombstones:
+                keep[np.fromiter(tombstones, dtype='int64')] = False
+            
+            vectors = base_vectors[keep]
+            metadata = [doc for row, doc in enumerate(handle.metadata) if keep[row]]
+            if delta_vectors is not None:
+                vectors = np.vstack([vectors, delta_vectors])
+                metadata.extend(delta_docs)
+            
+            # 复用原索引结构（含训练参数），只重新写入向量
+            new_cpu_index = faiss.clone_index(cpu_index)
+            new_cpu_index.reset()
+            new_cpu_index.add(np.ascontiguousarray(vectors, dtype='float32'))
+            
+            base_version = handle.version.split("-c")[0]
+            new_version = f"{base_version}-c{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            if persist:
+                self._write_version(city_cn, new_version, new_cpu_index, metadata)
+            
+            new_index, device_tag = new_cpu_index, "💻 CPU"
+            if self.use_gpu:
+                try:
+                    with self._gpu_lock:
+                        new_index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, new_cpu_index)
+                    device_tag = "🚀 GPU"
+                except Exception as e:
+                    logger.warning(f"⚠️  {city_cn}: GPU transfer failed ({e}), using CPU")
+            
+            new_handle = CityIndexHandle(city_cn, new_version, new_index, metadata, device_tag, self._gpu_lock)
+            result = self._install_handle(city_cn, new_handle, compacted=True)
+            if persist:
+                self._gc_compacted_versions(city_cn, base_version)
+            result.update({
+                "removed": len(tombstones),
+                "merged": len(delta_docs),
+                "compaction_time_s": round(time.time() - start, 3),
+            })
+            logger.info(f"🗜️  {city_cn}: compacted {len(delta_docs)} upserts / {len(tombstones)} tombstones "
+                  f"in {result['compaction_time_s']:.2f}s")
+            return result
+    
+    @staticmethod
+    def _lossy_index_type(index) -> Optional[str]:
+        """索引的编码不能无损取回原始向量时返回其类型名（Flat / IVFFlat / HNSWFlat 为无损）"""
+        index = faiss.downcast_index(index)
+        if isinstance(index, faiss.IndexIDMap):
+            return CityVectorDB._lossy_index_type(index.index)
+        if isinstance(index, faiss.IndexHNSW):
+            return CityVectorDB._lossy_index_type(index.storage)
+        if isinstance(index, (faiss.IndexFlat, faiss.IndexIVFFlat)):
+            return None
+        return type(index).__name__
+    
+    def _gc_compacted_versions(self, city_cn: str, base_version: str):
+        """删除该城市较旧的压缩版本文件（{base}-c{时间戳}），正在使用或 manifest 中记录的版本不删"""
+        versions_dir = os.path.join(self.data_dir, "versions")
+        city_en = self.city_to_en[city_cn]
+        compacted = sorted(
+            version for version in os.listdir(versions_dir)
+            if version.startswith(f"{base_version}-c") and self.VERSION_PATTERN.match(version)
+            and os.path.exists(self.index_paths(city_en, version)[0])
+        )
+        with self._lock:
+            in_use = {self._handles[city_cn].version, self.manifest["cities"].get(city_en)}
+        for version in compacted[:-self.keep_compacted_versions]:
+            if version in in_use:
+                continue
+            try:
+                for path in self.index_paths(city_en, version):
+                    if os.path.exists(path):
+                        os.remove(path)
+                if not os.listdir(os.path.join(versions_dir, version)):
+                    os.rmdir(os.path.join(versions_dir, version))
+                logger.info(f"🧹 {city_cn}: removed old compacted version {version}")
+            except OSError as e:
+                logger.warning(f"⚠️  {city_cn}: failed to remove compacted version {version}: {e}")
+    
+    def _write_version(self, city_cn: str, version: str, cpu_index, metadata: List[Dict[str, Any]]):
+        """将索引和元数据写入 versions/{version}/"""
+        city_en = self.city_to_en[city_cn]
+        os.makedirs(os.path.join(self.data_dir, "versions", version), exist_ok=True)
+        index_path, meta_path = self.index_paths(city_en, version)
+        faiss.write_index(cpu_index, index_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+    
+    def start_compactor(self, interval_s: float = 600.0, min_changes: int = 1, keep_versions: Optional[int] = None):
+        """后台定期压缩：每 interval_s 秒检查一次，变更数 >= min_changes 的城市执行压缩"""
+        if keep_versions is not None:
+            self.keep_compacted_versions = max(1, keep_versions)
+        
+        def _loop():
+            unsupported = set()  # 索引类型不支持压缩的城市，只提示一次
+            while not self._compactor_stop.wait(interval_s):
+                for city_cn in list(self.indexes.keys()):
+                    try:
+                        handle = self._current_handle(city_cn)
+                        if handle.pending_changes >= min_changes:
+                            self.compact_city(city_cn)
+                    except ValueError as e:
+                        if city_cn not in unsupported:
+                            unsupported.add(city_cn)
+                            logger.warning(f"⚠️  Skipping compaction: {e}")
+                    except Exception as e:
+                        logger.error(f"❌ Compaction failed for {city_cn}: {e}")
+        
+        threading.Thread(target=_loop, name="index-compactor", daemon=True).start()
+        logger.info(f"🗜️  Background compaction every {interval_s:.0f}s (min changes: {min_changes}, "
+                    f"keeping {self.keep_compacted_versions} compacted versions per city)")
+    
+    def stop_compactor(self):
+        self._compactor_stop.set()
+    
+    def stop_manifest_watcher(self):
+        self._manifest_watcher_stop.set()
+    
+    def close(self):
+        """释放检索线程池与各城市索引（注册表淘汰模型时连同其单独加载的索引一起释放）"""
+        self.stop_compactor()
+        self.stop_manifest_watcher()
+        self._search_executor.shutdown(wait=False)
+        with self._lock:
+            handles, self._handles = list(self._handles.values()), {}
+        for handle in handles:
+            handle.retire()
+    
+    def reload(self, version: str, cities: List[str], job: Dict[str, Any]):
+        """逐个城市加载并切换，避免所有城市同时出现新旧两份内存"""
+        job["status"] = "running"
+        self._save_job(job)
+        for city_cn in cities:
+            try:
+                job["swapped"].append(self.swap_city(city_cn, version))
+            except FileNotFoundError as e:
+                job["skipped"].append({"city": city_cn, "reason": str(e)})
+            except Exception as e:
+                job["failed"].append({"city": city_cn, "error": str(e)})
+            self._save_job(job)
+        job["status"] = "failed" if job["failed"] and not job["swapped"] else "completed"
+        job["finished_at"] = datetime.now().isoformat()
+        self._save_job(job)
+    
+    def share_reload_jobs(self, jobs_dir: str):
+        """多进程模式：任务状态写入共享目录，任一工作进程都能查询；热更新在所有进程间互斥"""
+        os.makedirs(jobs_dir, mode=0o700, exist_ok=True)
+        self.jobs_dir = jobs_dir
+    
+    def _save_job(self, job: Dict[str, Any]):
+        if not self.jobs_dir:
+            return
+        path = os.path.join(self.jobs_dir, f"{job['job_id']}.json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️  Failed to persist reload job {job['job_id']}: {e}")
+    
+    def get_reload_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """本进程的任务直接返回；多进程模式下再到共享目录中查找其他进程发起的任务"""
+        job = self.reload_jobs.get(job_id)
+        if job is not None or not self.jobs_dir or not re.fullmatch(r"reload-[0-9a-f-]+", job_id):
+            return job
+        try:
+            with open(os.path.join(self.jobs_dir, f"{job_id}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def recent_reload_jobs(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """最近的热更新任务（多进程模式下包含所有工作进程的任务）"""
+        if not self.jobs_dir:
+            return list(self.reload_jobs.values())[-limit:]
+        try:
+            names = sorted(name[:-len(".json")] for name in os.listdir(self.jobs_dir) if name.endswith(".json"))
+        except OSError:
+            names = []
+        jobs = [self.get_reload_job(job_id) for job_id in names[-limit:]]
+        return [job for job in jobs if job is not None]
+    
+    def start_reload(self, version: str, cities: List[str]) -> Dict[str, Any]:
+        """在后台线程中执行热更新，立即返回任务信息"""
+        if not self._reload_lock.acquire(blocking=False):
+            raise RuntimeError("Another index reload is already running")
+        lock_file = None
+        if self.jobs_dir:
+            # 其他工作进程的热更新同样互斥（文件锁随进程退出自动释放）
+            lock_file = open(os.path.join(self.jobs_dir, "reload.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                self._reload_lock.release()
+                raise RuntimeError("Another index reload is already running in another worker")
+        
+        job_id = f"reload-{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{os.getpid():x}"
+        job = {
+            "job_id": job_id,
+            "version": version,
+            "cities": cities,
+            "status": "pending",
+            "swapped": [],
+            "skipped": [],
+            "failed": [],
+            "started_at": datetime.now().isoformat(),
+            "finished_at": None,
+        }
+        self.reload_jobs[job_id] = job
+        self._save_job(job)
+        
+        def _run():
+            try:
+                self.reload(version, cities, job)
             except Exception as e:
-                print(f"❌ Failed to load {city_cn}: {e}")
+                job["status"] = "failed"
+                job["failed"].append({"city": None, "error": str(e)})
+                self._save_job(job)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()  # 关闭即释放 flock
+                self._reload_lock.release()
         
-        print(f"\n🎉 Loaded {len(self.indexes)}/{len(self.city_to_en)} cities successfully on {device_info}!\n")
+        threading.Thread(target=_run, name=job_id, daemon=True).start()
+        return job
+    
+    @contextmanager
+    def acquire(self, cities: List[str]):
+        """固定请求期间使用的索引版本（引用计数 +1），结束后释放"""
+        with self._lock:
+            handles = {city: self._handles[city].acquire() for city in cities if city in self._handles}
+        try:
+            yield handles
+        finally:
+            for handle in handles.values():
+                handle.release()
     
     def search(self, query_embedding: np.ndarray, city: str = "上海", top_k: int = 20):
         """在指定城市的向量数据库中搜索
@@ -189,23 +1214,171 @@ class CityVectorDB:
             city: 城市名（中文），如 "上海"、"北京"
             top_k: 返回结果数量
         """
-        if city not in self.indexes:
-            raise ValueError(f"City '{city}' not loaded. Available cities: {list(self.indexes.keys())}")
+        with self.acquire([city]) as handles:
+            if city not in handles:
+                raise ValueError(f"City '{city}' not loaded. Available cities: {list(self.indexes.keys())}")
+            # 使用 FAISS 进行向量检索（base + delta 段，过滤墓碑）
+            query_vec = query_embedding.reshape(1, -1).astype('float32')
+            results = []
+            for dist, doc in handles[city].search(query_vec, top_k):
+                merchant = doc.copy()
+                merchant["vector_score"] = dist
+                results.append(merchant)
+        
+        return results
+    
+    def resolve_cities(self, cities: Union[List[str], str, None], default_city: str = "上海") -> List[str]:
+        """将请求中的城市参数解析为已加载的中文城市列表
+        
+        Args:
+            cities: 城市列表、"all"（全部已加载城市）或 None（使用 default_city）
+            default_city: 未指定 cities 时使用的单个城市
+        """
+        if cities is None:
+            return [default_city]
+        if isinstance(cities, str):
+            if cities.strip().lower() == "all":
+                return list(self.indexes.keys())
+            cities = [cities]
         
-        # 使用 FAISS 进行向量检索
+        resolved = []
+        for city in cities:
+            city = city.strip()
+            if city.lower() == "all":
+                return list(self.indexes.keys())
+            if city and city not in resolved:
+                resolved.append(city)
+        return resolved
+    
+    def search_cities(self, query_embedding: np.ndarray, cities: List[str], top_k: int = 20,
+                      areas: Optional[Dict[str, List[str]]] = None, near: Optional[Tuple[float, float, float]] = None,
+                      open_slot: Optional[int] = None):
+        """在多个城市的向量数据库中并发检索，并用全局堆合并候选
+        
+        每个城市返回按相似度从高到低排列的 top_k 候选（L2 距离升序、内积降序），再通过 heapq.merge 做 k 路归并，
+        得到跨城市的全局 top_k。每条结果带有 source_city 字段标明来源城市。
+        检索期间持有各城市索引版本的引用，热切换不会影响在途请求。
+        
+        Args:
+            query_embedding: 查询向量（只编码一次，所有城市共享）
+            cities: 城市名列表（中文）
+            top_k: 全局返回结果数量
+            areas: 城市 -> 区域取值列表；指定的城市只在这些区域的商户中检索（见 LocationParser）
+            near: (lat, lng, radius_m)；只在半径内的商户中检索（见 GeoIndex），优先于 areas
+            open_slot: 周时段编号（见 week_slot）；排除该时段确定不营业的商户（见 OpeningHours），可与 areas / near 叠加
+        """
         query_vec = query_embedding.reshape(1, -1).astype('float32')
-        distances, indices = self.indexes[city].search(query_vec, top_k)
         
-        # 获取对应的元数据
-        results = []
-        for idx, dist in zip(indices[0], distances[0]):
-            if idx < len(self.metadata[city]):
-                merchant = self.metadata[city][idx].copy()
-                merchant["vector_score"] = float(dist)
-                results.append(merchant)
+        with self.acquire(cities) as handles:
+            self._check_loaded(cities, handles)
+            
+            def _search_one(city: str):
+                handle = handles[city]
+                if near:
+                    return [(dist, city, doc) for dist, doc in handle.search_near(query_vec, top_k, near, open_slot)]
+                hits = None
+                if areas and areas.get(city):
+                    hits = handle.search_in_areas(query_vec, top_k, areas[city], open_slot)
+                if hits is None:
+                    hits = handle.search(query_vec, top_k) if open_slot is None else handle.search_open(query_vec, top_k, open_slot)
+                return [(dist, city, doc) for dist, doc in hits]
+            
+            if len(cities) == 1:
+                per_city_hits = [_search_one(cities[0])]
+            else:
+                per_city_hits = list(self._search_executor.map(_search_one, cities))
+            return self._merge_city_hits(per_city_hits, top_k, handles[cities[0]].hit_key)
+    
+    async def search_cities_async(self, query_embedding: np.ndarray, cities: List[str], top_k: int = 20,
+                                  areas: Optional[Dict[str, List[str]]] = None,
+                                  near: Optional[Tuple[float, float, float]] = None,
+                                  open_slot: Optional[int] = None):
+        """search_cities 的异步版本：各城市的检索与并发请求合批（SearchBatcher），不阻塞事件循环
+        
+        带区域 / 半径 / 营业时间过滤（areas / near / open_slot）的检索各请求的候选范围不同，不参与合批
+        """
+        if not search_batcher.enabled or areas or near or open_slot is not None:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.search_cities, query_embedding, cities, top_k, areas, near, open_slot)
         
+        query_vec = np.asarray(query_embedding, dtype='float32').reshape(-1)
+        with self.acquire(cities) as handles:
+            self._check_loaded(cities, handles)
+            # 按索引版本（handle）合批：热切换前后的请求不会混在同一批里
+            per_city = await asyncio.gather(*[
+                search_batcher.submit(handles[city], (query_vec, top_k), self.city_to_en.get(city, city))
+                for city in cities
+            ])
+            per_city_hits = [[(dist, city, doc) for dist, doc in hits] for city, hits in zip(cities, per_city)]
+            return self._merge_city_hits(per_city_hits, top_k, handles[cities[0]].hit_key)
+    
+    def locate_city(self, lat: float, lng: float) -> Optional[str]:
+        """坐标所在的城市：商户外包框包含该坐标的城市中，离商户质心最近的一个（会按需构建空间索引）"""
+        cities = list(self.indexes.keys())
+        best, best_distance = None, None
+        with self.acquire(cities) as handles:
+            for city, handle in handles.items():
+                geo = handle.geo_index()
+                if not geo.contains(lat, lng):
+                    continue
+                distance = float(haversine_m(lat, lng, *geo.centroid))
+                if best_distance is None or distance < best_distance:
+                    best, best_distance = city, distance
+        return best
+    
+    def warm_filters(self):
+        """预先构建各城市的区域倒排、空间索引和营业时间位图，避免首个带过滤的请求承担构建耗时"""
+        cities = list(self.indexes.keys())
+        with self.acquire(cities) as handles:
+            for city, handle in handles.items():
+                try:
+                    handle.area_rows()
+                    geo = handle.geo_index()
+                    logger.info(f"📌 {city}: geo index {geo.exact} exact + {geo.approximate} district-centroid merchants "
+                                f"in {len(geo.cell_keys)} cells ({geo.build_s:.2f}s)")
+                    hours = handle.hours_index()
+                    logger.info(f"🕒 {city}: opening hours parsed for {int(hours.known.sum())}/{len(hours.known)} merchants "
+                                f"({hours.build_s:.2f}s)")
+                except Exception as e:
+                    logger.warning(f"⚠️  {city}: failed to build filter indexes: {e}")
+    
+    def geo_stats(self) -> Dict[str, Any]:
+        """已构建的空间索引统计（key 为中文城市名）"""
+        with self._lock:
+            handles = dict(self._handles)
+        return {city: handle._geo_index.stats() for city, handle in handles.items() if handle._geo_index is not None}
+    
+    def hours_stats(self) -> Dict[str, Any]:
+        """已构建的营业时间位图统计（key 为中文城市名）"""
+        with self._lock:
+            handles = dict(self._handles)
+        return {city: handle._hours.stats() for city, handle in handles.items() if handle._hours is not None}
+    
+    def _check_loaded(self, cities: List[str], handles: Dict[str, CityIndexHandle]):
+        missing = [city for city in cities if city not in handles]
+        if missing:
+            raise ValueError(f"Cities {missing} not loaded. Available cities: {list(self.indexes.keys())}")
+    
+    @staticmethod
+    def _merge_city_hits(per_city_hits: List[List[Tuple[float, str, Dict[str, Any]]]], top_k: int,
+                         key: Callable[[Tuple], float]):
+        # 各城市结果已按 key 升序排列（同一检索的各城市索引使用同一 Embedding 模型与度量），k 路归并取全局 top_k
+        results = []
+        for dist, city, doc in heapq.merge(*per_city_hits, key=key):
+            merchant = doc.copy()
+            merchant["vector_score"] = dist
+            merchant["source_city"] = city
+            results.append(merchant)
+            if len(results) >= top_k:
+                break
         return results
 
+# ==================== 检索过滤索引 ====================
+# 地点解析（Aho-Corasick）、商户名前缀补全、附近检索的网格空间索引与营业时间位图见 filter_index.py
+
+location_parser = LocationParser()
+merchant_autocomplete = MerchantAutocomplete()
+
 # ==================== LLM 精排器 ====================
 
 class LLMRanker:
@@ -245,10 +1418,10 @@ class LLMRanker:
                     with open(cfg_path, "r", encoding="utf-8") as f:
                         return yaml.safe_load(f)
                 except Exception as e:
-                    print(f"⚠️ Failed to load config from {cfg_path}: {e}")
+                    logger.warning(f"⚠️ Failed to load config from {cfg_path}: {e}")
         
         # 如果找不到配置文件，返回默认配置
-        print("⚠️ No config file found, using default LLM config")
+        logger.warning("⚠️ No config file found, using default LLM config")
         return {}
     
     def _init_llm_config(self) -> Dict[str, Any]:
@@ -274,11 +1447,11 @@ class LLMRanker:
         
         if not api_keys:
             llm_config["enabled"] = False
-            print("⚠️ No API keys found, LLM ranking disabled")
+            logger.warning("⚠️ No API keys found, LLM ranking disabled")
         else:
             llm_config["api_keys"] = api_keys
             llm_config["enabled"] = True
-            print(f"✅ LLM ranking enabled with {len(api_keys)} API key(s)")
+            logger.info(f"✅ LLM ranking enabled with {len(api_keys)} API key(s)")
         
         return llm_config
     
@@ -310,11 +1483,11 @@ class LLMRanker:
             筛选后的商户列表
         """
         if not self.llm.get("enabled", False):
-            print("⚠️ LLM ranking disabled, returning top_k candidates as-is")
+            logger.debug("LLM ranking disabled, returning top_k candidates as-is")
             return candidates[:top_k]
         
         if len(candidates) <= top_k:
-            print(f"📋 Candidates count ({len(candidates)}) <= top_k ({top_k}), no LLM ranking needed")
+            logger.debug("Candidates within top_k, no LLM ranking needed", extra=_fields(candidates=len(candidates), top_k=top_k))
             return candidates
         
         try:
@@ -339,15 +1512,16 @@ class LLMRanker:
             # 如果 LLM 成功解析但选择了较少的商户（包括0个），尊重这个判断
             if len(selected_indices) > 0:
                 # LLM 成功返回了选择（即使少于 top_k）
-                print(f"✅ LLM selected {len(result)} merchants from {len(candidates)} candidates (requested: {top_k})")
+                logger.debug("LLM selection parsed", extra=_fields(selected=len(result), candidates=len(candidates), top_k=top_k))
                 return result if result else candidates[:min(1, len(candidates))]  # 至少返回1个，避免完全为空
             else:
                 # LLM 返回空列表，说明没有符合条件的，但为了保证用户体验，返回top 1
-                print(f"⚠️ LLM returned empty selection, returning top 1 candidate")
+                logger.warning("LLM returned empty selection, returning top 1 candidate")
                 return candidates[:min(1, len(candidates))]
                 
         except Exception as e:
-            print(f"❌ LLM ranking error: {e}, falling back to top_k")
+            logger.warning("LLM ranking error, falling back to top_k", extra=_fields(error=str(e)[:200]))
+            FALLBACKS.inc(stage="llm_ranking", reason="error")
             return candidates[:top_k]
     
     def _build_selection_prompt(
@@ -372,6 +1546,8 @@ class LLMRanker:
             tags = doc.get('tags', [])
             products = doc.get('products', '')
             hours = doc.get('business_hours', '')
+            if doc.get('open_now'):
+                hours = f"{hours}（查询时段营业中）"
             rerank_score = doc.get('rerank_score', 0)
             
             tags_str = ','.join(tags[:5]) if isinstance(tags, list) else str(tags)
@@ -510,34 +1686,48 @@ class LLMRanker:
                 "max_tokens": max_tokens,
             }
             
-            try:
-                timeout_cfg = aiohttp.ClientTimeout(total=timeout)
-                start_ts = time.time()
-                print(f"[LLM] Attempt {attempt+1}/{retries}, model={self.llm['model']}, prompt_len={len(prompt)}")
+            with tracer.span("llm.attempt", kind=SPAN_KIND_CLIENT, attempt=attempt + 1, model=self.llm["model"],
+                             prompt_len=len(prompt)) as span:
+                # 向 LLM 服务传播 trace context
+                headers["traceparent"] = span.traceparent
+                try:
+                    timeout_cfg = aiohttp.ClientTimeout(total=timeout)
+                    start_ts = time.time()
+                    logger.debug("LLM attempt", extra=_fields(attempt=attempt + 1, retries=retries,
+                                                              model=self.llm['model'], prompt_len=len(prompt)))
+                    if attempt > 0:
+                        LLM_RETRIES.inc(model=self.llm['model'])
                 
-                async with aiohttp.ClientSession(timeout=timeout_cfg) as session:
-                    async with session.post(url, headers=headers, json=body) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            content = data["choices"][0]["message"]["content"].strip()
-                            latency = (time.time() - start_ts) * 1000.0
-                            print(f"[LLM] Success: {resp.status}, latency={latency:.0f}ms")
-                            return content
-                        else:
-                            txt = await resp.text()
-                            last_err = f"{resp.status} {txt[:200]}"
-                            latency = (time.time() - start_ts) * 1000.0
-                            print(f"[LLM] Error: {resp.status}, latency={latency:.0f}ms, detail={last_err[:100]}")
+                    async with aiohttp.ClientSession(timeout=timeout_cfg) as session:
+                        async with session.post(url, headers=headers, json=body) as resp:
+                            span.set_attribute("http.status_code", resp.status)
+                            if resp.status == 200:
+                                data = await resp.json()
+                                content = data["choices"][0]["message"]["content"].strip()
+                                latency = (time.time() - start_ts) * 1000.0
+                                logger.debug("LLM success", extra=_fields(status=resp.status, latency_ms=round(latency)))
+                                return content
+                            else:
+                                txt = await resp.text()
+                                last_err = f"{resp.status} {txt[:200]}"
+                                span.set_error(last_err)
+                                latency = (time.time() - start_ts) * 1000.0
+                                logger.warning("LLM error response", extra=_fields(
+                                    attempt=attempt + 1, status=resp.status, latency_ms=round(latency), detail=last_err[:100]))
                             
-                            # 429 时退避
-                            if resp.status == 429 and attempt < retries - 1:
-                                backoff = 2 ** attempt
-                                await asyncio.sleep(backoff)
-                                continue
-            except Exception as e:
-                last_err = str(e)
-                latency = (time.time() - start_ts) * 1000.0
-                print(f"[LLM] Exception: latency={latency:.0f}ms, error={last_err[:100]}")
+                                # 429 时退避
+                                if resp.status == 429:
+                                    LLM_RATE_LIMITED.inc(model=self.llm['model'])
+                                if resp.status == 429 and attempt < retries - 1:
+                                    backoff = 2 ** attempt
+                                    await asyncio.sleep(backoff)
+                                    continue
+                except Exception as e:
+                    last_err = str(e)
+                    span.set_error(e)
+                    latency = (time.time() - start_ts) * 1000.0
+                    logger.warning("LLM request failed", extra=_fields(
+                        attempt=attempt + 1, latency_ms=round(latency), error=last_err[:100]))
             
             # 简单退避
             if attempt < retries - 1:
@@ -547,86 +1737,651 @@ class LLMRanker:
 
 # ==================== 模型加载（GPU）====================
 
+# CPU 推理后端：torch（FP32）、int8（动态量化 Linear 层）、onnx（ONNX Runtime）
+CPU_BACKENDS = ("torch", "int8", "onnx")
+
+# rerank 每次提交到线程池的 pair 数：请求被取消时最多再算完这一块
+RERANK_CHUNK_SIZE = 8
+
+# 启动预热使用的示例查询
+WARMUP_QUERIES = ["外滩附近的餐厅", "五道口火锅店", "南山区电影院", "春熙路咖啡店"]
+
+def configure_cpu_threads(num_threads: Optional[int]):
+    """固定 CPU 推理线程数，避免与 FAISS/其他 worker 争抢核心
+    
+    OMP_NUM_THREADS 在导入 numpy / torch 之前已按 --cpu-threads / RAG_CPU_THREADS 设置（见文件开头）；
+    这里设置的环境变量只影响之后启动的子进程
+    """
+    if not num_threads or num_threads <= 0:
+        return
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(max(1, num_threads // 2))
+    except RuntimeError:
+        # interop 线程数只能在并行任务开始前设置一次
+        pass
+    logger.info(f"🧵 CPU inference threads: {num_threads}")
+
+def configure_faiss_threads(num_threads: Optional[int]):
+    """固定 FAISS 的 OpenMP 线程数：每个检索批次最多使用 num_threads 个线程，
+    多个城市 / 多个工作进程同时检索时不会超额占用 CPU 核心"""
+    if not num_threads or num_threads <= 0:
+        return
+    faiss.omp_set_num_threads(num_threads)
+    logger.info(f"🧵 FAISS OpenMP threads: {num_threads}")
+
+def _quantize_dynamic_int8(module):
+    """对 Linear 层做 int8 动态量化（仅 CPU 有效）"""
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _load_onnx_model(model_cls, model_name: str):
+    """使用 sentence-transformers 的 ONNX 后端加载模型；不支持时返回 None"""
+    try:
+        return model_cls(model_name, device="cpu", backend="onnx")
+    except Exception as e:
+        logger.warning(f"⚠️  ONNX backend unavailable for {model_name} ({e}), falling back to int8")
+        return None
+
+def build_embedding_model(model_name: str, backend: str = "torch") -> Tuple[Any, str]:
+    """构建 Embedding 模型，返回 (模型, 实际后端)；ONNX 不可用时退回 int8"""
+    model = None
+    if backend == "onnx":
+        model = _load_onnx_model(SentenceTransformer, model_name)
+        if model is None:
+            backend = "int8"
+    if model is None:
+        model = SentenceTransformer(model_name, device=DEVICE)
+    if backend == "int8" and DEVICE == "cpu":
+        model = _quantize_dynamic_int8(model)
+    return model, backend if DEVICE == "cpu" else "torch"
+
+def build_reranker_model(model_name: str, backend: str = "torch") -> Tuple[Any, str]:
+    """构建 Reranker 模型，返回 (模型, 实际后端)；ONNX 不可用时退回 int8"""
+    model = None
+    if backend == "onnx":
+        model = _load_onnx_model(CrossEncoder, model_name)
+        if model is None:
+            backend = "int8"
+    if model is None:
+        model = CrossEncoder(model_name, device=DEVICE)
+    if backend == "int8" and DEVICE == "cpu":
+        # CrossEncoder 的 transformers 模型在 .model 属性上
+        model.model = _quantize_dynamic_int8(model.model)
+    return model, backend if DEVICE == "cpu" else "torch"
+
+def _model_nbytes(model) -> int:
+    """估算模型参数占用的内存（字节）；远程模型或无法统计时为 0"""
+    module = getattr(model, "model", model)  # CrossEncoder 的参数在 .model 上
+    if not hasattr(module, "parameters"):
+        return 0
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
 class RAGModels:
     """在服务器启动时加载模型到 GPU"""
     
-    def __init__(self, data_dir: str = None, use_gpu: bool = True, config_path: str = None):
+    def __init__(self, data_dir: str = None, use_gpu: bool = True, config_path: str = None, index_version: str = None,
+                 shared_indexes: bool = False):
         self.embedding_model = None
         self.reranker_model = None
+        self.embedding_backend = None  # torch / int8 / onnx
+        self.reranker_backend = None
+        self.embedding_model_name = None
+        self.reranker_model_name = None
         self.llm = None
         self.vector_db = None
         self.llm_ranker = None
+        self.data_dir = data_dir
+        self.use_gpu = use_gpu
+        self.shared_indexes = shared_indexes
+        self.model_client: Optional[ModelServerClient] = None
+        self.registry = ModelRegistry(self._load_registered)
         
         # 初始化向量数据库（支持 GPU 加速）
         if data_dir and os.path.exists(data_dir):
             try:
-                self.vector_db = CityVectorDB(data_dir, use_gpu=use_gpu)
+                self.vector_db = CityVectorDB(data_dir, use_gpu=use_gpu, index_version=index_version, shared=shared_indexes)
             except Exception as e:
-                print(f"⚠️ Failed to load vector databases: {e}")
+                logger.warning(f"⚠️ Failed to load vector databases: {e}")
         
         # 初始化 LLM 精排器
         try:
             self.llm_ranker = LLMRanker(config_path=config_path)
         except Exception as e:
-            print(f"⚠️ Failed to initialize LLM ranker: {e}")
+            logger.warning(f"⚠️ Failed to initialize LLM ranker: {e}")
         
-    def load_embedding_model(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        """加载 Embedding 模型到 GPU"""
+    def load_embedding_model(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", backend: str = "torch"):
+        """加载 Embedding 模型（GPU，或 CPU 上的 torch / int8 / onnx 后端）"""
         if self.embedding_model is None:
-            print(f"📥 Loading embedding model: {model_name}")
+            logger.info(f"📥 Loading embedding model: {model_name} (backend={backend})")
             # 这里使用 sentence-transformers 作为示例
             # 你可以替换为 Qwen3-Embedding-8B 或其他模型
             try:
-                self.embedding_model = SentenceTransformer(model_name, device=DEVICE)
-                print(f"✅ Embedding model loaded on {DEVICE}")
+                self.embedding_model, self.embedding_backend = build_embedding_model(model_name, backend)
+                self.embedding_model_name = _model_label(model_name)
+                logger.info(f"✅ Embedding model loaded on {DEVICE} [{self.embedding_backend}]")
             except Exception as e:
-                print(f"❌ Failed to load embedding model: {e}")
+                logger.error(f"❌ Failed to load embedding model: {e}")
                 self.embedding_model = None
         return self.embedding_model
     
-    def load_reranker_model(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
-        """加载 Reranker 模型到 GPU"""
+    def load_reranker_model(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", backend: str = "torch"):
+        """加载 Reranker 模型（GPU，或 CPU 上的 torch / int8 / onnx 后端）"""
         if self.reranker_model is None:
-            print(f"📥 Loading reranker model: {model_name}")
+            logger.info(f"📥 Loading reranker model: {model_name} (backend={backend})")
             try:
-                from sentence_transformers import CrossEncoder
-                self.reranker_model = CrossEncoder(model_name, device=DEVICE)
-                print(f"✅ Reranker model loaded on {DEVICE}")
+                self.reranker_model, self.reranker_backend = build_reranker_model(model_name, backend)
+                self.reranker_model_name = _model_label(model_name)
+                logger.info(f"✅ Reranker model loaded on {DEVICE} [{self.reranker_backend}]")
             except Exception as e:
-                print(f"❌ Failed to load reranker model: {e}")
+                logger.error(f"❌ Failed to load reranker model: {e}")
                 self.reranker_model = None
         return self.reranker_model
     
-    def encode_query(self, query: str):
-        """使用 GPU 进行查询编码"""
-        if self.embedding_model is None:
+    def warmup(self, queries: Optional[List[str]] = None):
+        """启动时预热：触发 kernel 选择、内存分配和 ONNX 图优化，避免首个请求变慢"""
+        queries = queries or WARMUP_QUERIES
+        if self.embedding_model is not None:
+            start = time.time()
+            for query in queries:
+                self.encode_query(query)
+            logger.info(f"🔥 Embedding warmup: {len(queries)} queries in {(time.time() - start) * 1000:.0f}ms")
+        if self.reranker_model is not None:
+            start = time.time()
+            pairs = [[query, "店名：示例商户 - 类型：餐饮/火锅 - 地址：示例路1号 - 城市：上海"] for query in queries]
+            self.reranker_model.predict(pairs, batch_size=1)
+            logger.info(f"🔥 Reranker warmup: {len(pairs)} pairs in {(time.time() - start) * 1000:.0f}ms")
+    
+    def encode_query(self, query: str, model=None):
+        """使用 GPU 进行查询编码（model 为注册表路由到的模型，默认使用启动时加载的模型）"""
+        if model is None and self.embedding_model is None:
             self.load_embedding_model()
+        model = model or self.embedding_model
         
-        if self.embedding_model:
+        if model:
             with torch.no_grad():
-                embedding = self.embedding_model.encode(query, convert_to_tensor=True)
-            return embedding.cpu().numpy()
+                embedding = model.encode(query, convert_to_tensor=True)
+            # 多进程模式下的 RemoteEmbeddingModel 直接返回 numpy 数组
+            return embedding.cpu().numpy() if hasattr(embedding, "cpu") else embedding
         else:
             # Fallback: 使用简单的方法
             return None
+    
+    def encode_queries(self, queries: List[str], model=None) -> np.ndarray:
+        """批量编码查询（跨请求动态批处理调用），返回 (len(queries), d) 数组"""
+        model = model or self.embedding_model
+        with torch.no_grad():
+            embeddings = model.encode(queries, batch_size=len(queries), convert_to_tensor=True)
+        return embeddings.cpu().numpy() if hasattr(embeddings, "cpu") else np.asarray(embeddings)
+    
+    async def rerank_async(self, model, pairs: List[List[str]], batch_size: int = 1,
+                           chunk_size: int = RERANK_CHUNK_SIZE) -> List[float]:
+        """分块在线程池中重排：请求被取消时，尚未提交的分块不再执行，线程池立即空出"""
+        loop = asyncio.get_running_loop()
+        scores: List[float] = []
+        for i in range(0, len(pairs), chunk_size):
+            chunk = pairs[i:i + chunk_size]
+            scores.extend(await loop.run_in_executor(None, lambda: model.predict(chunk, batch_size=batch_size)))
+        return scores
+    
+    async def encode_query_async(self, query: str, model=None, name: str = "default"):
+        """查询编码：启用动态批处理时与并发请求合批，否则在线程池中单独编码"""
+        if model is None and self.embedding_model is None:
+            return None
+        model = model or self.embedding_model
+        if embedding_batcher.enabled:
+            return await embedding_batcher.submit(model, query, name)
+        return await asyncio.get_running_loop().run_in_executor(None, self.encode_query, query, model)
+    
+    def encode_documents(self, docs: List[Dict[str, Any]], batch_size: int = 32) -> Optional[np.ndarray]:
+        """编码商户文档（增量 upsert 只编码变更的商户）"""
+        if self.embedding_model is None:
+            self.load_embedding_model()
+        if self.embedding_model is None:
+            return None
+        
+        texts = [_format_document_for_rerank(doc) for doc in docs]
+        with torch.no_grad():
+            embeddings = self.embedding_model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+        return np.asarray(embeddings, dtype='float32')
+
+    # ---------- 模型注册表 ----------
+    
+    def configure_registry(self, registry_path: Optional[str], memory_budget_gb: Optional[float] = None,
+                           backend: str = "torch"):
+        """从注册表文件登记可选模型（只登记，不加载）"""
+        self.registry.memory_budget = int(memory_budget_gb * 1024 ** 3) if memory_budget_gb else None
+        if not registry_path:
+            return
+        for kind, entries in load_registry_file(registry_path).items():
+            for name, spec in entries.items():
+                spec = spec if isinstance(spec, dict) else {"path": spec}
+                self.registry.register(kind, name, spec["path"], spec.get("backend", backend),
+                                       str(spec["index_version"]) if spec.get("index_version") else None)
+        logger.info(f"🗂️  Model registry: {len(self.registry._entries)} models from {registry_path}"
+                    + (f", budget {memory_budget_gb:g} GB" if memory_budget_gb else ""))
+    
+    def _load_registered(self, entry: RegisteredModel):
+        """注册表加载回调：本进程加载模型，或在多进程模式下绑定模型服务进程中的同名模型"""
+        if self.model_client is not None:
+            proxy_cls = RemoteEmbeddingModel if entry.kind == "embedding" else RemoteReranker
+            entry.model, entry.loaded_backend, entry.nbytes = proxy_cls(self.model_client, entry.name), "remote", 0
+        elif entry.kind == "embedding":
+            entry.model, entry.loaded_backend = build_embedding_model(entry.path, entry.backend or "torch")
+            entry.nbytes = _model_nbytes(entry.model)
+        else:
+            entry.model, entry.loaded_backend = build_reranker_model(entry.path, entry.backend or "torch")
+            entry.nbytes = _model_nbytes(entry.model)
+        
+        if entry.kind == "embedding":
+            entry.vector_db = self._vector_db_for(entry.index_version)
+            entry.owns_vector_db = entry.vector_db is not None and entry.vector_db is not self.vector_db
+            if entry.owns_vector_db:
+                # 单独加载的索引版本计入该模型的内存占用
+                entry.nbytes += entry.vector_db.nbytes
+            if entry.vector_db is not None and self.model_client is None:
+                self._check_dimension(entry)
+    
+    def _vector_db_for(self, index_version: Optional[str]) -> Optional["CityVectorDB"]:
+        """与 Embedding 模型配套的索引：未指定或与默认版本相同时共用主索引，否则单独加载该版本"""
+        if self.vector_db is None or not index_version or index_version == self.vector_db.default_version:
+            return self.vector_db
+        return CityVectorDB(self.data_dir, use_gpu=self.use_gpu, index_version=index_version, shared=self.shared_indexes)
+    
+    @staticmethod
+    def _check_dimension(entry: RegisteredModel):
+        dim = entry.model.get_sentence_embedding_dimension()
+        for city, index in entry.vector_db.indexes.items():
+            if dim and index.d != dim:
+                raise ValueError(f"Embedding model '{entry.name}' outputs {dim} dims but the {city} index "
+                                 f"(version {entry.vector_db.versions.get(city)}) expects {index.d}")
+    
+    @contextmanager
+    def use_model(self, kind: str, name: Optional[str]):
+        """同步版本的模型路由：yield (模型, 名称, 索引)，未注册的名称使用默认模型"""
+        entry = self.registry.get(kind, name)
+        if entry is None:
+            if kind == "embedding":
+                yield self.embedding_model, self.embedding_model_name, self.vector_db
+            else:
+                yield self.reranker_model, self.reranker_model_name, None
+            return
+        self.registry.acquire(entry)
+        try:
+            yield entry.model, entry.name, entry.vector_db
+        finally:
+            self.registry.release(entry)
+    
+    async def _acquire_entry(self, kind: str, name: Optional[str]) -> Optional[RegisteredModel]:
+        entry = self.registry.get(kind, name)
+        if entry is None:
+            return None
+        if not self.registry.try_acquire(entry):
+            # 首次使用（或已被淘汰）：在线程池中加载，避免阻塞事件循环
+            await asyncio.get_running_loop().run_in_executor(None, self.registry.acquire, entry)
+        return entry
+    
+    @asynccontextmanager
+    async def route(self, retriever: Optional[str], reranker: Optional[str]):
+        """按请求的 retriever / reranker 名称固定本次请求使用的模型；reranker=None 表示不重排"""
+        embedding_entry = await self._acquire_entry("embedding", retriever)
+        try:
+            reranker_entry = await self._acquire_entry("reranker", reranker)
+        except BaseException:
+            if embedding_entry is not None:
+                self.registry.release(embedding_entry)
+            raise
+        try:
+            if embedding_entry is not None:
+                embedding = (embedding_entry.model, embedding_entry.vector_db, embedding_entry.name)
+            else:
+                embedding = (self.embedding_model, self.vector_db, self.embedding_model_name)
+            if reranker_entry is not None:
+                rerank = (reranker_entry.model, reranker_entry.name)
+            elif reranker is None:
+                rerank = (None, None)
+            else:
+                rerank = (self.reranker_model, self.reranker_model_name)
+            yield ModelRoute(embedding[0], embedding[1], embedding[2], rerank[0], rerank[1])
+        finally:
+            for entry in (embedding_entry, reranker_entry):
+                if entry is not None:
+                    self.registry.release(entry)
+    
+    def connect_model_server(self, address: str, authkey: bytes):
+        """多进程模式：Embedding / Reranker 由模型服务进程提供，工作进程通过本地 IPC 调用"""
+        client = ModelServerClient(address, authkey)
+        self.model_client = client
+        info = client.call("info")
+        self.embedding_model = RemoteEmbeddingModel(client) if info["embedding"] else None
+        self.reranker_model = RemoteReranker(client) if info["reranker"] else None
+        self.embedding_backend = info["embedding_backend"]
+        self.reranker_backend = info["reranker_backend"]
+        self.embedding_model_name = info["embedding_model_name"]
+        self.reranker_model_name = info["reranker_model_name"]
+        logger.info(f"🔌 Connected to model server at {address} "
+                    f"[embedding={self.embedding_backend}, reranker={self.reranker_backend}]")
+
+# 全局模型实例（稍后在 startup 时初始化）
+models = None
+
+# ==================== 多进程服务（模型服务进程 + 共享索引）====================
+# --workers > 1 时：
+#   - 主进程启动一个模型服务进程，独占 GPU（或 CPU 推理线程）加载 Embedding / Reranker；
+#   - uvicorn 以导入字符串启动多个工作进程，各自以 mmap 只读方式打开同一批索引与元数据（共享页缓存）；
+#   - 工作进程通过 multiprocessing.connection（Unix socket + authkey）调用模型服务进程。
+
+class ModelServerClient:
+    """模型服务进程的 IPC 客户端；连接不是线程安全的，每个线程各用一条"""
+    
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+    
+    def call(self, method: str, *args):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send((method, args))
+            status, payload = conn.recv()
+        except (EOFError, OSError):
+            # 连接断开：丢弃，下次调用重连
+            self._local.conn = None
+            raise
+        if status != "ok":
+            raise RuntimeError(f"Model server error in {method}: {payload}")
+        return payload
+
+class RemoteEmbeddingModel:
+    """与 SentenceTransformer.encode 调用方式兼容的远程 Embedding 模型（name 为注册表名称，None 为默认模型）"""
+    
+    def __init__(self, client: ModelServerClient, name: Optional[str] = None):
+        self.client = client
+        self.name = name
+    
+    def encode(self, sentences, batch_size: int = 32, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        embeddings = self.client.call("encode", self.name, [sentences] if single else list(sentences), batch_size)
+        return embeddings[0] if single else embeddings
+
+class RemoteReranker:
+    """与 CrossEncoder.predict 调用方式兼容的远程 Reranker（name 为注册表名称，None 为默认模型）"""
+    
+    def __init__(self, client: ModelServerClient, name: Optional[str] = None):
+        self.client = client
+        self.name = name
+    
+    def predict(self, pairs, batch_size: int = 1, **kwargs) -> np.ndarray:
+        return self.client.call("rerank", self.name, [list(pair) for pair in pairs], batch_size)
+
+def _serve_model_connection(conn, server_models: "RAGModels"):
+    def _encode(name, texts, batch_size):
+        with server_models.use_model("embedding", name) as (model, _, _):
+            return np.asarray(model.encode(texts, batch_size=batch_size, convert_to_numpy=True), dtype="float32")
+    
+    def _rerank(name, pairs, batch_size):
+        with server_models.use_model("reranker", name) as (model, _, _):
+            return np.asarray(model.predict(pairs, batch_size=batch_size))
+    
+    handlers = {
+        "encode": _encode,
+        "rerank": _rerank,
+        "info": lambda: {
+            "embedding": server_models.embedding_model is not None,
+            "reranker": server_models.reranker_model is not None,
+            "embedding_backend": server_models.embedding_backend,
+            "reranker_backend": server_models.reranker_backend,
+            "embedding_model_name": server_models.embedding_model_name,
+            "reranker_model_name": server_models.reranker_model_name,
+        },
+    }
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                with torch.no_grad():
+                    conn.send(("ok", handlers[method](*args)))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+def run_model_server(address: str, authkey: bytes, state: Dict[str, Any]):
+    """模型服务进程入口：加载模型后为每个工作进程连接开一个线程"""
+    configure_logging(**state.get("logging", {}))
+    if DEVICE == "cuda":
+        backend = "torch"
+    else:
+        backend = state.get("cpu_backend", "int8")
+        configure_cpu_threads(state.get("cpu_threads"))
+    
+    server_models = RAGModels()
+    server_models.configure_registry(state.get("model_registry"), state.get("model_memory_budget_gb"), backend)
+    if state.get("embedding_model_path"):
+        server_models.load_embedding_model(state["embedding_model_path"], backend=backend)
+    else:
+        server_models.load_embedding_model(backend=backend)
+    if state.get("reranker_model_path"):
+        server_models.load_reranker_model(state["reranker_model_path"], backend=backend)
+    else:
+        server_models.load_reranker_model(backend=backend)
+    server_models.warmup()
+    
+    listener = Listener(address, authkey=authkey)
+    logger.info(f"🧠 Model server ready at {address}")
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=_serve_model_connection, args=(conn, server_models), daemon=True).start()
+
+def start_model_server(state: Dict[str, Any], timeout_s: float = 900.0) -> Tuple[multiprocessing.Process, str, bytes]:
+    """启动模型服务进程并等待其可连接，返回 (进程, 地址, authkey)"""
+    address = os.path.join(tempfile.gettempdir(), f"rag-model-server-{os.getpid()}.sock")
+    if os.path.exists(address):
+        os.unlink(address)
+    authkey = os.urandom(16)
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_model_server, args=(address, authkey, state), name="rag-model-server", daemon=True)
+    process.start()
+    
+    deadline = time.time() + timeout_s
+    last_error: Optional[BaseException] = None
+    while time.time() < deadline:
+        if not process.is_alive():
+            raise RuntimeError(f"Model server exited during startup (exit code {process.exitcode})")
+        try:
+            Client(address, authkey=authkey).close()
+            return process, address, authkey
+        except (OSError, EOFError) as e:
+            # socket 尚未创建 / 未开始 listen / 握手时被关闭等，都在截止时间内重试
+            last_error = e
+            time.sleep(1.0)
+    process.terminate()
+    raise RuntimeError(f"Model server did not become ready within {timeout_s:.0f}s (last error: {last_error!r})")
+
+# ==================== 请求合并（single-flight）====================
+
+class SingleFlight:
+    """合并相同 key 的并发调用：只执行一次，所有等待者共享同一个结果（或异常）"""
+    
+    def __init__(self):
+        self._inflight: Dict[Any, List[Any]] = {}  # key -> [task, 等待者数量]
+        self.executed = 0   # 实际执行次数
+        self.coalesced = 0  # 被合并（搭便车）的请求数
+        self.abandoned = 0  # 所有等待者都已离开而被取消的执行次数
+    
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+    
+    async def do(self, key: Any, coro_factory) -> Tuple[Any, bool]:
+        """返回 (结果, 是否被合并)"""
+        entry = self._inflight.get(key)
+        if entry is not None:
+            self.coalesced += 1
+            return await self._wait(entry), True
+        
+        self.executed += 1
+        entry = self._inflight[key] = [asyncio.ensure_future(coro_factory()), 0]
+        entry[0].add_done_callback(lambda _: self._inflight.pop(key) if self._inflight.get(key) is entry else None)
+        return await self._wait(entry), False
+    
+    def join(self, key: Any):
+        """key 正在执行时立即登记为等待者并返回等待结果的协程，否则返回 None
+        
+        同步登记：返回的协程稍后才开始运行时，执行也不会因为暂时没有等待者而被取消
+        """
+        entry = self._inflight.get(key)
+        if entry is None:
+            return None
+        self.coalesced += 1
+        entry[1] += 1
+        return self._await(entry)
+    
+    async def _wait(self, entry: List[Any]) -> Any:
+        entry[1] += 1
+        return await self._await(entry)
+    
+    async def _await(self, entry: List[Any]) -> Any:
+        task = entry[0]
+        try:
+            # shield：某个等待者取消时，不影响其他等待者
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # 所有等待者都已离开（客户端断开）：没人需要这个结果了，取消计算
+                self.abandoned += 1
+                task.cancel()
+
+search_flight = SingleFlight()
+
+# ==================== 客户端断开检测 ====================
+# 前端 120 秒超时后用户常会重新提交；已断开的请求不应继续占用 rerank / LLM 精排和线程池。
+# 断开后取消请求的任务：CancelledError 沿 await 链传播，排队中的编码 / 检索批次跳过该请求，
+# rerank 不再提交剩余分块，进行中的 LLM HTTP 请求被关闭，准入名额立即归还。
+
+DISCONNECT_POLL_INTERVAL_S = 0.5
+
+CLIENT_DISCONNECTS = metrics_registry.register(Counter(
+    "rag_client_disconnects_total", "Requests whose client went away before the response was ready", ("endpoint",)))
+PIPELINE_CANCELLED = metrics_registry.register(Counter(
+    "rag_pipeline_cancelled_total", "Search pipelines cancelled mid-flight, by the stage they were in", ("stage",)))
+
+async def run_until_disconnect(http_request: Request, coro, endpoint: str):
+    """执行 coro，期间轮询客户端连接；客户端断开时取消任务并返回 499"""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL_S)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                CLIENT_DISCONNECTS.inc(endpoint=endpoint)
+                logger.info("Client disconnected, cancelling request", extra=_fields(endpoint=endpoint))
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                # 499（nginx 约定）：客户端已关闭连接，仅用于日志与指标
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
+def _search_flight_key(request: "RAGSearchRequest", use_llm_ranking: bool, use_reranker: bool = True,
+                       cities: Union[List[str], str, None] = None,
+                       areas: Optional[Dict[str, List[str]]] = None,
+                       near: Optional[Tuple[float, float, float]] = None,
+                       open_slot: Optional[int] = None) -> Tuple:
+    """规范化的 single-flight key：(query, cities, areas, near, open_slot, top_k, retriever, reranker, use_llm_ranking, use_reranker)
 
-# 全局模型实例（稍后在 startup 时初始化）
-models = None
-
-# ==================== RAG 实现 ====================
-
-async def perform_rag_search(query: str, city: str, top_k: int, retriever: str, reranker: str, use_llm_ranking: bool = True) -> Dict:
+    use_llm_ranking / use_reranker 为降级后实际生效的值，降级结果不会分给未降级的请求；
+    cities / areas / near 为地点解析后实际使用的城市、区域过滤和半径过滤（未传时取请求中的值）；
+    open_slot 为营业时间过滤的周时段，同一时段内的请求结果相同
     """
-    真实的 RAG 搜索实现（使用1028版本向量数据库）
+    query = " ".join(request.query.split())
+    cities = request.cities if cities is None else cities
+    if models and models.vector_db:
+        cities = tuple(sorted(models.vector_db.resolve_cities(cities, default_city=request.city)))
+    else:
+        cities = (request.city,)
+    return (
+        query,
+        cities,
+        tuple(sorted((city, tuple(sorted(values))) for city, values in (areas or {}).items())),
+        tuple(round(value, 5) for value in near) if near else None,
+        open_slot,
+        request.top_k,
+        request.retriever.strip().lower(),
+        request.reranker.strip().lower(),
+        use_llm_ranking,
+        use_reranker,
+    )
+
+# ==================== 跨请求微批处理 ====================
+# 并发请求的查询编码 / 向量检索在很短的时间窗内合批处理，实现见 batching.py
+
+embedding_batcher = EmbeddingBatcher(lambda queries, model: models.encode_queries(queries, model))
+search_batcher = SearchBatcher()
+
+# ==================== 准入控制与降级 ====================
+# 在途上限、按优先级排序的等待队列与降级级别见 admission.py
+
+admission = AdmissionController()
+
+# ==================== RAG 实现 ====================
+
+async def perform_rag_search(query: str, city: str, top_k: int, retriever: str, reranker: str, use_llm_ranking: bool = True,
+                             cities: Union[List[str], str, None] = None, use_reranker: bool = True,
+                             candidate_multiplier: int = 5, areas: Optional[Dict[str, List[str]]] = None,
+                             location: Optional[QueryLocation] = None,
+                             near: Optional[Tuple[float, float, float]] = None,
+                             open_at: Optional[datetime] = None) -> Dict:
+    """RAG 搜索（带 rag.search span，各阶段 span 挂在其下）；retriever / reranker 按模型注册表路由"""
+    if models is None:
+        raise HTTPException(status_code=503, detail="Models not loaded")
+    with tracer.span("rag.search", city=city, top_k=top_k, use_llm_ranking=use_llm_ranking,
+                     use_reranker=use_reranker) as span:
+        # 只有路由（加载 / 获取模型）失败转为 503；检索中的异常照常传给 models.route 并向上抛出
+        async with AsyncExitStack() as stack:
+            try:
+                route = await stack.enter_async_context(models.route(retriever, reranker if use_reranker else None))
+            except Exception as e:
+                logger.exception("Model routing failed")
+                raise HTTPException(status_code=503, detail=f"Model '{retriever}' / '{reranker}' unavailable: {str(e)[:200]}")
+            span.set_attribute("retriever", route.embedding_name)
+            span.set_attribute("reranker", route.reranker_name)
+            result = await _perform_rag_search(query, city, top_k, route, use_llm_ranking, cities, candidate_multiplier,
+                                               areas=areas, location=location, near=near, open_at=open_at)
+        span.set_attribute("returned_count", len(result.get("sources", [])))
+        return result
+
+async def _perform_rag_search(query: str, city: str, top_k: int, route: ModelRoute, use_llm_ranking: bool = True,
+                              cities: Union[List[str], str, None] = None, candidate_multiplier: int = 5,
+                              areas: Optional[Dict[str, List[str]]] = None,
+                              location: Optional[QueryLocation] = None,
+                              near: Optional[Tuple[float, float, float]] = None,
+                              open_at: Optional[datetime] = None) -> Dict:
+    """
+    真实的 RAG 搜索实现（各城市使用 manifest.json 中当前生效的索引版本，route 指定的模型可使用其配套版本）
     
     流程：
-    1. 使用 Embedding 模型编码查询
+    1. 使用 Embedding 模型编码查询（route 决定本次请求使用的模型及其配套索引）
     2. 在指定城市的 FAISS 索引中检索（候选文档数量 = top_k × candidate_multiplier）
-    3. 使用 Reranker 模型重排序
-    4. 返回 top_k 结果
+       - 指定 cities（列表或 "all"）时，查询只编码一次，并发检索各城市索引，
+         再用全局堆归并候选，之后统一做一次 rerank
+       - 指定 areas（来自 LocationParser）时只在这些区县 / 商圈 / 地标的商户中检索，
+         区域内结果不足 top_k 时退回全城检索
+       - 指定 near=(lat, lng, radius_m) 时只在半径内的商户中检索（优先于 areas，不退回全城），
+         候选带 distance_m，距离同时写入 rerank 文本
+       - 指定 open_at 时在检索阶段排除该时刻确定不营业的商户（见 OpeningHours），
+         关门的商户不进入 rerank / LLM 精排；候选的 open_now 为 True（营业）或 None（营业时间未知）
+    3. 使用 Reranker 模型重排序（route.reranker_model 为 None 时跳过，用于过载降级）
+    4. 返回 top_k 结果（每条结果带 source_city 字段）
     
     参考策略（与 interactive_merchant_search_vllm.py 保持一致）：
-    - 候选文档倍数：5倍（即检索 top_k × 5 个候选文档）
+    - 候选文档倍数：默认 5 倍（即检索 top_k × 5 个候选文档；离线评测可扫描 candidate_multiplier）
     - 相似度转换：将 L2 距离转换为 0-1 范围的相似度分数
     - 重排序文本：构建包含地理位置（city/district/business_area/landmark）+ 多个关键字段的丰富文本表示
     - 保留排名信息：记录原始排名、重排序分数和最终排名
@@ -634,41 +2389,77 @@ async def perform_rag_search(query: str, city: str, top_k: int, retriever: str,
     start_time = time.time()
     
     # 检查向量数据库是否已加载
-    if not models.vector_db:
+    vector_db = route.vector_db
+    if not vector_db:
         raise HTTPException(status_code=503, detail="Vector database not loaded. Please check server configuration.")
     
-    if city not in models.vector_db.indexes:
-        available_cities = list(models.vector_db.indexes.keys())
+    target_cities = vector_db.resolve_cities(cities, default_city=city)
+    unavailable = [c for c in target_cities if c not in vector_db.indexes]
+    if not target_cities or unavailable:
+        available_cities = list(vector_db.indexes.keys())
         raise HTTPException(
             status_code=400, 
-            detail=f"City '{city}' not available. Available cities: {available_cities}"
+            detail=f"City '{'、'.join(unavailable) or city}' not available. Available cities: {available_cities}"
         )
+    city_label = "、".join(target_cities)
+    metric_city = _city_metric_label(target_cities)
+    areas = None if near else ({c: values for c, values in (areas or {}).items() if c in target_cities and values} or None)
+    open_slot = week_slot(open_at) if open_at else None
     
     try:
         # 1. 使用 Embedding 模型编码查询
+        stage = "embedding"  # 当前阶段，客户端断开取消时计入指标
         embedding_start = time.time()
-        query_embedding = models.encode_query(query)
-        if query_embedding is None:
-            raise HTTPException(status_code=503, detail="Embedding model not loaded")
+        with tracer.span("embedding", model=route.embedding_name):
+            query_embedding = await models.encode_query_async(query, model=route.embedding_model, name=route.embedding_name)
+            if query_embedding is None:
+                raise HTTPException(status_code=503, detail="Embedding model not loaded")
         embedding_time = time.time() - embedding_start
+        STAGE_LATENCY.observe(embedding_time, stage="embedding", city=metric_city, model=route.embedding_name)
         
         # 2. 从 FAISS 向量数据库检索
         # 候选文档策略：如果使用重排序，检索 top_k × 5 个候选文档
-        candidate_multiplier = 5  # 候选文档倍数（与 VLLM 脚本保持一致）
-        use_reranker = models.reranker_model is not None
+        use_reranker = route.reranker_model is not None
         
         if use_reranker:
             # 使用重排序：检索更多候选文档
-            retrieval_k = min(top_k * candidate_multiplier, models.vector_db.indexes[city].ntotal)
-            print(f"🔍 Retrieving {retrieval_k} candidates (top_k={top_k} × multiplier={candidate_multiplier}) for reranking")
+            total_vectors = sum(vector_db.indexes[c].ntotal for c in target_cities)
+            retrieval_k = min(top_k * candidate_multiplier, total_vectors)
+            logger.debug("Retrieving candidates for reranking", extra=_fields(
+                retrieval_k=retrieval_k, top_k=top_k, multiplier=candidate_multiplier))
         else:
             # 不使用重排序：直接检索 top_k 个
             retrieval_k = top_k
-            print(f"🔍 Retrieving {retrieval_k} candidates (no reranking)")
+            logger.debug("Retrieving candidates (no reranking)", extra=_fields(retrieval_k=retrieval_k))
         
+        stage = "faiss_search"
         retrieval_start = time.time()
-        retrieved_docs = models.vector_db.search(query_embedding, city=city, top_k=retrieval_k)
+        with tracer.span("faiss_search", cities=city_label, retrieval_k=retrieval_k,
+                         open_filter=open_slot is not None) as span:
+            retrieved_docs = await vector_db.search_cities_async(query_embedding, cities=target_cities, top_k=retrieval_k,
+                                                                 areas=areas, near=near, open_slot=open_slot)
+            area_filter = None
+            if areas:
+                area_filter = "applied"
+                # 区域内商户不足 top_k 时退回全城检索，避免因过滤返回过少结果
+                if len(retrieved_docs) < top_k:
+                    retrieved_docs = await vector_db.search_cities_async(query_embedding, cities=target_cities, top_k=retrieval_k,
+                                                                         open_slot=open_slot)
+                    area_filter = "fallback"
+                    areas = None
+            open_filter = None
+            if open_slot is not None:
+                for doc in retrieved_docs:
+                    doc["open_now"] = OpeningHours.doc_open(doc, open_slot)
+                open_filter = {
+                    "at": open_at.isoformat(timespec="minutes"),
+                    "unknown_hours": sum(1 for doc in retrieved_docs if doc["open_now"] is None),
+                }
+                OPEN_FILTERS.inc(result="applied" if retrieved_docs else "empty")
+            span.set_attribute("hits", len(retrieved_docs))
+            span.set_attribute("area_filter", area_filter)
         retrieval_time = time.time() - retrieval_start
+        STAGE_LATENCY.observe(retrieval_time, stage="faiss_search", city=metric_city, model=route.embedding_name)
         
         if not retrieved_docs:
             return {
@@ -698,6 +2489,7 @@ async def perform_rag_search(query: str, city: str, top_k: int, retriever: str,
         # 3. 使用 Reranker 模型重排序
         rerank_time = 0
         if use_reranker and len(retrieved_docs) > 1:
+            stage = "rerank"
             try:
                 rerank_start = time.time()
                 
@@ -709,7 +2501,8 @@ async def perform_rag_search(query: str, city: str, top_k: int, retriever: str,
                     pairs.append([query, doc_text])
                 
                 # 使用 Reranker 重新打分 (使用 batch_size=1 避免 padding 问题)
-                rerank_scores = models.reranker_model.predict(pairs, batch_size=1)
+                with tracer.span("rerank", model=route.reranker_name, pairs=len(pairs)):
+                    rerank_scores = await models.rerank_async(route.reranker_model, pairs, batch_size=1)
                 
                 # 更新分数
                 for doc, score in zip(retrieved_docs, rerank_scores):
@@ -723,10 +2516,12 @@ async def perform_rag_search(query: str, city: str, top_k: int, retriever: str,
                     doc['final_rank'] = i + 1
                 
                 rerank_time = time.time() - rerank_start
-                print(f"🔄 Reranked {len(retrieved_docs)} documents in {rerank_time:.2f}s")
+                STAGE_LATENCY.observe(rerank_time, stage="rerank", city=metric_city, model=route.reranker_name)
+                logger.debug("Reranked documents", extra=_fields(docs=len(retrieved_docs), rerank_ms=round(rerank_time * 1000)))
                 
             except Exception as e:
-                print(f"⚠️ Reranking failed: {e}, using vector scores only")
+                logger.warning("Reranking failed, using vector scores only", extra=_fields(error=str(e)[:200]))
+                FALLBACKS.inc(stage="rerank", reason="error")
                 # 重排序失败，使用原始排名
                 for i, doc in enumerate(retrieved_docs):
                     doc['final_rank'] = doc.get('rank', i + 1)
@@ -735,44 +2530,54 @@ async def perform_rag_search(query: str, city: str, top_k: int, retriever: str,
             for i, doc in enumerate(retrieved_docs):
                 doc['final_rank'] = doc.get('rank', i + 1)
         
-        # 调试：打印第一个文档的字段
+        # 调试：第一个文档的字段
         if retrieved_docs:
-            print(f"📋 First document fields: {list(retrieved_docs[0].keys())}")
-            print(f"📋 Merchant name: {retrieved_docs[0].get('name', 'NOT FOUND')}")
+            logger.debug("First document", extra=_fields(
+                doc_fields=list(retrieved_docs[0].keys()), name=retrieved_docs[0].get('name', 'NOT FOUND')))
+        
+        # 完整的重排候选列表（LLM 精排前），用于游标分页
+        candidates = retrieved_docs
         
         # 4. 使用 LLM 精排（从 rerank 的结果中选出 top_k 个）
         llm_ranking_time = 0
         if use_llm_ranking and models.llm_ranker and len(retrieved_docs) > top_k:
+            stage = "llm_ranking"
             try:
                 llm_start = time.time()
-                print(f"🤖 LLM ranking: selecting {top_k} from {len(retrieved_docs)} candidates")
-                retrieved_docs = await models.llm_ranker.select_top_k_async(
-                    query=query,
-                    candidates=retrieved_docs,
-                    top_k=top_k,
-                    city=city
-                )
+                logger.debug("LLM ranking started", extra=_fields(top_k=top_k, candidates=len(retrieved_docs)))
+                # llm.attempt span 挂在 llm_ranking span 下
+                with tracer.span("llm_ranking", candidates=len(retrieved_docs), top_k=top_k):
+                    retrieved_docs = await models.llm_ranker.select_top_k_async(
+                        query=query,
+                        candidates=retrieved_docs,
+                        top_k=top_k,
+                        city=city_label
+                    )
                 llm_ranking_time = time.time() - llm_start
-                print(f"✅ LLM ranking completed in {llm_ranking_time:.2f}s")
+                STAGE_LATENCY.observe(llm_ranking_time, stage="llm_ranking", city=metric_city,
+                                      model=_model_label(models.llm_ranker.llm.get("model")))
+                logger.debug("LLM ranking completed", extra=_fields(llm_ranking_ms=round(llm_ranking_time * 1000)))
             except Exception as e:
-                print(f"⚠️ LLM ranking failed: {e}, using reranked results")
+                logger.warning("LLM ranking failed, using reranked results", extra=_fields(error=str(e)[:200]))
+                FALLBACKS.inc(stage="llm_ranking", reason="error")
                 retrieved_docs = retrieved_docs[:top_k]
         else:
             # 不使用 LLM 精排，直接取 top_k
             if not use_llm_ranking:
-                print(f"📋 LLM ranking disabled by request")
+                logger.debug("LLM ranking disabled by request")
             elif not models.llm_ranker:
-                print(f"⚠️ LLM ranker not initialized")
+                logger.debug("LLM ranker not initialized")
             retrieved_docs = retrieved_docs[:top_k]
         
         # 5. 生成答案摘要（city 已经是中文）
-        answer = f"在{city}找到相关商户，为您推荐以下 {len(retrieved_docs)} 家："
+        answer = f"在{city_label}找到相关商户，为您推荐以下 {len(retrieved_docs)} 家："
         
         # 6. 计算评估指标
         metrics = {
             "retrieved_count": len(retrieved_docs),
             "returned_count": len(retrieved_docs),
-            "city": city,
+            "city": city_label,
+            "cities": target_cities,
             "latency_ms": (time.time() - start_time) * 1000,
             "embedding_time_ms": embedding_time * 1000,
             "retrieval_time_ms": retrieval_time * 1000,
@@ -780,25 +2585,45 @@ async def perform_rag_search(query: str, city: str, top_k: int, retriever: str,
             "llm_ranking_time_ms": llm_ranking_time * 1000,
             "used_reranker": use_reranker,
             "used_llm_ranking": use_llm_ranking and llm_ranking_time > 0,
-            "candidate_multiplier": candidate_multiplier if use_reranker else 1
+            "retriever": route.embedding_name,
+            "reranker": route.reranker_name,
+            "candidate_multiplier": candidate_multiplier if use_reranker else 1,
+            "location": location.to_dict() if location else None,
+            "area_filter": area_filter,
+            "geo": {"lat": near[0], "lng": near[1], "radius_m": near[2], "candidates": len(candidates)} if near else None,
+            "open_filter": open_filter
         }
         
-        # 调试：打印返回的商店名称
-        print(f"📦 Returning {len(retrieved_docs)} merchants:")
-        for i, doc in enumerate(retrieved_docs[:3], 1):  # 只打印前3个
-            score_info = f"rerank={doc.get('rerank_score', 0):.4f}" if use_reranker else f"similarity={doc.get('similarity', 0):.4f}"
-            llm_rank = f", llm_rank={doc.get('llm_rank', '-')}" if doc.get('llm_selected') else ""
-            print(f"   {i}. {doc.get('name', 'NO_NAME')} ({score_info}, rank: {doc.get('original_rank', '?')}→{doc.get('final_rank', '?')}{llm_rank})")
+        # 调试：返回的前 3 个商户
+        if logger.isEnabledFor(logging.DEBUG):
+            top = [{
+                "name": doc.get('name', 'NO_NAME'),
+                "score": doc.get('rerank_score', 0) if use_reranker else doc.get('similarity', 0),
+                "rank": f"{doc.get('original_rank', '?')}→{doc.get('final_rank', '?')}",
+                "llm_rank": doc.get('llm_rank') if doc.get('llm_selected') else None,
+            } for doc in retrieved_docs[:3]]
+            logger.debug("Returning merchants", extra=_fields(count=len(retrieved_docs), top=top))
+        
+        # 7. 缓存完整候选列表：“显示更多”直接从中分页，不再重新检索和重排
+        next_cursor = candidate_cache.save(
+            query, query_embedding, target_cities, city_label, route, candidates, retrieved_docs,
+            retrieval_k=retrieval_k, max_distance=max_distance, areas=areas, near=near, open_slot=open_slot
+        )
         
         return {
             "answer": answer,
             "sources": retrieved_docs,
             "metrics": metrics,
-            "processing_time": time.time() - start_time
+            "processing_time": time.time() - start_time,
+            "next_cursor": next_cursor
         }
         
+    except asyncio.CancelledError:
+        PIPELINE_CANCELLED.inc(stage=stage)
+        logger.info("Search cancelled", extra=_fields(stage=stage, elapsed_ms=round((time.time() - start_time) * 1000)))
+        raise
     except Exception as e:
-        print(f"❌ RAG search error: {e}")
+        logger.exception("RAG search error")
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
 
 
@@ -851,6 +2676,10 @@ def _format_document_for_rerank(doc_info: Dict[str, Any]) -> str:
     if doc_info.get('landmark'):
         parts.append(f"地标：{doc_info['landmark']}")
     
+    # 5. 附近检索时与用户的距离
+    if doc_info.get('distance_m') is not None:
+        parts.append(f"距离：约{doc_info['distance_m']}米")
+    
     # 使用 " - " 连接所有部分
     return ' - '.join(parts)
 
@@ -914,6 +2743,411 @@ def perform_agentic_search(query: str, model: str, max_iterations: int) -> Dict:
         "processing_time": time.time() - start_time
     }
 
+# ==================== 候选列表游标分页 ====================
+# 每次搜索的完整重排候选列表缓存一段时间（TTL），响应中的 next_cursor 指向下一页。
+# 单进程时缓存在进程内；多进程模式下翻页请求可能落到任意工作进程，列表保存在各进程共享的本机目录中。
+# 翻页直接从缓存列表中切片，不再重新编码、检索、重排和 LLM 精排；列表用完时才扩大检索范围，
+# 只对新增的候选做 rerank 后追加到列表末尾。
+# 展示顺序：首页为 LLM 精排（或 rerank）后的结果，之后按 rerank 分数排列其余候选，已展示的商户不会重复出现。
+
+CURSOR_PAGES = metrics_registry.register(Counter(
+    "rag_cursor_pages_total", "Follow-up result pages served from cached candidate lists", ("result",)))
+
+def _candidate_key(doc: Dict[str, Any]) -> str:
+    """候选去重键：优先使用商户 ID，没有 ID 时用店名 + 地址"""
+    city = doc.get("source_city", "")
+    for field in MERCHANT_ID_FIELDS:
+        if doc.get(field) is not None:
+            return f"{city}:{doc[field]}"
+    return f"{city}:{doc.get('name', '')}:{doc.get('address', '')}"
+
+def encode_cursor(entry_id: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(f"{entry_id}:{offset}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """解析游标；格式不对时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        entry_id, offset = raw.rsplit(":", 1)
+        return entry_id, max(0, int(offset))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+class CandidateList:
+    """一次搜索缓存下来的候选列表（按展示顺序）"""
+    
+    def __init__(self, query: str, embedding: np.ndarray, cities: List[str], city_label: str,
+                 retriever: str, reranker: Optional[str], order: List[Dict[str, Any]], page_size: int,
+                 retrieval_k: int, max_distance: float, exhausted: bool,
+                 areas: Optional[Dict[str, List[str]]] = None, near: Optional[Tuple[float, float, float]] = None,
+                 open_slot: Optional[int] = None):
+        self.query = query
+        self.embedding = embedding  # 查询向量：扩大检索时无需重新编码
+        self.cities = cities
+        self.areas = areas          # 首次检索的区域过滤，扩展时沿用
+        self.near = near            # 首次检索的半径过滤，扩展时沿用
+        self.open_slot = open_slot  # 首次检索的营业时段过滤，扩展时沿用
+        self.city_label = city_label
+        self.retriever = retriever
+        self.reranker = reranker    # None 表示首次搜索未做 rerank（降级），扩展时同样不做
+        self.order = order
+        self.keys = {_candidate_key(doc) for doc in order}
+        self.page_size = page_size
+        self.retrieval_k = retrieval_k
+        self.max_distance = max_distance  # 相似度换算沿用首次检索的最大距离，保证分数可比
+        self.exhausted = exhausted        # 索引中已没有更多候选
+        self.lock = asyncio.Lock()        # 同一列表的并发扩展串行执行
+        self.expires_at = 0.0
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        # 共享目录中只保存数据，锁在读取时重新创建
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+    
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.lock = asyncio.Lock()
+
+class CandidateCache:
+    """游标 → 候选列表的 TTL + LRU 缓存
+    
+    shared_dir 为空时缓存在进程内。多进程模式下设置为各工作进程共享的本机目录（由主进程创建、退出时删除）：
+    每个列表一个 pickle 文件，文件 mtime 即最近使用时间，翻页时续期；扩展后的列表写回文件，
+    其他进程读到的是最新的列表。两个进程同时扩展同一列表时以后写入的为准（两者结果相同）。
+    """
+    
+    SHARED_SWEEP_EVERY = 32  # 共享目录模式下每创建这么多个列表清理一次过期 / 超量的文件
+    
+    def __init__(self, ttl_s: float = 300.0, max_entries: int = 2000):
+        self.configure(ttl_s, max_entries)
+        self._entries: "OrderedDict[str, CandidateList]" = OrderedDict()
+        self.created = 0
+        self.expired = 0
+    
+    def configure(self, ttl_s: float = 300.0, max_entries: int = 2000, shared_dir: Optional[str] = None):
+        self.ttl = max(0.0, ttl_s)
+        self.max_entries = max(1, max_entries)
+        self.shared_dir = shared_dir
+        if shared_dir:
+            os.makedirs(shared_dir, mode=0o700, exist_ok=True)
+    
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+    
+    def save(self, query: str, embedding: np.ndarray, cities: List[str], city_label: str, route: "ModelRoute",
+             candidates: List[Dict[str, Any]], first_page: List[Dict[str, Any]], retrieval_k: int,
+             max_distance: float, areas: Optional[Dict[str, List[str]]] = None,
+             near: Optional[Tuple[float, float, float]] = None, open_slot: Optional[int] = None) -> Optional[str]:
+        """缓存候选列表，返回第二页的游标；没有更多结果或未启用时返回 None"""
+        if not self.enabled or not first_page:
+            return None
+        shown = {_candidate_key(doc) for doc in first_page}
+        order = list(first_page) + [doc for doc in candidates if _candidate_key(doc) not in shown]
+        exhausted = len(candidates) < retrieval_k
+        if len(order) <= len(first_page) and exhausted:
+            return None
+        
+        entry = CandidateList(query, embedding, cities, city_label, route.embedding_name, route.reranker_name,
+                              order, len(first_page), retrieval_k, max_distance, exhausted, areas, near, open_slot)
+        entry_id = secrets.token_urlsafe(12)
+        entry.expires_at = time.time() + self.ttl
+        self.created += 1
+        if self.shared_dir:
+            self.store(entry_id, entry)
+            if self.created % self.SHARED_SWEEP_EVERY == 0:
+                self._sweep_shared()
+            return encode_cursor(entry_id, len(first_page))
+        self._entries[entry_id] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return encode_cursor(entry_id, len(first_page))
+    
+    def store(self, entry_id: str, entry: CandidateList):
+        """列表扩展后写回共享目录（进程内缓存直接修改了对象本身，无需写回）"""
+        if not self.shared_dir:
+            return
+        path = self._shared_path(entry_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    def _shared_path(self, entry_id: str) -> str:
+        return os.path.join(self.shared_dir, f"{entry_id}.pkl")
+    
+    def _get_shared(self, entry_id: str) -> Optional[CandidateList]:
+        # entry_id 来自客户端的游标，拼路径前只允许 token_urlsafe 的字符
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", entry_id):
+            return None
+        path = self._shared_path(entry_id)
+        try:
+            now = time.time()
+            if now > os.path.getmtime(path) + self.ttl:
+                os.remove(path)
+                self.expired += 1
+                return None
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            os.utime(path)  # 续期
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        entry.expires_at = now + self.ttl
+        return entry
+    
+    def _sweep_shared(self):
+        """删除过期的列表；超过 max_entries 时从最久未使用的开始删除"""
+        try:
+            files = [(e.stat().st_mtime, e.path) for e in os.scandir(self.shared_dir) if e.name.endswith(".pkl")]
+        except OSError:
+            return
+        files.sort()
+        cutoff = time.time() - self.ttl
+        excess = len(files) - self.max_entries
+        for i, (mtime, path) in enumerate(files):
+            if mtime >= cutoff and i >= excess:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def get(self, entry_id: str) -> Optional[CandidateList]:
+        """取出列表并续期；过期的列表删除"""
+        if self.shared_dir:
+            return self._get_shared(entry_id)
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return None
+        now = time.time()
+        if now > entry.expires_at:
+            del self._entries[entry_id]
+            self.expired += 1
+            return None
+        entry.expires_at = now + self.ttl
+        self._entries.move_to_end(entry_id)
+        return entry
+    
+    def stats(self) -> Dict[str, Any]:
+        if self.shared_dir:
+            try:
+                entries = sum(1 for name in os.listdir(self.shared_dir) if name.endswith(".pkl"))
+            except OSError:
+                entries = 0
+            # 共享目录模式：created / expired 为本进程的计数
+            return {"ttl_s": self.ttl, "shared_dir": self.shared_dir, "entries": entries,
+                    "created": self.created, "expired": self.expired}
+        return {
+            "ttl_s": self.ttl,
+            "entries": len(self._entries),
+            "created": self.created,
+            "expired": self.expired,
+            "cached_candidates": sum(len(e.order) for e in self._entries.values()),
+        }
+
+candidate_cache = CandidateCache()
+
+async def _extend_candidates(entry: CandidateList, needed: int):
+    """候选列表不够 needed 条时扩大检索范围（每次翻倍），只对新增候选做 rerank 后追加"""
+    async with models.route(entry.retriever, entry.reranker) as route:
+        vector_db = route.vector_db
+        total = sum(vector_db.indexes[c].ntotal for c in entry.cities if c in vector_db.indexes)
+        while len(entry.order) < needed and not entry.exhausted:
+            new_k = min(max(entry.retrieval_k * 2, needed), total)
+            if new_k <= entry.retrieval_k:
+                entry.exhausted = True
+                break
+            docs = await vector_db.search_cities_async(entry.embedding, cities=entry.cities, top_k=new_k,
+                                                      areas=entry.areas, near=entry.near, open_slot=entry.open_slot)
+            fresh = []
+            for rank, doc in enumerate(docs, 1):
+                if _candidate_key(doc) in entry.keys:
+                    continue
+                distance = doc.get('vector_score', 0)
+                doc['distance'] = float(distance)
+                doc['similarity'] = float(max(0.0, (entry.max_distance - distance) / entry.max_distance)) if entry.max_distance > 0 else 0.0
+                doc['rank'] = doc['original_rank'] = rank
+                fresh.append(doc)
+            
+            if fresh and route.reranker_model is not None:
+                pairs = [[entry.query, _format_document_for_rerank(doc)] for doc in fresh]
+                scores = await models.rerank_async(route.reranker_model, pairs, batch_size=1)
+                for doc, score in zip(fresh, scores):
+                    doc["rerank_score"] = float(score)
+                fresh.sort(key=lambda doc: doc["rerank_score"], reverse=True)
+            
+            entry.order.extend(fresh)
+            entry.keys.update(_candidate_key(doc) for doc in fresh)
+            entry.retrieval_k = new_k
+            entry.exhausted = len(docs) < new_k or new_k >= total
+            logger.debug("Extended candidate list", extra=_fields(retrieval_k=new_k, fresh=len(fresh), total=len(entry.order)))
+
+async def fetch_candidate_page(cursor: str, page_size: Optional[int] = None, allow_extend: bool = True) -> Dict:
+    """按游标返回下一页（结构与 perform_rag_search 相同）；游标过期返回 410"""
+    start_time = time.time()
+    try:
+        entry_id, offset = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    entry = candidate_cache.get(entry_id)
+    if entry is None:
+        CURSOR_PAGES.inc(result="expired")
+        raise HTTPException(status_code=410, detail="Cursor expired or unknown; run the search again")
+    
+    page_size = max(1, min(page_size or entry.page_size, 100))
+    extended = False
+    async with entry.lock:
+        if allow_extend and offset + page_size > len(entry.order) and not entry.exhausted:
+            await _extend_candidates(entry, offset + page_size)
+            extended = True
+            candidate_cache.store(entry_id, entry)
+    CURSOR_PAGES.inc(result="extended" if extended else "hit")
+    
+    page = [{**doc, "final_rank": offset + i + 1} for i, doc in enumerate(entry.order[offset:offset + page_size])]
+    next_offset = offset + len(page)
+    has_more = next_offset < len(entry.order) or (allow_extend and not entry.exhausted)
+    return {
+        "answer": f"在{entry.city_label}找到更多相关商户（第 {offset + 1}-{next_offset} 家）：" if page
+                  else f"在{entry.city_label}没有更多相关商户了",
+        "sources": page,
+        "metrics": {
+            "returned_count": len(page),
+            "offset": offset,
+            "city": entry.city_label,
+            "cities": entry.cities,
+            "cached_candidates": len(entry.order),
+            "extended": extended,
+            "retrieval_k": entry.retrieval_k,
+            "retriever": entry.retriever,
+            "reranker": entry.reranker,
+            "latency_ms": (time.time() - start_time) * 1000,
+        },
+        "processing_time": time.time() - start_time,
+        "next_cursor": encode_cursor(entry_id, next_offset) if page and has_more else None,
+    }
+
+# ==================== 响应裁剪与序列化 ====================
+# sources 默认返回商户的完整元数据和全部打分字段，而前端只用到其中几个。
+# 请求可用 fields 裁剪字段；结果直接编码为 JSON（可选 orjson），不再逐条经过 pydantic 校验；
+# 开启 --compression 后，大于 --compress-min-bytes 的响应按 Accept-Encoding 做 gzip / brotli 压缩。
+
+# 常用字段组合；未列出的字段在裁剪后丢弃，列出但商户没有的字段忽略
+SOURCE_FIELD_PROFILES: Dict[str, Optional[Tuple[str, ...]]] = {
+    "full": None,  # 全部字段（默认，兼容旧客户端）
+    # Web 前端 / Gradio 展示卡片用到的字段
+    "ui": ("name", "merchant_name", "category", "subcategory", "address", "city", "district", "business_area",
+           "landmark", "rating", "avg_price", "price", "phone", "business_hours", "open_now", "tags",
+           "description", "source_city", "score", "rerank_score", "vector_score", "similarity", "final_rank", "llm_rank"),
+    # MCP 工具输出给 Agent 的精简字段
+    "mcp": ("name", "address", "rating", "avg_price", "poi_type", "category", "district", "business_area",
+            "source_city", "rerank_score", "similarity", "final_rank"),
+    # 只要 ID 和排名（评测 / 批量任务）
+    "ids": MERCHANT_ID_FIELDS + ("name", "source_city", "final_rank", "rerank_score"),
+}
+
+RESPONSE_COMPRESSIONS = ("off", "gzip", "br")
+RESPONSE_BYTES = metrics_registry.register(Histogram(
+    "rag_response_bytes", "Search response body size on the wire", ("encoding",),
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304)))
+SERIALIZE_LATENCY = metrics_registry.register(Histogram(
+    "rag_serialize_seconds", "Time spent projecting, encoding and compressing search responses", ("encoding",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)))
+
+class ResponseEncoder:
+    """搜索响应的序列化与压缩配置"""
+    
+    def __init__(self):
+        self.compression = "off"
+        self.min_bytes = 4096
+    
+    def configure(self, compression: str = "off", min_bytes: int = 4096):
+        if compression == "br" and brotli is None:
+            logger.warning("⚠️  brotli is not installed, falling back to gzip compression")
+            compression = "gzip"
+        self.compression = compression
+        self.min_bytes = max(0, min_bytes)
+    
+    def choose_encoding(self, accept_encoding: Optional[str], size: int) -> Optional[str]:
+        """按服务端配置与客户端 Accept-Encoding 选择压缩算法；小响应不压缩"""
+        if self.compression == "off" or size < self.min_bytes or not accept_encoding:
+            return None
+        accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+        if self.compression == "br" and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+response_encoder = ResponseEncoder()
+
+def resolve_fields(fields: Union[List[str], str, None]) -> Optional[Tuple[str, ...]]:
+    """将请求的 fields 参数解析为字段元组；None 表示不裁剪"""
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        name = fields.strip().lower()
+        if name in SOURCE_FIELD_PROFILES:
+            return SOURCE_FIELD_PROFILES[name]
+        fields = fields.split(",")
+    return tuple(f.strip() for f in fields if f.strip()) or None
+
+def project_sources(sources: List[Dict[str, Any]], fields: Optional[Tuple[str, ...]]) -> List[Dict[str, Any]]:
+    """只保留 fields 中的字段（single-flight 共享的结果不会被修改）"""
+    if fields is None:
+        return sources
+    return [{key: doc[key] for key in fields if key in doc} for doc in sources]
+
+def _json_default(obj):
+    """标准库 json 不支持的类型（numpy 标量 / 数组、日期、集合）"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps_json(payload: Any) -> bytes:
+    """编码为 UTF-8 JSON；安装了 orjson 时使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+def search_response(result: Dict[str, Any], http_request: Request, fields: Union[List[str], str, None] = None,
+                    headers: Optional[Dict[str, str]] = None) -> Response:
+    """构建搜索响应：裁剪 sources → JSON 编码 → 按需压缩（跳过 SearchResult 的逐条校验）"""
+    start = time.time()
+    payload = {
+        "answer": result["answer"],
+        "sources": project_sources(result["sources"], resolve_fields(fields)),
+        "metrics": result["metrics"],
+        "reasoning_steps": result.get("reasoning_steps"),
+        "processing_time": result["processing_time"],
+        "next_cursor": result.get("next_cursor"),
+    }
+    body = dumps_json(payload)
+    headers = dict(headers or {})
+    encoding = response_encoder.choose_encoding(http_request.headers.get("accept-encoding"), len(body))
+    if encoding == "br":
+        body = brotli.compress(body, quality=4)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=5)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    if payload["next_cursor"]:
+        # 游标的有效期：缓存响应的代理不应在游标过期后继续返回该响应
+        headers["X-Cursor-TTL"] = str(int(candidate_cache.ttl))
+    if response_encoder.compression != "off":
+        headers["Vary"] = "Accept-Encoding"
+    label = encoding or "identity"
+    RESPONSE_BYTES.observe(len(body), encoding=label)
+    SERIALIZE_LATENCY.observe(time.time() - start, encoding=label)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # ==================== API 端点 ====================
 
 @app.get("/")
@@ -926,6 +3160,58 @@ def root():
         "timestamp": datetime.now().isoformat()
     }
 
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """记录在途请求数和端到端延迟（/metrics 自身不计入）"""
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    IN_FLIGHT.inc()
+    start = time.time()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        IN_FLIGHT.dec()
+        # 使用路由模板（如 /admin/merchants/{city}/upsert）作为标签，避免基数膨胀
+        route = request.scope.get("route")
+        REQUEST_LATENCY.observe(time.time() - start, path=getattr(route, "path", "other"), status=status)
+
+@app.middleware("http")
+async def request_log_middleware(request: Request, call_next):
+    """绑定 request id（沿用上游 X-Request-ID），并输出结构化访问日志"""
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    bind_request_context(request_id)
+    start = time.time()
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    logger.info("request", extra=_fields(
+        method=request.method, path=request.url.path, status=response.status_code,
+        latency_ms=round((time.time() - start) * 1000, 1)))
+    return response
+
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    """根据上游 traceparent 创建请求 span，并在响应中返回 trace id"""
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    with tracer.span("http.request", traceparent=request.headers.get("traceparent"), kind=SPAN_KIND_SERVER,
+                     method=request.method, path=request.url.path) as span:
+        response = await call_next(request)
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.status = "ERROR"
+        response.headers["X-Trace-Id"] = span.trace_id
+        return response
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus 抓取端点"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 def health_check():
     """健康检查"""
@@ -933,13 +3219,17 @@ def health_check():
     if models and models.vector_db:
         # CityVectorDB 使用 city_to_en 映射（中文 -> 英文）
         # indexes 和 metadata 的 key 是中文城市名
+        indexes = models.vector_db.indexes
+        metadata = models.vector_db.metadata
+        versions = models.vector_db.versions
         for city_cn, city_en in models.vector_db.city_to_en.items():
-            if city_cn in models.vector_db.indexes:
+            if city_cn in indexes:
                 cities_loaded[city_en] = {
-                "name": city_cn,
-                    "vectors": models.vector_db.indexes[city_cn].ntotal,
-                    "merchants": len(models.vector_db.metadata.get(city_cn, []))
-        }
+                    "name": city_cn,
+                    "vectors": indexes[city_cn].ntotal,
+                    "merchants": len(metadata.get(city_cn, [])),
+                    "version": versions.get(city_cn)
+                }
     
     return {
         "status": "healthy",
@@ -948,60 +3238,382 @@ def health_check():
         "models_loaded": {
             "embedding": models.embedding_model is not None if models else False,
             "reranker": models.reranker_model is not None if models else False,
+            "embedding_backend": models.embedding_backend if models else None,
+            "reranker_backend": models.reranker_backend if models else None,
             "vector_db": models.vector_db is not None if models else False
         },
         "cities": cities_loaded,
-        "total_cities": len(cities_loaded)
+        "total_cities": len(cities_loaded),
+        "single_flight": {
+            "executed": search_flight.executed,
+            "coalesced": search_flight.coalesced,
+            "abandoned": search_flight.abandoned,
+            "in_flight": search_flight.in_flight
+        },
+        "admission": admission.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "candidate_cache": candidate_cache.stats(),
+        "location_parser": location_parser.stats(),
+        "autocomplete": merchant_autocomplete.stats(),
+        "geo_indexes": models.vector_db.geo_stats() if models and models.vector_db else {},
+        "opening_hours": models.vector_db.hours_stats() if models and models.vector_db else {},
+        "search_batcher": search_batcher.stats(),
+        "model_registry": models.registry.stats() if models else None
     }
 
+def _resolve_open_at(request: RAGSearchRequest) -> Optional[datetime]:
+    """营业时间过滤的时刻：open_at > open_now=True（当前时间）> 查询中的“现在还营业”等说法；不过滤时返回 None"""
+    if request.open_at:
+        try:
+            open_at = datetime.fromisoformat(request.open_at.strip().replace("Z", "+00:00"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid open_at: {request.open_at!r} (expected ISO 8601)")
+        return open_at.astimezone(HOURS_TZ) if open_at.tzinfo else open_at.replace(tzinfo=HOURS_TZ)
+    if request.open_now or (request.open_now is None and OPEN_NOW_PATTERN.search(request.query)):
+        return datetime.now(HOURS_TZ)
+    return None
+
+async def _resolve_search_scope(request: "RAGSearchRequest") -> Tuple[
+        Union[List[str], str, None], Optional[Dict[str, List[str]]], Optional[QueryLocation],
+        Optional[Tuple[float, float, float]], Optional[datetime]]:
+    """按坐标 / 查询中的地点 / 营业时间解析本次搜索的 (cities, areas, location, near, open_at)"""
+    cities, areas, location, near = request.cities, None, None, None
+    explicit_city = cities is not None or "city" in request.model_fields_set
+    if (request.lat is None) != (request.lng is None) or (
+            request.lat is not None and _valid_coords(request.lat, request.lng) is None):
+        raise HTTPException(status_code=400, detail="lat and lng must be given together as valid coordinates")
+    if request.lat is not None:
+        near = (request.lat, request.lng, max(1.0, min(request.radius_m, GEO_MAX_RADIUS_M)))
+        # 未指定城市时按坐标所在城市路由（首次调用可能需要构建空间索引，放到线程池）
+        if not explicit_city and models and models.vector_db:
+            located = await asyncio.get_running_loop().run_in_executor(
+                None, models.vector_db.locate_city, request.lat, request.lng)
+            if located:
+                cities, explicit_city = [located], True
+    if request.auto_location:
+        if models and models.vector_db:
+            location_parser.refresh(models.vector_db.metadata)
+        location = location_parser.parse(request.query)
+        # 显式传了 city / cities（或已按坐标定位到城市）时不改写城市，只应用这些城市内的区域过滤
+        if location.cities and not explicit_city:
+            cities = location.cities
+            location.routed = True
+        areas = None if near else (location.areas or None)
+    return cities, areas, location, near, _resolve_open_at(request)
+
 @app.post("/api/rag/search", response_model=SearchResult)
-async def rag_search(request: RAGSearchRequest):
-    """RAG 搜索端点（支持多城市）"""
-    try:
-        result = await perform_rag_search(
-            query=request.query,
-            city=request.city,
-            top_k=request.top_k,
-            retriever=request.retriever,
-            reranker=request.reranker,
-            use_llm_ranking=request.use_llm_ranking
-        )
-        return SearchResult(**result)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def rag_search(request: RAGSearchRequest, http_request: Request, x_request_priority: Optional[str] = Header(None)):
+    """RAG 搜索端点（支持多城市；按查询中的地点自动路由与过滤；相同的并发请求只计算一次；
+    过载时按排队深度降级；客户端断开即取消）"""
+    priority = _request_priority(x_request_priority)
+    cities, areas, location, near, open_at = await _resolve_search_scope(request)
+    open_slot = week_slot(open_at) if open_at else None
+    
+    def flight_key(degrade_level: int) -> Tuple:
+        return _search_flight_key(request, request.use_llm_ranking and degrade_level < DEGRADE_NO_LLM,
+                                  degrade_level < DEGRADE_NO_RERANK, cities=cities, areas=areas, near=near,
+                                  open_slot=open_slot)
+    
+    async def run(degrade_level: int, follower=None) -> Response:
+        use_llm_ranking = request.use_llm_ranking and degrade_level < DEGRADE_NO_LLM
+        use_reranker = degrade_level < DEGRADE_NO_RERANK
+        headers = {"X-Degraded": str(degrade_level)} if degrade_level else {}
+        try:
+            if follower is not None:
+                result, coalesced = await run_until_disconnect(http_request, follower, endpoint="rag_search"), True
+            else:
+                result, coalesced = await run_until_disconnect(http_request, search_flight.do(
+                    flight_key(degrade_level),
+                    lambda: perform_rag_search(
+                        query=request.query,
+                        city=request.city,
+                        top_k=request.top_k,
+                        retriever=request.retriever,
+                        reranker=request.reranker,
+                        use_llm_ranking=use_llm_ranking,
+                        cities=cities,
+                        use_reranker=use_reranker,
+                        areas=areas,
+                        location=location,
+                        near=near,
+                        open_at=open_at
+                    )
+                ), endpoint="rag_search")
+            if coalesced:
+                CACHE_HITS.inc(cache="single_flight")
+            result = {**result, "metrics": {**result["metrics"], "coalesced": coalesced, "degrade_level": degrade_level}}
+            return search_response(result, http_request, request.fields, headers)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    
+    # 相同的请求正在计算：直接搭便车，不占用准入名额（不增加负载，也不应在过载时被拒绝）
+    degrade_level = admission.degrade_level()
+    follower = search_flight.join(flight_key(degrade_level))
+    if follower is not None:
+        return await run(degrade_level, follower)
+    async with admission.admit(priority) as degrade_level:
+        return await run(degrade_level)
+
+@app.post("/api/rag/search/next", response_model=SearchResult)
+async def rag_search_next(request: RAGPageRequest, http_request: Request, x_request_priority: Optional[str] = Header(None)):
+    """翻页：从缓存的候选列表中返回下一页；列表用完时才扩大检索（过载降级时只返回已缓存的部分）"""
+    async with admission.admit(_request_priority(x_request_priority)) as degrade_level:
+        try:
+            result = await run_until_disconnect(http_request, fetch_candidate_page(
+                request.cursor, request.page_size, allow_extend=degrade_level < DEGRADE_NO_RERANK
+            ), endpoint="rag_search_next")
+            headers = {"X-Degraded": str(degrade_level)} if degrade_level else {}
+            return search_response(result, http_request, request.fields, headers)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/rag/parse")
+def rag_parse(q: str):
+    """地点解析调试端点：返回查询中识别出的城市、区域和命中的词"""
+    if models and models.vector_db:
+        location_parser.refresh(models.vector_db.metadata)
+    return location_parser.parse(q).to_dict()
+
+@app.get("/api/autocomplete")
+async def autocomplete(q: str, city: Optional[str] = None, limit: int = 10):
+    """商户名 / 品牌前缀补全（按评分与人气排序）；不传 city 时在全部已加载城市中补全"""
+    if models is None or not models.vector_db:
+        raise HTTPException(status_code=503, detail="Vector database not loaded")
+    vector_db = models.vector_db
+    merchant_autocomplete.refresh(vector_db.metadata)
+    cities = vector_db.resolve_cities(city or "all")
+    unavailable = [c for c in cities if c not in vector_db.city_to_en]
+    if unavailable:
+        raise HTTPException(status_code=400, detail=f"City '{'、'.join(unavailable)}' not available")
+    
+    start = time.perf_counter()
+    with vector_db.acquire(cities) as handles:
+        suggestions = merchant_autocomplete.suggest(q, cities, max(1, min(limit, AUTOCOMPLETE_TOP_N)), handles)
+    elapsed = time.perf_counter() - start
+    AUTOCOMPLETE_LATENCY.observe(elapsed)
+    ready = set(merchant_autocomplete.ready_cities())
+    return {
+        "query": q,
+        "suggestions": suggestions,
+        "pending_cities": [c for c in cities if c not in ready],  # 索引仍在构建中的城市
+        "latency_us": round(elapsed * 1e6, 1),
+    }
 
 @app.post("/api/web/search", response_model=SearchResult)
-async def web_search(request: WebSearchRequest):
+async def web_search(request: WebSearchRequest, x_request_priority: Optional[str] = Header(None)):
     """Web 搜索端点"""
-    try:
-        result = perform_web_search(
-            query=request.query,
-            top_k=request.top_k
-        )
-        return SearchResult(**result)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    async with admission.admit(_request_priority(x_request_priority)):
+        try:
+            result = perform_web_search(
+                query=request.query,
+                top_k=request.top_k
+            )
+            return SearchResult(**result)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/agentic/search", response_model=SearchResult)
-async def agentic_search(request: AgenticSearchRequest):
+async def agentic_search(request: AgenticSearchRequest, x_request_priority: Optional[str] = Header(None)):
     """Agentic 搜索端点"""
+    async with admission.admit(_request_priority(x_request_priority)):
+        try:
+            result = perform_agentic_search(
+                query=request.query,
+                model=request.model,
+                max_iterations=request.max_iterations
+            )
+            return SearchResult(**result)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== 索引热更新（管理端点）====================
+
+def _check_admin_token(token: Optional[str]):
+    """管理端点要求请求头 X-Admin-Token 与 RAG_ADMIN_TOKEN 匹配
+    
+    未设置 RAG_ADMIN_TOKEN 时管理端点默认关闭（CORS 允许任意来源，不能无鉴权开放）；
+    仅本机调试时可显式设置 RAG_ADMIN_INSECURE=1 跳过鉴权。
+    """
+    expected = os.getenv("RAG_ADMIN_TOKEN")
+    if not expected:
+        if os.getenv("RAG_ADMIN_INSECURE") == "1":
+            return
+        raise HTTPException(status_code=403, detail="Admin API disabled: set RAG_ADMIN_TOKEN to enable it")
+    if token is None or not secrets.compare_digest(token.encode("utf-8"), expected.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+def _require_vector_db():
+    if not models or not models.vector_db:
+        raise HTTPException(status_code=503, detail="Vector database not loaded. Please check server configuration.")
+    return models.vector_db
+
+@app.get("/admin/indexes")
+def list_indexes(x_admin_token: Optional[str] = Header(None)):
+    """查看各城市当前生效的索引版本、引用计数和磁盘上可用的版本"""
+    _check_admin_token(x_admin_token)
+    vector_db = _require_vector_db()
+    with vector_db._lock:
+        handles = dict(vector_db._handles)
+    return {
+        "manifest": vector_db.manifest,
+        "startup_version": vector_db.index_version,
+        "available_versions": vector_db.list_versions(),
+        "cities": {
+            city: {
+                "version": handle.version,
+                "loaded_at": handle.loaded_at,
+                "in_flight": handle.refcount,
+                "vectors": handle.index.ntotal,
+                "device": handle.device_tag,
+                "index_type": type(handle.index).__name__,
+                "dimension": handle.index.d,
+                "delta_merchants": len(handle.delta_metadata),
+                "tombstones": len(handle.tombstones),
+                "live_merchants": handle.live_count,
+            }
+            for city, handle in handles.items()
+        },
+        "jobs": vector_db.recent_reload_jobs(10),
+    }
+
+@app.post("/admin/indexes/reload", status_code=202)
+def reload_indexes(request: IndexReloadRequest, x_admin_token: Optional[str] = Header(None)):
+    """后台加载新版本索引并逐城市原子切换，在途请求继续使用旧版本"""
+    _check_admin_token(x_admin_token)
+    vector_db = _require_vector_db()
+    
+    if isinstance(request.cities, str) and request.cities.strip().lower() == "all":
+        cities = list(vector_db.city_to_en.keys())
+    else:
+        cities = vector_db.resolve_cities(request.cities)
+    unknown = [c for c in cities if c not in vector_db.city_to_en]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown cities: {unknown}")
     try:
-        result = perform_agentic_search(
-            query=request.query,
-            model=request.model,
-            max_iterations=request.max_iterations
+        vector_db.check_version(request.version)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if request.version not in vector_db.list_versions():
+        raise HTTPException(status_code=404, detail=f"Index version '{request.version}' not found")
+    
+    try:
+        return vector_db.start_reload(request.version, cities)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/admin/indexes/jobs/{job_id}")
+def get_reload_job(job_id: str, x_admin_token: Optional[str] = Header(None)):
+    """查询热更新任务状态"""
+    _check_admin_token(x_admin_token)
+    vector_db = _require_vector_db()
+    job = vector_db.get_reload_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job
+
+# ==================== 商户增量更新（管理端点）====================
+
+def _require_city(vector_db, city: str):
+    if city not in vector_db.indexes:
+        raise HTTPException(
+            status_code=400,
+            detail=f"City '{city}' not available. Available cities: {list(vector_db.indexes.keys())}"
         )
-        return SearchResult(**result)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+def _require_mutable(vector_db):
+    """多进程模式下每个工作进程各有一份 delta 段，增量写入无法在进程间保持一致"""
+    if vector_db.shared:
+        raise HTTPException(
+            status_code=409,
+            detail="Incremental merchant updates are disabled with --workers > 1; build a new version and use /admin/indexes/reload"
+        )
+
+@app.post("/admin/merchants/{city}/upsert")
+async def upsert_merchants(city: str, request: MerchantUpsertRequest, x_admin_token: Optional[str] = Header(None)):
+    """新增或修改商户：只编码变更的商户并写入 delta 段，立即对检索可见"""
+    _check_admin_token(x_admin_token)
+    vector_db = _require_vector_db()
+    _require_city(vector_db, city)
+    _require_mutable(vector_db)
+    if not request.merchants:
+        return {"inserted": 0, "updated": 0}
+    
+    loop = asyncio.get_running_loop()
+    vectors = await loop.run_in_executor(None, models.encode_documents, request.merchants)
+    if vectors is None:
+        raise HTTPException(status_code=503, detail="Embedding model not loaded")
+    expected_dim = vector_db.indexes[city].d
+    if vectors.shape[1] != expected_dim:
+        # 默认 Embedding 模型与该城市索引不配套（如索引由另一个模型构建），写入后检索结果将毫无意义
+        raise HTTPException(
+            status_code=409,
+            detail=f"Embedding model outputs {vectors.shape[1]} dims but the {city} index expects {expected_dim}"
+        )
+    
+    try:
+        return await loop.run_in_executor(None, vector_db.upsert_merchants, city, request.merchants, vectors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/admin/merchants/{city}/delete")
+async def delete_merchants(city: str, request: MerchantDeleteRequest, x_admin_token: Optional[str] = Header(None)):
+    """删除（关店）商户：打墓碑，检索时过滤"""
+    _check_admin_token(x_admin_token)
+    vector_db = _require_vector_db()
+    _require_city(vector_db, city)
+    _require_mutable(vector_db)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, vector_db.delete_merchants, city, request.merchant_ids)
+
+@app.post("/admin/merchants/{city}/compact")
+async def compact_merchants(city: str, x_admin_token: Optional[str] = Header(None)):
+    """立即将 delta 段和墓碑合并进 base 段（通常由后台定期执行）"""
+    _check_admin_token(x_admin_token)
+    vector_db = _require_vector_db()
+    _require_city(vector_db, city)
+    _require_mutable(vector_db)
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(None, vector_db.compact_city, city)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return result or {"city": city, "message": "No pending changes"}
 
 @app.on_event("startup")
 async def startup_event():
     """服务启动时预加载模型和向量数据库"""
     global models
     
-    print("🚀 Starting LocalSearchBench RAG Server...")
-    print(f"📍 Device: {DEVICE}")
+    # 以导入字符串启动的工作进程（--workers > 1 / --reload）从环境变量取得 main() 中的配置
+    if SERVER_STATE_ENV in os.environ and not hasattr(app.state, 'data_dir'):
+        _apply_server_state(json.loads(os.environ[SERVER_STATE_ENV]))
+    
+    # 结构化日志（后台线程写出）
+    configure_logging(**getattr(app.state, 'logging', {}))
+    admission_config = getattr(app.state, 'admission', None)
+    if admission_config:
+        admission.configure(**admission_config)
+    embedding_batcher.configure(**getattr(app.state, 'embedding_batcher', {}))
+    response_encoder.configure(**getattr(app.state, 'response', {}))
+    candidate_cache.configure(**getattr(app.state, 'candidate_cache', {}))
+    search_batcher.configure(**getattr(app.state, 'search_batcher', {'max_batch_size': 64, 'max_wait_ms': 1.0}))
+    logger.info("🚀 Starting LocalSearchBench RAG Server...")
+    logger.info(f"📍 Device: {DEVICE}")
+    
+    # 链路追踪
+    tracer.configure(
+        sample_rate=getattr(app.state, 'trace_sample_rate', 0.0),
+        export_target=getattr(app.state, 'trace_export', None)
+    )
+    
+    # 显式创建事件循环的默认线程池，便于监控排队深度
+    executor_workers = getattr(app.state, 'executor_workers', None) or min(32, (os.cpu_count() or 1) + 4)
+    default_executor = ObservedExecutor(max_workers=executor_workers, thread_name_prefix="rag-worker")
+    asyncio.get_running_loop().set_default_executor(default_executor)
     
     # 获取配置
     data_dir = getattr(app.state, 'data_dir', None)
@@ -1009,60 +3621,148 @@ async def startup_event():
     reranker_model_path = getattr(app.state, 'reranker_model_path', None)
     use_gpu = getattr(app.state, 'use_gpu', True)  # 默认使用 GPU
     config_path = getattr(app.state, 'config_path', None)  # LLM 配置文件路径
+    index_version = getattr(app.state, 'index_version', None)  # 覆盖 manifest 中的索引版本
+    shared_indexes = getattr(app.state, 'shared_indexes', False)  # 多进程模式：mmap 共享只读索引
+    model_server = getattr(app.state, 'model_server', None)  # 多进程模式：模型服务进程地址
+    
+    # FAISS OpenMP 线程数：未指定时各工作进程平分 CPU 核心，避免互相争抢
+    workers = getattr(app.state, 'workers', 1)
+    configure_faiss_threads(getattr(app.state, 'faiss_threads', None) or max(1, (os.cpu_count() or 1) // workers))
     
     # 初始化模型（包括向量数据库和 LLM 精排器）
-    models = RAGModels(data_dir=data_dir, use_gpu=use_gpu, config_path=config_path)
+    models = RAGModels(data_dir=data_dir, use_gpu=use_gpu, config_path=config_path, index_version=index_version,
+                       shared_indexes=shared_indexes)
+    backend = "torch" if DEVICE == "cuda" else getattr(app.state, 'cpu_backend', 'int8')
+    models.configure_registry(getattr(app.state, 'model_registry', None),
+                              getattr(app.state, 'model_memory_budget_gb', None), backend)
     
-    # 预加载模型到 GPU
+    if model_server:
+        models.connect_model_server(model_server["address"], bytes.fromhex(model_server["authkey"]))
+        _finish_vector_db_startup()
+        return
+    
+    # 预加载模型：GPU 使用 torch；CPU 使用量化 / ONNX 后端并固定线程数
     if DEVICE == "cuda":
-        print("\n📥 Pre-loading models to GPU...")
-        
-        # 加载 Embedding 模型
-        if embedding_model_path:
-            models.load_embedding_model(embedding_model_path)
-        else:
-            print("⚠️  No embedding model path specified, using default")
-            models.load_embedding_model()
-        
-        # 加载 Reranker 模型
-        if reranker_model_path:
-            models.load_reranker_model(reranker_model_path)
-        else:
-            print("⚠️  No reranker model path specified, using default")
-            models.load_reranker_model()
-        
-        print("✅ Models loaded successfully")
+        logger.info("📥 Pre-loading models to GPU...")
+        backend = "torch"
     else:
-        print("⚠️ Running in CPU mode")
+        backend = getattr(app.state, 'cpu_backend', 'int8')
+        logger.info(f"📥 Pre-loading models for CPU serving (backend={backend})...")
+        configure_cpu_threads(getattr(app.state, 'cpu_threads', None))
     
-    # 检查向量数据库状态
+    # 加载 Embedding 模型
+    if embedding_model_path:
+        models.load_embedding_model(embedding_model_path, backend=backend)
+    else:
+        logger.warning("⚠️  No embedding model path specified, using default")
+        models.load_embedding_model(backend=backend)
+    
+    # 加载 Reranker 模型
+    if reranker_model_path:
+        models.load_reranker_model(reranker_model_path, backend=backend)
+    else:
+        logger.warning("⚠️  No reranker model path specified, using default")
+        models.load_reranker_model(backend=backend)
+    
+    logger.info("✅ Models loaded successfully")
+    models.warmup()
+    _finish_vector_db_startup()
+
+def _finish_vector_db_startup():
+    """检查向量数据库状态，启动后台压缩（单进程）或 manifest 跟随（多进程）"""
     if models.vector_db:
-        print(f"\n✅ Vector databases ready: {len(models.vector_db.indexes)} cities loaded")
+        logger.info(f"✅ Vector databases ready: {len(models.vector_db.indexes)} cities loaded")
+        # 地点解析：城市 / 省份词典立即可用，区域词典、区域倒排和空间索引需要扫描全部元数据，放到后台线程构建
+        vector_db = models.vector_db
+        admin_geojson = getattr(app.state, 'admin_geojson', None)
+        location_parser.build(vector_db.city_to_en, admin_geojson)
+        
+        def _build_filters():
+            location_parser.build(vector_db.city_to_en, admin_geojson, vector_db.metadata)
+            vector_db.warm_filters()
+        
+        threading.Thread(target=_build_filters, name="location-parser", daemon=True).start()
+        merchant_autocomplete.refresh(vector_db.metadata)
+        compact_interval = getattr(app.state, 'compact_interval', 600)
+        if models.vector_db.shared:
+            jobs_dir = getattr(app.state, 'jobs_dir', None)
+            if jobs_dir:
+                models.vector_db.share_reload_jobs(jobs_dir)
+            models.vector_db.start_manifest_watcher()
+        elif compact_interval and compact_interval > 0:
+            models.vector_db.start_compactor(
+                interval_s=compact_interval,
+                min_changes=getattr(app.state, 'compact_min_changes', 1),
+                keep_versions=getattr(app.state, 'compact_keep_versions', None)
+            )
     else:
-        print("\n⚠️  No vector databases loaded. Please specify --data-dir")
+        logger.warning("⚠️  No vector databases loaded. Please specify --data-dir")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """服务关闭时清理资源"""
-    print("👋 Shutting down LocalSearchBench RAG Server...")
+    logger.info("👋 Shutting down LocalSearchBench RAG Server...")
+    if models and models.vector_db:
+        models.vector_db.stop_compactor()
+        models.vector_db.stop_manifest_watcher()
     # 清理 GPU 显存
     if DEVICE == "cuda" and 'torch' in globals():
         torch.cuda.empty_cache()
+    shutdown_logging()
 
 # ==================== 主函数 ====================
 
+# 以导入字符串启动 uvicorn 时，配置通过该环境变量传给工作进程
+SERVER_STATE_ENV = "RAG_SERVER_STATE"
+
+def _apply_server_state(state: Dict[str, Any]):
+    """将配置保存到 app.state 供 startup_event 使用"""
+    for key, value in state.items():
+        setattr(app.state, key, value)
+
 def main():
     parser = argparse.ArgumentParser(description="LocalSearchBench RAG Server")
     parser.add_argument("--host", type=str, default="0.0.0.0", help="Host to bind")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind")
-    parser.add_argument("--data-dir", type=str, default=None, help="Path to vector database directory (containing 1028 FAISS files)")
+    parser.add_argument("--data-dir", type=str, default=None, help="Path to vector database directory (manifest.json + versions/, or legacy flat FAISS files)")
     parser.add_argument("--embedding-model", type=str, default=None, help="Path to Qwen3-Embedding-8B model")
     parser.add_argument("--reranker-model", type=str, default=None, help="Path to Qwen3-Reranker-8B model")
     parser.add_argument("--config", type=str, default=None, help="Path to config.yaml for LLM ranking")
+    parser.add_argument("--index-version", type=str, default=None, help="Index version to load for all cities (overrides manifest.json)")
+    parser.add_argument("--cpu-backend", type=str, default="int8", choices=CPU_BACKENDS, help="Model backend when no GPU is available (default: int8)")
+    parser.add_argument("--cpu-threads", type=int, default=None, help="Fixed thread count for CPU model inference")
+    parser.add_argument("--executor-workers", type=int, default=None, help="Worker threads for blocking model/index calls (default: min(32, cpus + 4))")
+    parser.add_argument("--trace-sample-rate", type=float, default=float(os.getenv("RAG_TRACE_SAMPLE_RATE", "0")), help="Fraction of new traces to sample (sampled parents are always followed)")
+    parser.add_argument("--trace-export", type=str, default=os.getenv("RAG_TRACE_EXPORT"), help="Span export target: a JSONL file path (file:/path) or an http(s) collector URL")
+    parser.add_argument("--log-level", type=str, default=os.getenv("RAG_LOG_LEVEL", "info"), choices=["debug", "info", "warning", "error"], help="Server log level")
+    parser.add_argument("--log-format", type=str, default=os.getenv("RAG_LOG_FORMAT", "json"), choices=LOG_FORMATS, help="json (one object per line) or text")
+    parser.add_argument("--log-file", type=str, default=os.getenv("RAG_LOG_FILE"), help="Write logs to this file instead of stdout")
+    parser.add_argument("--log-debug-sample-rate", type=float, default=float(os.getenv("RAG_LOG_DEBUG_SAMPLE_RATE", "1.0")), help="Fraction of requests whose DEBUG logs are kept (with --log-level debug)")
+    parser.add_argument("--access-log", action="store_true", help="Also enable uvicorn's plain-text access log")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="Search requests processed concurrently; the rest wait in the admission queue")
+    parser.add_argument("--max-queue", type=int, default=64, help="Admission queue length; beyond it requests are shed with 429/503")
+    parser.add_argument("--queue-timeout", type=float, default=5.0, help="Seconds a request may wait for admission before a 503")
+    parser.add_argument("--degrade-llm-at", type=float, default=0.25, help="Queue fill ratio at which LLM ranking is switched off")
+    parser.add_argument("--degrade-rerank-at", type=float, default=0.75, help="Queue fill ratio at which reranking is also switched off")
+    parser.add_argument("--embed-batch-size", type=int, default=32, help="Max queries from concurrent requests encoded in one embedding batch (1 disables batching)")
+    parser.add_argument("--embed-batch-wait-ms", type=float, default=2.0, help="How long the first query of a batch waits for others to join")
+    parser.add_argument("--search-batch-size", type=int, default=64, help="Max query vectors from concurrent requests searched in one FAISS call per city (1 disables batching)")
+    parser.add_argument("--search-batch-wait-ms", type=float, default=1.0, help="How long the first query vector of a search batch waits for others to join")
+    parser.add_argument("--faiss-threads", type=int, default=int(os.getenv("RAG_FAISS_THREADS", "0")) or None, help="OpenMP threads per FAISS search (default: cpus / workers)")
+    parser.add_argument("--compression", type=str, default="off", choices=RESPONSE_COMPRESSIONS, help="Compress large search responses for clients that accept it (br falls back to gzip)")
+    parser.add_argument("--compress-min-bytes", type=int, default=4096, help="Only compress responses at least this large")
+    parser.add_argument("--cursor-ttl", type=float, default=300, help="Seconds a search's candidate list is kept for next_cursor pagination (0 disables)")
+    parser.add_argument("--cursor-max-entries", type=int, default=2000, help="Max cached candidate lists (least recently used are dropped)")
+    parser.add_argument("--admin-geojson", type=str, default=os.getenv("RAG_ADMIN_GEOJSON", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "china_full.json")), help="GeoJSON with admin-region names used by the query location parser")
+    parser.add_argument("--model-registry", type=str, default=os.getenv("RAG_MODEL_REGISTRY"), help="YAML file of named embedding/reranker models selectable per request via retriever/reranker")
+    parser.add_argument("--model-memory-budget-gb", type=float, default=None, help="Memory budget for lazily loaded registry models; least recently used idle models are evicted beyond it")
+    parser.add_argument("--compact-interval", type=float, default=600, help="Seconds between background compactions of incremental merchant updates (0 disables)")
+    parser.add_argument("--compact-min-changes", type=int, default=1, help="Minimum pending upserts/deletions before a city is compacted")
+    parser.add_argument("--compact-keep-versions", type=int, default=3, help="Compacted index versions kept per city; older ones are deleted after each compaction")
     parser.add_argument("--use-gpu", action="store_true", default=True, help="Use GPU for FAISS vector search (default: True)")
     parser.add_argument("--no-gpu", action="store_true", help="Force CPU mode for FAISS vector search")
     parser.add_argument("--reload", action="store_true", help="Enable auto-reload")
-    parser.add_argument("--workers", type=int, default=1, help="Number of workers")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes; >1 shares mmap'd indexes and serves models from one model-server process")
     
     args = parser.parse_args()
     
@@ -1071,16 +3771,66 @@ def main():
     embedding_model_path = args.embedding_model or os.getenv("EMBEDDING_MODEL_PATH")
     reranker_model_path = args.reranker_model or os.getenv("RERANKER_MODEL_PATH")
     config_path = args.config or os.getenv("TUANSOU_CONFIG") or os.getenv("CONFIG_PATH")
+    index_version = args.index_version or os.getenv("RAG_INDEX_VERSION")
     
     # GPU 配置
     use_gpu = args.use_gpu and not args.no_gpu
     
-    # 将配置保存到全局变量供 startup_event 使用
-    app.state.data_dir = data_dir
-    app.state.embedding_model_path = embedding_model_path
-    app.state.reranker_model_path = reranker_model_path
-    app.state.use_gpu = use_gpu
-    app.state.config_path = config_path
+    # 多进程模式
+    multiprocess = args.workers > 1
+    
+    # 将配置保存到 app.state 供 startup_event 使用（必须可 JSON 序列化，多进程时经环境变量传递）
+    state = {
+        "data_dir": data_dir,
+        "embedding_model_path": embedding_model_path,
+        "reranker_model_path": reranker_model_path,
+        "use_gpu": use_gpu,
+        "config_path": config_path,
+        "index_version": index_version,
+        "compact_interval": args.compact_interval,
+        "executor_workers": args.executor_workers,
+        "trace_sample_rate": args.trace_sample_rate,
+        "trace_export": args.trace_export,
+        "cpu_backend": args.cpu_backend,
+        "cpu_threads": args.cpu_threads or (int(os.getenv("RAG_CPU_THREADS")) if os.getenv("RAG_CPU_THREADS") else None),
+        "compact_min_changes": args.compact_min_changes,
+        "compact_keep_versions": args.compact_keep_versions,
+        "workers": args.workers,
+        "shared_indexes": multiprocess,
+        "embedding_batcher": {
+            "max_batch_size": args.embed_batch_size,
+            "max_wait_ms": args.embed_batch_wait_ms,
+        },
+        "search_batcher": {
+            "max_batch_size": args.search_batch_size,
+            "max_wait_ms": args.search_batch_wait_ms,
+        },
+        "faiss_threads": args.faiss_threads,
+        "candidate_cache": {
+            "ttl_s": args.cursor_ttl,
+            "max_entries": args.cursor_max_entries,
+        },
+        "response": {
+            "compression": args.compression,
+            "min_bytes": args.compress_min_bytes,
+        },
+        "admin_geojson": args.admin_geojson,
+        "model_registry": args.model_registry,
+        "model_memory_budget_gb": args.model_memory_budget_gb,
+        "admission": {
+            "max_in_flight": args.max_in_flight,
+            "max_queue": args.max_queue,
+            "queue_timeout": args.queue_timeout,
+            "degrade_llm_at": args.degrade_llm_at,
+            "degrade_rerank_at": args.degrade_rerank_at,
+        },
+        "logging": {
+            "level": args.log_level,
+            "fmt": args.log_format,
+            "debug_sample_rate": args.log_debug_sample_rate,
+            "log_file": args.log_file,
+        },
+    }
     
     print(f"""
 ╔═══════════════════════════════════════════════════════════╗
@@ -1092,14 +3842,42 @@ def main():
 ╚═══════════════════════════════════════════════════════════╝
     """)
     
-    uvicorn.run(
-        app,  # 直接传入 app 对象，而不是字符串
-        host=args.host,
-        port=args.port,
-        reload=args.reload,
-        workers=args.workers,
-        log_level="info"
-    )
+    model_server_process = None
+    shared_dir = None
+    if multiprocess:
+        # 请求会落到任意工作进程：翻页用的候选列表和热更新任务状态放在各进程共享的目录中
+        shared_dir = tempfile.mkdtemp(prefix="rag-shared-")
+        if args.cursor_ttl > 0:
+            state["candidate_cache"]["shared_dir"] = os.path.join(shared_dir, "cursors")
+        state["jobs_dir"] = os.path.join(shared_dir, "jobs")
+        print(f"🧠 Starting model server for {args.workers} workers...")
+        model_server_process, address, authkey = start_model_server(state)
+        state["model_server"] = {"address": address, "authkey": authkey.hex()}
+    
+    if multiprocess or args.reload:
+        # uvicorn 只有拿到导入字符串才能启动多个工作进程 / 自动重载
+        os.environ[SERVER_STATE_ENV] = json.dumps(state)
+        target = "rag_server:app"
+    else:
+        _apply_server_state(state)
+        target = app
+    
+    try:
+        uvicorn.run(
+            target,
+            app_dir=os.path.dirname(os.path.abspath(__file__)),
+            host=args.host,
+            port=args.port,
+            reload=args.reload,
+            workers=args.workers,
+            log_level=args.log_level,
+            access_log=args.access_log  # 访问日志由 request_log_middleware 以结构化形式输出
+        )
+    finally:
+        if model_server_process is not None:
+            model_server_process.terminate()
+        if shared_dir is not None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,172 @@
+"""
+模型注册表：按名称路由到不同的 Embedding / Reranker 模型，首次使用时加载，超出内存预算时按 LRU 淘汰
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import yaml
+
+from observability import Counter, logger, metrics_registry
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# ==================== 模型注册表 ====================
+# 按请求中的 retriever / reranker 名称路由到不同模型，便于在线 A/B 对比而无需另起部署。
+# 注册表中的模型在首次使用时加载，已加载模型总大小超过内存预算时按 LRU 淘汰（正在使用的不淘汰）。
+# 每个 Embedding 模型绑定一个索引版本（用该模型构建的向量），淘汰模型时一并释放其索引。
+# 未注册的名称使用启动时加载的默认模型与默认索引。
+
+MODEL_LOADS = metrics_registry.register(Counter(
+    "rag_model_loads_total", "Registry models loaded on demand", ("kind", "model")))
+MODEL_EVICTIONS = metrics_registry.register(Counter(
+    "rag_model_evictions_total", "Registry models evicted to stay within the memory budget", ("kind", "model")))
+
+class RegisteredModel:
+    """注册表中的一个模型；model 为 None 表示尚未加载或已被淘汰"""
+    
+    def __init__(self, kind: str, name: str, path: str, backend: Optional[str] = None,
+                 index_version: Optional[str] = None):
+        self.kind = kind  # embedding / reranker
+        self.name = name
+        self.path = path
+        self.backend = backend
+        self.index_version = index_version  # 仅 Embedding：与该模型配套的索引版本
+        self.model = None
+        self.vector_db: Optional["CityVectorDB"] = None
+        self.owns_vector_db = False  # 索引由注册表为该模型单独加载（而非共用主索引），淘汰时才关闭
+        self.loaded_backend = None
+        self.nbytes = 0
+        self.refcount = 0
+        self.last_used = 0.0
+        self.load_lock = threading.Lock()
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "index_version": self.index_version,
+            "loaded": self.model is not None,
+            "backend": self.loaded_backend,
+            "memory_mb": round(self.nbytes / 1024 / 1024, 1),
+            "in_use": self.refcount,
+        }
+
+class ModelRegistry:
+    """按 (kind, name) 管理可选模型：懒加载 + 内存预算内的 LRU 淘汰"""
+    
+    def __init__(self, loader, memory_budget_bytes: Optional[int] = None):
+        self._loader = loader  # loader(entry)：填充 entry.model / nbytes / vector_db
+        self.memory_budget = memory_budget_bytes
+        self._entries: Dict[Tuple[str, str], RegisteredModel] = {}
+        self._loaded: "OrderedDict[Tuple[str, str], RegisteredModel]" = OrderedDict()  # 最近使用的在末尾
+        self._lock = threading.Lock()
+    
+    def register(self, kind: str, name: str, path: str, backend: Optional[str] = None,
+                 index_version: Optional[str] = None) -> RegisteredModel:
+        entry = RegisteredModel(kind, name.strip().lower(), path, backend, index_version)
+        self._entries[(kind, entry.name)] = entry
+        return entry
+    
+    def get(self, kind: str, name: Optional[str]) -> Optional[RegisteredModel]:
+        return self._entries.get((kind, name.strip().lower())) if name else None
+    
+    @property
+    def loaded_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._loaded.values())
+    
+    def try_acquire(self, entry: RegisteredModel) -> bool:
+        """模型已加载时直接占用（引用计数 +1），不会阻塞"""
+        with self._lock:
+            if entry.model is None:
+                return False
+            self._touch(entry)
+            return True
+    
+    def acquire(self, entry: RegisteredModel) -> RegisteredModel:
+        """占用模型，未加载时先加载（阻塞，应在线程池中调用）"""
+        if self.try_acquire(entry):
+            return entry
+        with entry.load_lock:
+            # 等锁期间可能已被其他请求加载
+            if not self.try_acquire(entry):
+                start = time.time()
+                try:
+                    self._loader(entry)
+                except Exception:
+                    # 加载失败（如维度不匹配）时不留下半加载的模型和索引
+                    self._unload(entry)
+                    raise
+                MODEL_LOADS.inc(kind=entry.kind, model=entry.name)
+                logger.info(f"📥 Registry {entry.kind} model '{entry.name}' loaded in {time.time() - start:.1f}s "
+                            f"({entry.nbytes / 1024 / 1024:.0f} MB)")
+                with self._lock:
+                    self._touch(entry)
+                    self._evict_over_budget()
+        return entry
+    
+    def release(self, entry: RegisteredModel):
+        with self._lock:
+            entry.refcount -= 1
+            self._evict_over_budget()
+    
+    def _touch(self, entry: RegisteredModel):
+        entry.refcount += 1
+        entry.last_used = time.time()
+        self._loaded[(entry.kind, entry.name)] = entry
+        self._loaded.move_to_end((entry.kind, entry.name))
+    
+    def _evict_over_budget(self):
+        """从最久未使用的开始淘汰，直到不超过预算（调用方持有 self._lock）"""
+        if self.memory_budget is None:
+            return
+        evicted = False
+        for key, entry in list(self._loaded.items()):
+            if self.loaded_bytes <= self.memory_budget:
+                break
+            if entry.refcount > 0:
+                continue
+            del self._loaded[key]
+            self._unload(entry)
+            MODEL_EVICTIONS.inc(kind=entry.kind, model=entry.name)
+            logger.info(f"♻️  Evicted registry {entry.kind} model '{entry.name}'")
+            evicted = True
+        if evicted and torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
+    @staticmethod
+    def _unload(entry: RegisteredModel):
+        """释放模型；共用的主索引不关闭，只关闭为该模型单独加载的索引"""
+        if entry.owns_vector_db and entry.vector_db is not None:
+            entry.vector_db.close()
+        entry.model = entry.vector_db = None
+        entry.owns_vector_db = False
+        entry.nbytes = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_budget_mb": round(self.memory_budget / 1024 / 1024) if self.memory_budget is not None else None,
+                "loaded_mb": round(self.loaded_bytes / 1024 / 1024, 1),
+                "models": {f"{kind}:{name}": entry.to_dict() for (kind, name), entry in self._entries.items()},
+            }
+
+class ModelRoute:
+    """一次请求实际使用的 Embedding（及其索引）与 Reranker"""
+    
+    def __init__(self, embedding_model, vector_db, embedding_name: str, reranker_model, reranker_name: Optional[str]):
+        self.embedding_model = embedding_model
+        self.vector_db = vector_db
+        self.embedding_name = embedding_name
+        self.reranker_model = reranker_model
+        self.reranker_name = reranker_name
+
+def load_registry_file(path: str) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """读取模型注册表（YAML / JSON）：{"embedding": {name: {path, index_version, backend}}, "reranker": {...}}"""
+    with open(path, "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    return {kind: config.get(kind) or {} for kind in ("embedding", "reranker")}
@@ -0,0 +1,35 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# 测试直接导入 server/ 下的模块（与 benchmark_cpu_inference.py、evaluate_pipeline.py 相同）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_city_version(data_dir, city_en, version, n=8, d=4, seed=0, docs=None, vectors=None, metric=None):
+    """在 versions/{version}/ 下写一个小的 IndexFlat（默认内积）及其元数据；不传 vectors 时随机生成"""
+    import faiss
+
+    if vectors is None:
+        rng = np.random.default_rng(seed)
+        vectors = rng.random((n, d), dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    index = faiss.IndexFlat(d, faiss.METRIC_INNER_PRODUCT if metric is None else metric)
+    index.add(vectors)
+    version_dir = os.path.join(data_dir, "versions", version)
+    os.makedirs(version_dir, exist_ok=True)
+    filename = os.path.join(version_dir, f"faiss_merchant_index_vllm_{city_en}_{version}")
+    faiss.write_index(index, f"{filename}.faiss")
+    docs = docs or [{"merchant_id": f"{city_en}-{i}", "name": f"商户{i}"} for i in range(n)]
+    with open(f"{filename}_metadata.json", "w", encoding="utf-8") as f:
+        json.dump(docs, f, ensure_ascii=False)
+    return vectors
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return str(tmp_path)
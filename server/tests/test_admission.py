@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from admission import AdmissionController
+from rag_server import SingleFlight
+
+
+async def _fill(controller, priorities):
+    """占满处理名额后按顺序排队，返回排队中的任务"""
+    await controller._acquire("interactive")
+    tasks = [asyncio.ensure_future(controller._acquire(p)) for p in priorities]
+    await asyncio.sleep(0)
+    return tasks
+
+
+async def _drain(tasks):
+    for task in tasks:
+        task.cancel()
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_lower_priority_cannot_evict_beyond_its_share():
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=5)
+        tasks = await _fill(controller, ["eval"] + ["interactive"] * 3)
+        assert controller.queued == 4
+        with pytest.raises(HTTPException) as exc_info:
+            await controller._acquire("batch")
+        assert exc_info.value.status_code == 429
+        assert controller.queued == 4 and not any(t.done() for t in tasks)
+        await _drain(tasks)
+    asyncio.run(run())
+
+
+def test_interactive_evicts_lowest_priority_when_full():
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queue=2, queue_timeout=5)
+        tasks = await _fill(controller, ["batch", "eval"])
+        waiter = asyncio.ensure_future(controller._acquire("interactive"))
+        await asyncio.sleep(0)
+        assert tasks[1].done() and isinstance(tasks[1].exception(), HTTPException)
+        assert not tasks[0].done() and controller.queued == 2
+        await _drain([tasks[0], waiter])
+    asyncio.run(run())
+
+
+def test_single_flight_join_shares_running_call():
+    async def run():
+        flight = SingleFlight()
+        assert flight.join("k") is None
+        release = asyncio.Event()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        leader = asyncio.ensure_future(flight.do("k", compute))
+        await asyncio.sleep(0)
+        follower = flight.join("k")
+        leader.cancel()  # 发起者离开后，已登记的跟随者仍能拿到结果
+        await asyncio.sleep(0)
+        release.set()
+        assert await follower == "result"
+        assert calls == [1] and flight.coalesced == 1 and flight.abandoned == 0
+    asyncio.run(run())
@@ -0,0 +1,40 @@
+import random
+
+from filter_index import AhoCorasick
+
+
+def _brute_force(patterns, text):
+    return sorted((i, i + len(p), p) for p in patterns for i in range(len(text)) if text.startswith(p, i))
+
+
+def test_overlapping_and_nested_matches():
+    patterns = ["he", "she", "his", "hers", "浦东", "浦东新区", "东新"]
+    automaton = AhoCorasick()
+    for pattern in patterns:
+        automaton.add(pattern, pattern)
+    automaton.build()
+
+    text = "ushers 去浦东新区"
+    assert sorted(automaton.find_all(text)) == _brute_force(patterns, text)
+
+
+def test_matches_brute_force_on_random_text():
+    rng = random.Random(0)
+    patterns = sorted({"".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(30)})
+    automaton = AhoCorasick()
+    for pattern in patterns:
+        automaton.add(pattern, pattern)
+    automaton.build()
+
+    for _ in range(20):
+        text = "".join(rng.choice("abcd") for _ in range(50))
+        assert sorted(automaton.find_all(text)) == _brute_force(patterns, text)
+
+
+def test_duplicate_patterns_keep_every_payload():
+    automaton = AhoCorasick()
+    automaton.add("朝阳", ("北京", "district"))
+    automaton.add("朝阳", ("长春", "district"))
+    automaton.build()
+    assert automaton.find_all("朝阳大悦城") == [(0, 2, ("北京", "district")), (0, 2, ("长春", "district"))]
+    assert automaton.find_all("") == []
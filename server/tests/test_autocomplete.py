@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import filter_index
+from filter_index import MerchantAutocomplete, PrefixIndex
+from rag_server import CityVectorDB
+from conftest import write_city_version
+
+DOCS = [
+    {"merchant_id": "1", "name": "星巴克(国贸店)", "rating": 4.5, "review_count": 900},
+    {"merchant_id": "2", "name": "星巴克(三里屯店)", "rating": 4.0, "review_count": 100},
+    {"merchant_id": "3", "name": "海底捞火锅", "rating": 4.8, "review_count": 5000},
+    {"merchant_id": "4", "name": "喜茶", "brand": "HEYTEA", "rating": 4.2, "review_count": 300},
+]
+
+
+def test_prefix_lookup_ranks_by_popularity_and_dedupes_aliases():
+    index = PrefixIndex(DOCS)
+    rows = [row for _, row in index.lookup("星巴克", 10)]
+    assert rows == [0, 1]  # “星巴克”同时是两家店的品牌别名，每家只出现一次
+    assert [row for _, row in index.lookup("ＨＥＹ", 10)] == [3]  # 全角、大小写规范化
+    assert index.lookup("不存在", 10) == []
+    assert index.lookup("  ", 10) == []
+
+
+def test_prefix_lookup_hot_prefixes_respect_exclusions(monkeypatch):
+    monkeypatch.setattr(filter_index, "AUTOCOMPLETE_HOT_RANGE", 2)
+    monkeypatch.setattr(filter_index, "AUTOCOMPLETE_TOP_N", 2)
+    docs = [{"merchant_id": str(i), "name": f"星巴克{i}", "rating": i} for i in range(6)]
+    index = PrefixIndex(docs)
+    assert "星" in index.hot
+    assert [row for _, row in index.lookup("星", 2)] == [5, 4]
+    assert [row for _, row in index.lookup("星", 2, frozenset({5, 4}))] == [3, 2]
+
+
+@pytest.fixture
+def vector_db(data_dir):
+    write_city_version(data_dir, "shanghai", "v1", n=len(DOCS), docs=DOCS)
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    yield db
+    db.close()
+
+
+def _suggest(autocomplete, db, prefix):
+    with db.acquire(["上海"]) as handles:
+        return [s["name"] for s in autocomplete.suggest(prefix, ["上海"], 10, handles)]
+
+
+def test_suggestions_follow_deletes_and_upserts(vector_db):
+    autocomplete = MerchantAutocomplete()
+    autocomplete._build(vector_db.metadata)
+    assert _suggest(autocomplete, vector_db, "星巴克") == ["星巴克(国贸店)", "星巴克(三里屯店)"]
+
+    vector_db.delete_merchants("上海", ["1"])
+    assert _suggest(autocomplete, vector_db, "星巴克") == ["星巴克(三里屯店)"]
+
+    vector_db.upsert_merchants("上海", [
+        {"merchant_id": "5", "name": "星巴克(新天地店)", "rating": 4.9, "review_count": 2000},
+        {"merchant_id": "2", "name": "星巴克臻选(三里屯店)", "rating": 4.1, "review_count": 100},
+    ], np.ones((2, 4), dtype="float32"))
+    assert _suggest(autocomplete, vector_db, "星巴克") == ["星巴克(新天地店)", "星巴克臻选(三里屯店)"]
@@ -0,0 +1,60 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from filter_index import DAY_SLOTS, HOURS_SLOT_MINUTES, parse_business_hours, week_slot
+
+
+def is_open(bitmap, day, hhmm):
+    hour, minute = map(int, hhmm.split(":"))
+    slot = day * DAY_SLOTS + (hour * 60 + minute) // HOURS_SLOT_MINUTES
+    return bool((bitmap[slot >> 3] >> (7 - (slot & 7))) & 1)
+
+
+def test_daily_range_rounds_slots_outwards():
+    bitmap = parse_business_hours("10:00-22:00")
+    assert len(bitmap) == 84
+    for day in range(7):
+        assert is_open(bitmap, day, "10:00") and is_open(bitmap, day, "21:59")
+        assert not is_open(bitmap, day, "09:59") and not is_open(bitmap, day, "22:00")
+    # 10:20 开门：10:15-10:30 时段内有营业时间，算作营业
+    assert is_open(parse_business_hours("10:20-22:00"), 0, "10:15")
+
+
+def test_weekday_groups_and_split_ranges():
+    bitmap = parse_business_hours("周一至周五 09:00-18:00；周六、周日 10:00-20:00")
+    assert is_open(bitmap, 0, "09:00") and not is_open(bitmap, 0, "19:00")
+    assert is_open(bitmap, 5, "19:30") and not is_open(bitmap, 5, "09:30")
+
+    bitmap = parse_business_hours("11:00-14:00,17:00-21:30")
+    assert is_open(bitmap, 2, "13:45") and not is_open(bitmap, 2, "15:00") and is_open(bitmap, 2, "21:15")
+
+
+def test_overnight_hours_wrap_into_next_day():
+    bitmap = parse_business_hours("18:00-次日02:00")
+    assert is_open(bitmap, 0, "23:30") and is_open(bitmap, 1, "01:45") and not is_open(bitmap, 1, "02:00")
+    # 周日跨夜绕回周一凌晨
+    assert is_open(bitmap, 0, "01:00")
+    # 结束时间早于开始时间：同样按跨夜处理
+    assert parse_business_hours("18:00-02:00") == bitmap
+
+
+def test_rest_days_all_day_and_closed():
+    bitmap = parse_business_hours("周一休息 10:00-22:00")
+    assert not is_open(bitmap, 0, "12:00") and is_open(bitmap, 1, "12:00")
+
+    assert all(is_open(parse_business_hours("24小时营业"), day, "03:00") for day in range(7))
+    assert parse_business_hours("暂停营业") == bytes(84)
+
+
+@pytest.mark.parametrize("text", ["", "   ", "请电话咨询", "营业时间以门店公告为准"])
+def test_unparseable_text_is_unknown(text):
+    assert parse_business_hours(text) is None
+
+
+def test_week_slot_uses_beijing_time():
+    monday_noon = datetime(2024, 1, 1, 12, 0)  # 2024-01-01 为周一
+    assert week_slot(monday_noon) == 12 * 60 // HOURS_SLOT_MINUTES
+    utc = datetime(2024, 1, 1, 4, 0, tzinfo=timezone.utc)
+    assert week_slot(utc) == week_slot(monday_noon)
+    assert week_slot(datetime(2024, 1, 7, 23, 59)) == 7 * DAY_SLOTS - 1  # 周日最后一个时段
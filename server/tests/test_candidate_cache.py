@@ -0,0 +1,86 @@
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from rag_server import CandidateCache, decode_cursor, encode_cursor
+
+ROUTE = SimpleNamespace(embedding_name="bge", reranker_name="bge-reranker")
+
+
+def _docs(n):
+    return [{"source_city": "上海", "id": i, "name": f"店{i}"} for i in range(n)]
+
+
+def _save(cache, n=10, page=3):
+    docs = _docs(n)
+    return cache.save("咖啡", np.ones(4, dtype=np.float32), ["上海"], "上海", ROUTE,
+                      docs, docs[:page], retrieval_k=n * 2, max_distance=1.0)
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor("abc_-1", 7)) == ("abc_-1", 7)
+    assert decode_cursor(encode_cursor("x", -3)) == ("x", 0)
+
+
+@pytest.mark.parametrize("cursor", ["%%%", encode_cursor("abc", 1)[:-2] + "!!", "YWJj"])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_shared_dir_is_visible_to_other_caches(tmp_path):
+    # 两个 CandidateCache 模拟两个工作进程
+    writer, reader = CandidateCache(), CandidateCache()
+    writer.configure(ttl_s=60, shared_dir=str(tmp_path))
+    reader.configure(ttl_s=60, shared_dir=str(tmp_path))
+
+    entry_id, offset = decode_cursor(_save(writer))
+    assert offset == 3
+    entry = reader.get(entry_id)
+    assert [doc["id"] for doc in entry.order] == list(range(10))
+    assert entry.embedding.tolist() == [1.0] * 4
+
+    # 扩展后写回，其他进程读到扩展后的列表
+    entry.order.append({"source_city": "上海", "id": 99})
+    reader.store(entry_id, entry)
+    assert writer.get(entry_id).order[-1]["id"] == 99
+    assert reader.stats()["entries"] == 1
+
+
+def test_shared_dir_expiry(tmp_path):
+    cache = CandidateCache()
+    cache.configure(ttl_s=60, shared_dir=str(tmp_path))
+    entry_id, _ = decode_cursor(_save(cache))
+    path = os.path.join(str(tmp_path), f"{entry_id}.pkl")
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    assert cache.get(entry_id) is None
+    assert not os.path.exists(path)
+    assert cache.expired == 1
+
+
+def test_shared_dir_rejects_path_like_ids(tmp_path):
+    shared = tmp_path / "cursors"
+    cache = CandidateCache()
+    cache.configure(ttl_s=60, shared_dir=str(shared))
+    entry_id, _ = decode_cursor(_save(cache))
+    os.replace(shared / f"{entry_id}.pkl", tmp_path / "outside.pkl")
+
+    assert cache.get("../outside") is None
+
+
+def test_shared_dir_sweep_keeps_newest(tmp_path):
+    cache = CandidateCache()
+    cache.configure(ttl_s=60, max_entries=2, shared_dir=str(tmp_path))
+    ids = [decode_cursor(_save(cache))[0] for _ in range(3)]
+    for i, entry_id in enumerate(ids):
+        stamp = time.time() - 30 + i
+        os.utime(os.path.join(str(tmp_path), f"{entry_id}.pkl"), (stamp, stamp))
+
+    cache._sweep_shared()
+    assert cache.get(ids[0]) is None
+    assert cache.get(ids[1]) is not None and cache.get(ids[2]) is not None
@@ -0,0 +1,66 @@
+import threading
+
+import faiss
+import numpy as np
+import pytest
+
+from conftest import write_city_version
+from observability import _city_metric_label
+from rag_server import CityIndexHandle, CityVectorDB
+
+
+class CountingLock:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        self.acquired += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _handle(device_tag, gpu_lock):
+    vectors = np.eye(4, dtype="float32")
+    index = faiss.IndexFlatIP(4)
+    index.add(vectors)
+    docs = [{"merchant_id": str(i)} for i in range(4)]
+    return CityIndexHandle("上海", "v1", index, docs, device_tag, gpu_lock)
+
+
+def test_gpu_searches_are_serialized_through_the_shared_lock():
+    lock = CountingLock()
+    handle = _handle("🚀 GPU", lock)
+    hits = handle.search(np.eye(4, dtype="float32")[:1], 2)
+    assert hits[0][1]["merchant_id"] == "0"
+    handle._search_filtered(np.eye(4, dtype="float32")[:1], 1, np.array([2, 3], dtype="int64"), lambda doc: True)
+    assert lock.acquired == 2
+
+
+def test_cpu_searches_do_not_take_the_gpu_lock():
+    lock = CountingLock()
+    _handle("💻 CPU", lock).search(np.eye(4, dtype="float32")[:1], 2)
+    assert lock.acquired == 0
+
+
+def test_city_metric_label_is_bounded():
+    assert _city_metric_label(["上海"]) == "上海"
+    assert _city_metric_label(["上海", "北京"]) == "multi"
+    assert _city_metric_label(["北京", "上海", "深圳"]) == "multi"
+
+
+@pytest.mark.parametrize("metric", [faiss.METRIC_INNER_PRODUCT, faiss.METRIC_L2])
+def test_multi_city_merge_keeps_best_hits(data_dir, metric):
+    # 内积越大越相似、L2 越小越相似；两种度量下最相似的都是 上海 0，其次是 北京 0、北京 1
+    write_city_version(data_dir, "shanghai", "v1", vectors=[[1, 0], [0.1, 0]], metric=metric)
+    write_city_version(data_dir, "beijing", "v1", vectors=[[0.9, 0], [0.8, 0]], metric=metric)
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    try:
+        results = db.search_cities(np.array([1, 0], dtype="float32"), ["上海", "北京"], top_k=3)
+    finally:
+        db.close()
+    assert [doc["merchant_id"] for doc in results] == ["shanghai-0", "beijing-0", "beijing-1"]
+    assert [doc["source_city"] for doc in results] == ["上海", "北京", "北京"]
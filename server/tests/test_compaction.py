@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+from types import SimpleNamespace
+
+import faiss
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+import rag_server
+from rag_server import CityVectorDB
+from conftest import write_city_version
+
+
+@pytest.fixture
+def vector_db(data_dir):
+    write_city_version(data_dir, "shanghai", "v1")
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    yield db
+    db.close()
+
+
+def _upsert(db, merchant_id, d=4):
+    db.upsert_merchants("上海", [{"merchant_id": merchant_id, "name": "新店"}], np.ones((1, d), dtype="float32"))
+
+
+def test_compaction_does_not_warn_about_discarded_changes(vector_db, caplog):
+    _upsert(vector_db, "new-1")
+    vector_db.delete_merchants("上海", ["shanghai-0"])
+    with caplog.at_level(logging.WARNING, logger="rag_server"):
+        result = vector_db.compact_city("上海")
+    assert result["merged"] == 1 and result["removed"] == 1
+    assert "uncompacted" not in caplog.text
+    ids = [doc["merchant_id"] for doc in vector_db.metadata["上海"]]
+    assert "new-1" in ids and "shanghai-0" not in ids
+
+
+def test_compaction_keeps_only_recent_versions(vector_db, data_dir, monkeypatch):
+    vector_db.keep_compacted_versions = 2
+    stamps = iter(f"2026010100000{i}" for i in range(5))
+
+    class FakeDatetime:
+        @staticmethod
+        def now():
+            class Stamp:
+                def strftime(self, fmt):
+                    return next(stamps)
+
+                def isoformat(self):
+                    return "now"
+            return Stamp()
+
+    monkeypatch.setattr("rag_server.datetime", FakeDatetime)
+    for i in range(4):
+        _upsert(vector_db, f"new-{i}")
+        vector_db.compact_city("上海")
+
+    kept = sorted(os.listdir(os.path.join(data_dir, "versions")))
+    assert kept == ["v1", "v1-c20260101000002", "v1-c20260101000003"]
+    assert vector_db.versions["上海"] == "v1-c20260101000003"
+
+
+def test_lossy_indexes_are_not_compacted(data_dir):
+    write_city_version(data_dir, "shanghai", "v1")
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    handle = db._current_handle("上海")
+    sq = faiss.IndexScalarQuantizer(4, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    vectors = np.random.default_rng(0).random((8, 4), dtype=np.float32)
+    sq.train(vectors)
+    sq.add(vectors)
+    handle.index = sq
+    _upsert(db, "new-1")
+    with pytest.raises(ValueError, match="IndexScalarQuantizer"):
+        db.compact_city("上海")
+    assert db.versions["上海"] == "v1"
+    db.close()
+
+
+def test_upsert_rejects_mismatched_dimension(vector_db):
+    with pytest.raises(ValueError, match="dimension"):
+        _upsert(vector_db, "new-1", d=8)
+
+
+def test_merchant_endpoints_require_admin_token(vector_db, monkeypatch):
+    monkeypatch.setattr(rag_server, "models", SimpleNamespace(vector_db=vector_db))
+    monkeypatch.delenv("RAG_ADMIN_TOKEN", raising=False)
+    monkeypatch.delenv("RAG_ADMIN_INSECURE", raising=False)
+    calls = [
+        rag_server.upsert_merchants("上海", rag_server.MerchantUpsertRequest(merchants=[]), x_admin_token=None),
+        rag_server.delete_merchants("上海", rag_server.MerchantDeleteRequest(merchant_ids=["1"]), x_admin_token=None),
+        rag_server.compact_merchants("上海", x_admin_token=None),
+    ]
+    for call in calls:
+        with pytest.raises(HTTPException) as excinfo:
+            asyncio.run(call)
+        assert excinfo.value.status_code == 403
+
+
+@pytest.mark.parametrize("metric", [faiss.METRIC_INNER_PRODUCT, faiss.METRIC_L2])
+def test_search_orders_base_and_delta_hits_by_metric(data_dir, metric):
+    # 两种度量下 delta 段的 new-1 都排在 shanghai-0 与 shanghai-1 之间
+    write_city_version(data_dir, "shanghai", "v1", vectors=[[1, 0], [0.1, 0]], metric=metric)
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    db.upsert_merchants("上海", [{"merchant_id": "new-1", "name": "新店"}], np.array([[0.95, 0]], dtype="float32"))
+    handle = db._current_handle("上海")
+    query = np.array([[1, 0]], dtype="float32")
+    expected = ["shanghai-0", "new-1", "shanghai-1"]
+    try:
+        assert [doc["merchant_id"] for _, doc in handle.search(query, 3)] == expected
+        assert [doc["merchant_id"] for _, doc in handle.search(query, 2)] == expected[:2]
+        rows = np.arange(2, dtype="int64")
+        hits = handle._search_filtered(query, 3, rows, lambda doc: True)
+        assert [doc["merchant_id"] for _, doc in hits] == expected
+    finally:
+        db.close()
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from evaluate_pipeline import config_id, prepare_models, retriever_index_versions
+
+
+class FakeVectorDB:
+    def __init__(self, versions):
+        self.versions = dict(versions)
+        self.swaps = []
+
+    def swap_city(self, city, version, write_manifest=True):
+        assert not write_manifest
+        self.swaps.append((city, version))
+        self.versions[city] = version
+
+
+def test_prepare_models_restores_default_versions():
+    defaults = {"上海": "v1", "北京": "v1"}
+    db = FakeVectorDB(defaults)
+    models = SimpleNamespace(vector_db=db, reranker_model=None)
+    loaded = {"retriever": "/m/a"}
+    pinned = ("a", "/m/a", "v2")
+    plain = ("a", "/m/a", None)
+    no_reranker = ("none", None, None)
+
+    prepare_models(models, loaded, pinned, no_reranker, retriever_index_versions(pinned, defaults), "torch")
+    assert db.versions == {"上海": "v2", "北京": "v2"}
+
+    prepare_models(models, loaded, plain, no_reranker, retriever_index_versions(plain, defaults), "torch")
+    assert db.versions == defaults
+
+
+def test_config_id_depends_on_data_dir_and_index_versions():
+    config = {"retriever": "a", "data_dir": "/data/a", "index_versions": {"上海": "v1"}}
+    base = config_id(config, "digest")
+    assert config_id(dict(config, data_dir="/data/b"), "digest") != base
+    assert config_id(dict(config, index_versions={"上海": "v2"}), "digest") != base
+    assert config_id(dict(config), "digest") == base
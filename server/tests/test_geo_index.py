@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from filter_index import GeoIndex, _merchant_coords, haversine_m
+
+
+@pytest.mark.parametrize("doc, expected", [
+    ({"latitude": 31.23, "longitude": 121.47}, (31.23, 121.47)),
+    ({"lat": "31.23", "lng": "121.47"}, (31.23, 121.47)),
+    ({"location": {"lat": 31.23, "lon": 121.47}}, (31.23, 121.47)),
+    ({"location": "121.47,31.23"}, (31.23, 121.47)),       # 高德：经度在前
+    ({"location": [121.47, 31.23]}, (31.23, 121.47)),      # GeoJSON 顺序
+    ({"latitude": 0, "longitude": 0}, None),
+    ({"latitude": 95, "longitude": 121.47}, None),
+    ({"name": "无坐标"}, None),
+])
+def test_merchant_coords_formats(doc, expected):
+    assert _merchant_coords(doc) == expected
+
+
+def test_radius_query_matches_brute_force():
+    rng = np.random.default_rng(0)
+    lats = 31.2 + rng.uniform(-0.2, 0.2, 2000)
+    lngs = 121.45 + rng.uniform(-0.2, 0.2, 2000)
+    metadata = [{"latitude": float(lat), "longitude": float(lng)} for lat, lng in zip(lats, lngs)]
+    index = GeoIndex(metadata)
+
+    for lat, lng, radius in [(31.2, 121.45, 1500.0), (31.35, 121.6, 3000.0), (31.0, 121.45, 500.0)]:
+        expected = np.flatnonzero(haversine_m(lat, lng, lats, lngs) <= radius)
+        assert sorted(index.query(lat, lng, radius).tolist()) == expected.tolist()
+
+
+def test_district_centroid_fallback_and_contains():
+    metadata = [
+        {"district": "黄浦区", "latitude": 31.23, "longitude": 121.48},
+        {"district": "黄浦区", "latitude": 31.25, "longitude": 121.50},
+        {"district": "黄浦区"},                 # 没有坐标：按区县质心定位
+        {"district": "未知区"},                 # 区县也没有坐标：不进入索引
+    ]
+    index = GeoIndex(metadata)
+    assert index.stats()["exact"] == 2 and index.stats()["district_centroid"] == 1
+    assert sorted(index.query(31.24, 121.49, 100).tolist()) == [2]
+
+    distance, precision = index.distance_to(31.24, 121.49, metadata[2])
+    assert precision == "district" and distance < 1
+    assert index.distance_to(31.24, 121.49, metadata[3]) is None
+    assert index.contains(31.24, 121.49) and not index.contains(39.9, 116.4)
+
+
+def test_empty_index():
+    index = GeoIndex([{"name": "无坐标"}])
+    assert index.query(31.2, 121.4, 1000).tolist() == []
+    assert not index.contains(31.2, 121.4)
@@ -0,0 +1,122 @@
+import fcntl
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import rag_server
+from rag_server import CityVectorDB
+from conftest import write_city_version
+
+
+@pytest.mark.parametrize("version", ["..", "../etc", "a/b", ".hidden", "v1/../../x", ""])
+def test_index_paths_reject_traversal(data_dir, version):
+    db = CityVectorDB(data_dir, use_gpu=False)
+    with pytest.raises(ValueError):
+        db.index_paths("shanghai", version)
+
+
+def test_index_version_keeps_per_city_manifest_entries(data_dir):
+    write_city_version(data_dir, "shanghai", "v1")
+    write_city_version(data_dir, "shanghai", "v2")
+    write_city_version(data_dir, "beijing", "v2")
+    write_city_version(data_dir, "beijing", "v3")
+    with open(os.path.join(data_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"default_version": "v1", "cities": {"shanghai": "v1"}}, f)
+
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v2")
+    assert db.versions == {"上海": "v2", "北京": "v2"}
+    assert db.default_version == "v2"
+
+    db.swap_city("北京", "v3")
+    with open(os.path.join(data_dir, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    assert manifest["cities"] == {"shanghai": "v1", "beijing": "v3"}
+    assert manifest["default_version"] == "v1"
+    db.close()
+
+
+@pytest.fixture
+def vector_db(data_dir, monkeypatch):
+    write_city_version(data_dir, "shanghai", "v1")
+    db = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    monkeypatch.setattr(rag_server, "models", SimpleNamespace(vector_db=db))
+    yield db
+    db.close()
+
+
+def _status(call, *args, **kwargs):
+    try:
+        call(*args, **kwargs)
+    except HTTPException as e:
+        return e.status_code
+    return 200
+
+
+def test_admin_disabled_without_token(vector_db, monkeypatch):
+    monkeypatch.delenv("RAG_ADMIN_TOKEN", raising=False)
+    monkeypatch.delenv("RAG_ADMIN_INSECURE", raising=False)
+    assert _status(rag_server.list_indexes, x_admin_token=None) == 403
+    assert _status(rag_server.list_indexes, x_admin_token="anything") == 403
+
+
+def test_admin_requires_matching_token(vector_db, monkeypatch):
+    monkeypatch.setenv("RAG_ADMIN_TOKEN", "secret")
+    assert _status(rag_server.list_indexes, x_admin_token=None) == 403
+    assert _status(rag_server.list_indexes, x_admin_token="wrong") == 403
+    assert _status(rag_server.list_indexes, x_admin_token="secret") == 200
+
+
+def test_reload_rejects_traversal_and_unknown_versions(vector_db, monkeypatch):
+    monkeypatch.setenv("RAG_ADMIN_TOKEN", "secret")
+    request = rag_server.IndexReloadRequest(version="../../etc")
+    assert _status(rag_server.reload_indexes, request, x_admin_token="secret") == 400
+    request = rag_server.IndexReloadRequest(version="v9")
+    assert _status(rag_server.reload_indexes, request, x_admin_token="secret") == 404
+
+
+def _wait_for_job(db, job_id, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = db.get_reload_job(job_id)
+        if job and job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_reload_jobs_are_visible_and_exclusive_across_workers(data_dir, tmp_path):
+    write_city_version(data_dir, "shanghai", "v1")
+    write_city_version(data_dir, "shanghai", "v2")
+    jobs_dir = str(tmp_path / "jobs")
+    # 两个 CityVectorDB 模拟两个工作进程
+    worker_a = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    worker_b = CityVectorDB(data_dir, use_gpu=False, index_version="v1")
+    worker_a.share_reload_jobs(jobs_dir)
+    worker_b.share_reload_jobs(jobs_dir)
+
+    # 另一个进程持有热更新锁时拒绝
+    with open(os.path.join(jobs_dir, "reload.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with pytest.raises(RuntimeError):
+            worker_b.start_reload("v2", ["上海"])
+
+    job = worker_a.start_reload("v2", ["上海"])
+    finished = _wait_for_job(worker_b, job["job_id"])
+    assert finished["status"] == "completed" and finished["swapped"]
+    assert [j["job_id"] for j in worker_b.recent_reload_jobs()] == [job["job_id"]]
+    assert worker_b.get_reload_job("../manifest") is None
+    worker_a.close()
+    worker_b.close()
+
+
+def test_manifest_watcher_has_its_own_stop_event(data_dir):
+    write_city_version(data_dir, "shanghai", "v1")
+    db = CityVectorDB(data_dir, use_gpu=False)
+    db.stop_compactor()
+    assert not db._manifest_watcher_stop.is_set()
+    db.close()
+    assert db._manifest_watcher_stop.is_set()
@@ -0,0 +1,40 @@
+import time
+
+from filter_index import LocationParser
+
+CITIES = {"上海": "shanghai", "北京": "beijing"}
+
+
+def _wait_rebuilt(parser, timeout=5.0):
+    deadline = time.time() + timeout
+    while parser._building and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_parser_routes_by_city_and_area():
+    parser = LocationParser()
+    parser.build(CITIES, metadata={"上海": [{"district": "浦东新区"}], "北京": [{"district": "朝阳区"}]})
+    location = parser.parse("浦东新区的火锅")
+    assert location.cities == ["上海"] and location.areas == {"上海": ["浦东新区"]}
+    assert parser.parse("北京 好吃的").cities == ["北京"]
+
+
+def test_refresh_rebuilds_area_dictionary_after_swap():
+    parser = LocationParser()
+    shanghai = [{"district": "浦东新区"}]
+    parser.build(CITIES, metadata={"上海": shanghai})
+    assert parser.parse("徐汇区咖啡").cities == []
+
+    parser.refresh({"上海": shanghai})
+    assert not parser._building  # 元数据未变化时不重建
+
+    parser.refresh({"上海": [{"district": "浦东新区"}, {"district": "徐汇区"}]})
+    _wait_rebuilt(parser)
+    assert parser.parse("徐汇区咖啡").areas == {"上海": ["徐汇区"]}
+
+
+def test_refresh_waits_for_the_startup_area_build():
+    parser = LocationParser()
+    parser.build(CITIES)
+    parser.refresh({"上海": [{"district": "徐汇区"}]})
+    assert not parser._building and not parser.includes_areas
@@ -0,0 +1,30 @@
+import json
+import logging
+import queue
+
+from observability import JsonFormatter, _DroppingQueueHandler
+
+
+def test_queued_records_keep_exception_for_json_formatter():
+    log_queue = queue.Queue()
+    test_logger = logging.getLogger("rag_server.test_queue_handler")
+    test_logger.handlers = [_DroppingQueueHandler(log_queue)]
+    test_logger.propagate = False
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        test_logger.exception("Failed for %s", "shanghai")
+
+    record = log_queue.get_nowait()
+    assert record.exc_info is None and record.args is None
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["msg"] == "Failed for shanghai"
+    assert "RuntimeError: boom" in entry["exc"]
+
+
+def test_queue_full_drops_instead_of_blocking():
+    handler = _DroppingQueueHandler(queue.Queue(maxsize=1))
+    record = logging.LogRecord("rag_server", logging.INFO, __file__, 1, "msg", None, None)
+    handler.handle(record)
+    handler.handle(record)
+    assert handler.queue.qsize() == 1
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import observability
+from observability import Counter, Histogram, ObservedExecutor, _Metric
+
+
+def test_metric_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        _Metric("rag_test", "help")
+
+
+def test_counter_and_histogram_render_prometheus_text():
+    counter = Counter("rag_test_total", "Test counter", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    assert counter.render()[-1] == 'rag_test_total{kind="a"} 3.0'
+
+    histogram = Histogram("rag_test_seconds", "Test histogram", (), buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    lines = histogram.render()
+    assert 'rag_test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'rag_test_seconds_bucket{le="+Inf"} 2' in lines
+    assert "rag_test_seconds_count 2" in lines
+
+
+def test_observed_executor_tracks_queue_depth():
+    release = threading.Event()
+    started = threading.Event()
+    executor = ObservedExecutor(max_workers=1)
+    assert executor in observability._observed_executors
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    futures = [executor.submit(block) for _ in range(3)]
+    started.wait(5)
+    assert executor.queue_depth == 2
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert executor.queue_depth == 0
+
+    release.clear()
+    started.clear()
+    executor.submit(block)
+    started.wait(5)
+    executor.submit(block)
+    release.set()
+    executor.shutdown(wait=True, cancel_futures=True)
+    assert executor.queue_depth == 0
+    assert executor not in observability._observed_executors
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+import pytest
+
+from batching import MicroBatcher
+from observability import Histogram
+
+
+class DoublingBatcher(MicroBatcher):
+    def __init__(self, **kwargs):
+        super().__init__(Histogram("test_batch_size", "", ("target",)), Histogram("test_queue_wait", "", ("target",)),
+                         "target", **kwargs)
+        self.calls = []
+
+    def _process(self, target, payloads):
+        self.calls.append((threading.current_thread().name, list(payloads)))
+        return [target * p for p in payloads]
+
+
+def test_micro_batcher_is_abstract():
+    with pytest.raises(TypeError):
+        MicroBatcher(Histogram("a", ""), Histogram("b", ""), "target")
+
+
+def test_concurrent_requests_are_batched_per_target():
+    batcher = DoublingBatcher(max_batch_size=3, max_wait_ms=20)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(2, i) for i in range(5)), batcher.submit(10, 1))
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8, 10]
+    sizes = sorted(len(payloads) for _, payloads in batcher.calls)
+    assert sizes == [1, 2, 3]
+    assert batcher.stats()["items"] == 6 and batcher.stats()["queued"] == 0
+    # 批次在专用线程池中执行，不占用事件循环的默认 executor
+    assert all(name.startswith("DoublingBatcher") for name, _ in batcher.calls)
+
+
+def test_errors_propagate_to_every_request_in_the_batch():
+    class FailingBatcher(DoublingBatcher):
+        def _process(self, target, payloads):
+            raise RuntimeError("boom")
+
+    batcher = FailingBatcher(max_batch_size=4, max_wait_ms=10)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(1, i) for i in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_cancelled_requests_are_dropped_before_processing():
+    batcher = DoublingBatcher(max_batch_size=8, max_wait_ms=30)
+
+    async def run():
+        cancelled = asyncio.ensure_future(batcher.submit(1, 99))
+        kept = asyncio.ensure_future(batcher.submit(1, 1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await kept
+
+    assert asyncio.run(run()) == 1
+    assert [payloads for _, payloads in batcher.calls] == [[1]]
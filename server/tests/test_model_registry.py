@@ -0,0 +1,111 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import rag_server
+from registry import ModelRegistry
+
+
+class FakeVectorDB:
+    def __init__(self, nbytes=0):
+        self.nbytes = nbytes
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _loader(shared_db, owned_db=None, nbytes=100, fail=False):
+    def load(entry):
+        entry.model = object()
+        entry.nbytes = nbytes
+        entry.vector_db = owned_db or shared_db
+        entry.owns_vector_db = owned_db is not None
+        if fail:
+            raise ValueError("dimension mismatch")
+    return load
+
+
+def test_eviction_keeps_shared_vector_db_open():
+    shared = FakeVectorDB()
+    registry = ModelRegistry(_loader(shared), memory_budget_bytes=150)
+    first = registry.register("embedding", "a", "/models/a")
+    second = registry.register("embedding", "b", "/models/b")
+
+    registry.acquire(first)
+    registry.release(first)
+    registry.acquire(second)
+    registry.release(second)
+
+    assert first.model is None and first.vector_db is None
+    assert not shared.closed
+
+
+def test_eviction_closes_owned_vector_db():
+    shared, owned = FakeVectorDB(), FakeVectorDB()
+    registry = ModelRegistry(_loader(shared, owned), memory_budget_bytes=150)
+    entry = registry.register("embedding", "a", "/models/a", index_version="v2")
+    other = registry.register("reranker", "b", "/models/b")
+    registry._loader = _loader(shared, owned)
+    registry.acquire(entry)
+    registry.release(entry)
+
+    registry._loader = _loader(shared)
+    registry.acquire(other)
+
+    assert owned.closed and entry.vector_db is None and not entry.owns_vector_db
+    assert not shared.closed
+
+
+def test_failed_load_leaves_entry_unloaded():
+    shared, owned = FakeVectorDB(), FakeVectorDB()
+    registry = ModelRegistry(_loader(shared, owned, fail=True), memory_budget_bytes=None)
+    entry = registry.register("embedding", "a", "/models/a", index_version="v2")
+
+    with pytest.raises(ValueError):
+        registry.acquire(entry)
+
+    assert entry.model is None and entry.vector_db is None and entry.nbytes == 0
+    assert owned.closed and not shared.closed
+    assert not registry.try_acquire(entry)
+
+
+class FakeRouting:
+    """models.route 的替身：记录退出时收到的异常"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.exit_exceptions = []
+
+    @asynccontextmanager
+    async def route(self, retriever, reranker):
+        if self.fail:
+            raise RuntimeError("out of memory")
+        try:
+            yield SimpleNamespace(embedding_name=retriever, reranker_name=reranker)
+        except BaseException as e:
+            self.exit_exceptions.append(e)
+            raise
+
+
+def test_routing_failure_becomes_503(monkeypatch):
+    monkeypatch.setattr(rag_server, "models", FakeRouting(fail=True))
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(rag_server.perform_rag_search("咖啡", "上海", 5, "bge", "bge-reranker"))
+    assert excinfo.value.status_code == 503
+
+
+def test_search_error_reaches_route_context(monkeypatch):
+    routing = FakeRouting()
+    monkeypatch.setattr(rag_server, "models", routing)
+
+    async def fail(*args, **kwargs):
+        raise ValueError("boom")
+
+    monkeypatch.setattr(rag_server, "_perform_rag_search", fail)
+    with pytest.raises(ValueError, match="boom"):
+        asyncio.run(rag_server.perform_rag_search("咖啡", "上海", 5, "bge", "bge-reranker"))
+    assert [type(e) for e in routing.exit_exceptions] == [ValueError]
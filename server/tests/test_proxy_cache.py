@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+# proxy_server.py 位于仓库根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import proxy_server  # noqa: E402
+
+
+class StubUpstream:
+    """模拟 RAG 服务器：记录调用次数，搜索接口按请求体决定延迟和响应头"""
+
+    def __init__(self):
+        self.calls = {"search": 0, "health": 0}
+        self.cancelled = 0
+        self.started = asyncio.Event()
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.calls["search"] += 1
+        payload = await request.json()
+        self.started.set()
+        try:
+            await asyncio.sleep(payload.get("delay", 0.05))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        headers = {"Vary": "Accept-Encoding"}
+        if payload.get("degraded"):
+            headers["X-Degraded"] = "no_llm"
+        if "cursor_ttl" in payload:
+            headers["X-Cursor-TTL"] = str(payload["cursor_ttl"])
+        return web.json_response({"n": self.calls["search"]}, headers=headers)
+
+    async def health(self, request: web.Request) -> web.Response:
+        self.calls["health"] += 1
+        return web.json_response({"status": "ok"})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/rag/search", self.search)
+        app.router.add_get("/health", self.health)
+        return app
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    # _run 会把 RAG_SERVER 指向模拟上游，测试结束后恢复
+    monkeypatch.setattr(proxy_server, "RAG_SERVER", proxy_server.RAG_SERVER)
+    monkeypatch.setattr(proxy_server, "_cache", proxy_server.ResponseCache(60, 16))
+    monkeypatch.setattr(proxy_server, "_inflight", {})
+    monkeypatch.setattr(proxy_server, "_waiters", {})
+    monkeypatch.setattr(proxy_server, "_semaphores", {})
+
+
+def _run(scenario):
+    """启动模拟上游和代理，执行 scenario(client, upstream)"""
+    async def run():
+        upstream = StubUpstream()
+        upstream_server = TestServer(upstream.app(), handler_cancellation=True)
+        await upstream_server.start_server()
+        proxy_server.RAG_SERVER = str(upstream_server.make_url("")).rstrip("/")
+        # handler_cancellation：与 run_app 一致，客户端断开时取消处理函数
+        client = TestClient(TestServer(proxy_server.create_app(), handler_cancellation=True))
+        await client.start_server()
+        try:
+            await scenario(client, upstream)
+        finally:
+            await client.close()
+            await upstream_server.close()
+    asyncio.run(run())
+
+
+async def _search(client, body, **headers):
+    response = await client.post("/api/rag/search", data=body, headers=headers)
+    return response.headers.get("X-Proxy-Cache"), await response.json()
+
+
+def test_concurrent_identical_posts_share_one_upstream_call():
+    async def scenario(client, upstream):
+        # 键顺序和空白不同的 JSON 请求体规范化后是同一个 key
+        bodies = ['{"query": "咖啡", "top_k": 5}', '{"top_k":5,"query":"咖啡"}', '{ "query":"咖啡", "top_k":5 }']
+        results = await asyncio.gather(*[_search(client, body) for body in bodies])
+        assert upstream.calls["search"] == 1
+        assert sorted(status for status, _ in results) == ["COALESCED", "COALESCED", "MISS"]
+        assert all(payload == {"n": 1} for _, payload in results)
+        assert proxy_server._cache.coalesced == 2
+
+        status, payload = await _search(client, bodies[0])
+        assert (status, payload) == ("HIT", {"n": 1})
+        assert upstream.calls["search"] == 1
+    _run(scenario)
+
+
+def test_accept_encoding_is_part_of_the_key():
+    async def scenario(client, upstream):
+        body = '{"query": "咖啡"}'
+        assert (await _search(client, body, **{"Accept-Encoding": "gzip"}))[0] == "MISS"
+        assert (await _search(client, body, **{"Accept-Encoding": "identity"}))[0] == "MISS"
+        assert (await _search(client, body, **{"Accept-Encoding": "gzip"}))[0] == "HIT"
+        assert upstream.calls["search"] == 2
+    _run(scenario)
+
+
+def test_health_is_never_cached():
+    async def scenario(client, upstream):
+        for _ in range(2):
+            response = await client.get("/health")
+            assert response.status == 200
+            assert "X-Proxy-Cache" not in response.headers
+        assert upstream.calls["health"] == 2
+    _run(scenario)
+
+
+def test_degraded_response_is_not_stored():
+    async def scenario(client, upstream):
+        body = json.dumps({"query": "咖啡", "degraded": True})
+        assert (await _search(client, body))[0] == "MISS"
+        assert (await _search(client, body))[0] == "MISS"
+        assert upstream.calls["search"] == 2
+        assert not proxy_server._cache._entries
+    _run(scenario)
+
+
+def test_cursor_ttl_caps_cache_ttl():
+    async def scenario(client, upstream):
+        await _search(client, json.dumps({"query": "咖啡", "cursor_ttl": 5}))
+        await _search(client, json.dumps({"query": "奶茶", "cursor_ttl": 3600}))
+        ttls = sorted(entry.ttl for entry in proxy_server._cache._entries.values())
+        assert ttls == [5.0, proxy_server.CACHE_TTL]
+    _run(scenario)
+
+
+def test_upstream_is_cancelled_when_every_waiter_disconnects():
+    async def scenario(client, upstream):
+        body = json.dumps({"query": "咖啡", "delay": 5})
+        first = asyncio.ensure_future(_search(client, body))
+        await upstream.started.wait()
+        second = asyncio.ensure_future(_search(client, body))
+        while proxy_server._cache.coalesced < 1:
+            await asyncio.sleep(0.01)
+
+        # 只断开一个等待者时上游请求继续
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.sleep(0.1)
+        assert upstream.cancelled == 0 and proxy_server._cache.abandoned == 0
+
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        for _ in range(100):
+            if upstream.cancelled:
+                break
+            await asyncio.sleep(0.02)
+        assert proxy_server._cache.abandoned == 1
+        assert upstream.cancelled == 1
+        assert upstream.calls["search"] == 1 and not proxy_server._inflight
+    _run(scenario)
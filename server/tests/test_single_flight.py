@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from rag_server import SingleFlight
+
+
+class SlowCall:
+    """慢协程工厂：记录执行与被取消的次数，release 之后才返回"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return "result"
+
+
+async def _settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_calls_run_once():
+    async def run():
+        flight, call = SingleFlight(), SlowCall()
+        tasks = [asyncio.ensure_future(flight.do("k", call)) for _ in range(5)]
+        await _settle()
+        assert flight.in_flight == 1
+        call.release.set()
+        results = await asyncio.gather(*tasks)
+        assert call.calls == 1 and flight.executed == 1 and flight.coalesced == 4
+        assert sorted(coalesced for _, coalesced in results) == [False, True, True, True, True]
+        assert all(result == "result" for result, _ in results)
+        assert flight.in_flight == 0
+    asyncio.run(run())
+
+
+def test_exception_is_shared_by_all_waiters():
+    async def run():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(*[flight.do("k", fail) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert flight.executed == 1 and flight.in_flight == 0
+    asyncio.run(run())
+
+
+def test_call_is_cancelled_only_after_every_waiter_leaves():
+    async def run():
+        flight, call = SingleFlight(), SlowCall()
+        tasks = [asyncio.ensure_future(flight.do("k", call)) for _ in range(3)]
+        await _settle()
+
+        for task in tasks[:2]:
+            task.cancel()
+        await _settle()
+        assert call.cancelled == 0 and flight.abandoned == 0
+
+        tasks[2].cancel()
+        await _settle()
+        assert call.cancelled == 1 and flight.abandoned == 1
+        assert flight.in_flight == 0
+        await asyncio.gather(*tasks, return_exceptions=True)
+    asyncio.run(run())
+
+
+def test_joined_follower_keeps_call_alive_until_it_leaves():
+    async def run():
+        flight, call = SingleFlight(), SlowCall()
+        leader = asyncio.ensure_future(flight.do("k", call))
+        await _settle()
+
+        # join 同步登记：协程尚未开始运行，发起者离开也不会取消执行
+        follower = flight.join("k")
+        leader.cancel()
+        await _settle()
+        assert call.cancelled == 0 and flight.coalesced == 1
+
+        follower_task = asyncio.ensure_future(follower)
+        await _settle()
+        follower_task.cancel()
+        await _settle()
+        assert call.cancelled == 1 and flight.abandoned == 1
+        with pytest.raises(asyncio.CancelledError):
+            await follower_task
+        await asyncio.gather(leader, return_exceptions=True)
+    asyncio.run(run())
+
+
+def test_new_call_starts_after_previous_finishes():
+    async def run():
+        flight, call = SingleFlight(), SlowCall()
+        call.release.set()
+        assert await flight.do("k", call) == ("result", False)
+        assert await flight.do("k", call) == ("result", False)
+        assert call.calls == 2 and flight.coalesced == 0
+    asyncio.run(run())
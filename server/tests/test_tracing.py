@@ -0,0 +1,38 @@
+import pytest
+
+from observability import SPAN_KIND_SERVER, STATUS_CODE_ERROR, Tracer, otlp_trace_request
+
+
+class CapturingExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+def test_stage_spans_are_timed_live_under_the_request_span():
+    exporter = CapturingExporter()
+    tracer = Tracer(sample_rate=1.0, exporter=exporter)
+    with tracer.span("http.request", kind=SPAN_KIND_SERVER, path="/api/rag/search") as root:
+        with tracer.span("embedding", model="bge"):
+            pass
+        with pytest.raises(RuntimeError):
+            with tracer.span("rerank", pairs=3):
+                raise RuntimeError("reranker down")
+
+    embedding, rerank, request = exporter.spans
+    assert embedding.parent_id == rerank.parent_id == root.span_id
+    assert root.start_ns <= embedding.start_ns <= embedding.end_ns <= rerank.start_ns <= root.end_ns
+
+    otlp = rerank.to_otlp()
+    assert otlp["status"] == {"code": STATUS_CODE_ERROR, "message": "reranker down"}
+    assert {"key": "pairs", "value": {"intValue": "3"}} in otlp["attributes"]
+    assert request.to_otlp()["kind"] == SPAN_KIND_SERVER and "parentSpanId" not in request.to_otlp()
+
+
+def test_otlp_trace_request_wraps_spans_with_service_resource():
+    payload = otlp_trace_request([{"name": "x"}])
+    resource_spans = payload["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"] == [{"key": "service.name", "value": {"stringValue": "rag-server"}}]
+    assert resource_spans["scopeSpans"][0]["spans"] == [{"name": "x"}]